@@ -111,6 +111,9 @@ class ResNetBackbone(nn.Module):
         self.dilation = 1
         self.atrous_layers = atrous_layers
 
+        # The indices of the layers to use activation checkpointing on during training
+        self.checkpoint_layers = []
+
         # From torchvision.models.resnet.Resnet
         self.inplanes = 64
 
@@ -215,8 +218,14 @@ class ResNetBackbone(nn.Module):
         x = self.maxpool(x)
 
         outs = []
-        for layer in self.layers:
-            x = layer(x)
+        for idx, layer in enumerate(self.layers):
+            if self.training and idx in self.checkpoint_layers:
+                # Imported here because utils imports the config, which imports this file
+                from utils.functions import checkpoint_module
+
+                x = checkpoint_module(layer, x)
+            else:
+                x = layer(x)
             outs.append(x)
 
         return tuple(outs)
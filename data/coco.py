@@ -131,13 +131,13 @@ class COCODetection(data.Dataset):
         # Separate out crowd annotations. These are annotations that signify a large crowd of
         # objects of said class, where there is no annotation for each individual object. Both
         # during testing and training, consider these crowds as neutral.
-        crowd = [x for x in target if ("iscrowd" in x and x["iscrowd"])]
+        # Copy the crowds before changing their category so the annotations in self.coco stay intact.
+        crowd = [
+            dict(x, category_id=-1) for x in target if ("iscrowd" in x and x["iscrowd"])
+        ]
         target = [x for x in target if not ("iscrowd" in x and x["iscrowd"])]
         num_crowds = len(crowd)
 
-        for x in crowd:
-            x["category_id"] = -1
-
         # This is so we ensure that all crowd annotations are at the end of the array
         target += crowd
 
@@ -663,6 +663,14 @@ coco_base_config = Config(
         # If using batchnorm anywhere in the backbone, freeze the batchnorm layer during training.
         # Note: any additional batch norm layers after the backbone will not be frozen.
         "freeze_bn": False,
+        # Activation checkpointing: while training, don't keep the activations of these parts of the network in memory
+        # for the backward pass but recompute them during it. The gradients are exactly the same, at the cost of running
+        # those parts forward twice, so use this to fit bigger batches or images in memory.
+        # checkpoint_backbone_layers is a list of indices into a ResNet backbone's layers (e.g., [0, 1, 2] for the
+        # first three), and checkpoint_fpn and checkpoint_proto_net checkpoint the whole FPN and protonet respectively.
+        "checkpoint_backbone_layers": [],
+        "checkpoint_fpn": False,
+        "checkpoint_proto_net": False,
         # Set this to a config object if you want an FPN (inherit from fpn_base). See fpn_base for details.
         "fpn": None,
         # Use the same weights for each network head
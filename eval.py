@@ -2,13 +2,16 @@ from data import COCODetection, get_label_map, MEANS, COLORS
 from yolact import Yolact
 from utils.augmentations import BaseTransform, FastBaseTransform, Resize
 from utils.functions import MovingAverage, ProgressBar
+from utils.functions import JSONArrayWriter, read_json_array_lines
+from utils.cocoeval import COCOEvaluator
 from layers.box_utils import jaccard, center_size, mask_iou
 from utils import timer
 from utils.functions import SavePath
 from layers.output_utils import postprocess, undo_image_transformation
+from layers.output_utils import ROIMasks, PackedMasks, RLEMasks
 import pycocotools
 
-from data import cfg, set_cfg, set_dataset
+from data import cfg, set_cfg, set_dataset, mask_type
 
 import numpy as np
 import torch
@@ -20,8 +23,10 @@ import random
 import cProfile
 import pickle
 import json
+import csv
 import os
-from collections import defaultdict
+import multiprocessing
+from collections import defaultdict, deque
 from pathlib import Path
 from collections import OrderedDict
 from PIL import Image
@@ -39,6 +44,32 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
+def str2shard(v):
+    """ Parses a shard given as i/N into the tuple (i, N). """
+    try:
+        shard_idx, num_shards = [int(x) for x in v.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Shard expected in the format i/N.")
+
+    if not (0 <= shard_idx < num_shards):
+        raise argparse.ArgumentTypeError("Shard index must be in [0, N).")
+
+    return shard_idx, num_shards
+
+
+def str2ints(v):
+    """ Parses a comma separated list of positive ints, like 550,700. """
+    try:
+        values = [int(x) for x in v.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Comma separated integers expected.")
+
+    if any(x <= 0 for x in values):
+        raise argparse.ArgumentTypeError("Values must be positive.")
+
+    return values
+
+
 def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="YOLACT COCO Evaluation")
     parser.add_argument(
@@ -56,6 +87,36 @@ def parse_args(argv=None):
     parser.add_argument(
         "--cuda", default=True, type=str2bool, help="Use cuda to evaulate model"
     )
+    parser.add_argument(
+        "--cpu_threads",
+        default=0,
+        type=int,
+        help="The number of threads Pytorch should use for the network and postprocessing when running on the CPU (i.e., with --cuda=False). Use 0 for Pytorch's default.",
+    )
+    parser.add_argument(
+        "--fuse_conv_bn",
+        default=False,
+        type=str2bool,
+        help="Fold the (frozen) batch norm layers into the convs before them after loading the weights. The outputs are the same up to float rounding, but each forward skips a pass over every one of those activation maps, which helps most on the CPU.",
+    )
+    parser.add_argument(
+        "--quantize",
+        default=False,
+        type=str2bool,
+        help="Run the network in int8 on the CPU (static post-training quantization of the backbone, FPN, protonet and prediction head convs). In quantitative mode, this also evaluates the fp32 network and prints an mAP and latency comparison of the two (their results files get _fp32 and _int8 added to the names).",
+    )
+    parser.add_argument(
+        "--quantize_calib_images",
+        default=100,
+        type=int,
+        help="If quantize is set, the number of validation images to calibrate the int8 activation ranges on.",
+    )
+    parser.add_argument(
+        "--quantized_model",
+        default=None,
+        type=str,
+        help="If quantize is set, load the int8 network from this file (made by quantize.py) instead of calibrating. If the file doesn't exist, the calibrated network is saved there.",
+    )
     parser.add_argument(
         "--fast_nms",
         default=True,
@@ -68,6 +129,46 @@ def parse_args(argv=None):
         type=str2bool,
         help="Whether compute NMS cross-class or per-class.",
     )
+    parser.add_argument(
+        "--nms_mode",
+        default=None,
+        type=str,
+        choices=["fast", "traditional", "matrix", "soft"],
+        help="Which NMS to use. fast and traditional are the same as setting --fast_nms. matrix (Matrix NMS) and soft (Soft-NMS) decay the scores of overlapping detections instead of removing them. If left unset, --fast_nms decides.",
+    )
+    parser.add_argument(
+        "--nms_kernel",
+        default="gaussian",
+        type=str,
+        choices=["gaussian", "linear"],
+        help="The decay function used for --nms_mode=matrix or soft. linear Soft-NMS only decays overlaps above the NMS threshold.",
+    )
+    parser.add_argument(
+        "--nms_sigma",
+        default=0.5,
+        type=float,
+        help="The sigma of the gaussian decay for --nms_mode=matrix or soft. Smaller values decay overlapping detections more.",
+    )
+    parser.add_argument(
+        "--nms_mask_iou",
+        default=False,
+        type=str2bool,
+        help="For --nms_mode=matrix or soft, decay using the IoU of the masks made from the lincomb coefficients instead of the box IoU.",
+    )
+    parser.add_argument(
+        "--mask_upsample",
+        default="full",
+        type=str,
+        choices=["full", "roi"],
+        help="How to scale lincomb masks up to the image size. full upsamples each mask over the whole image. roi only upsamples the part of the image each cropped mask can cover (the result is the same), so the cost scales with the object size instead of the image size. Use roi for large images.",
+    )
+    parser.add_argument(
+        "--mask_format",
+        default="dense",
+        type=str,
+        choices=["dense", "packed", "rle"],
+        help="The format postprocess returns masks in when evaluating. dense is a float tensor. packed is bit-packed and rle is run-length encoded on the device. Both make the copy to the cpu much smaller, and the mask IoU, coco eval and json output all work on them directly.",
+    )
     parser.add_argument(
         "--display_masks",
         default=True,
@@ -116,12 +217,43 @@ def parse_args(argv=None):
         action="store_true",
         help="If display not set, this resumes mAP calculations from the ap_data_file.",
     )
+    parser.add_argument(
+        "--checkpoint_every",
+        default=0,
+        type=int,
+        help="In quantitative mode, save the partial results to checkpoint_file after about every this many images so an interrupted run can be continued with --resume_checkpoint. Use 0 to never checkpoint.",
+    )
+    parser.add_argument(
+        "--checkpoint_file",
+        default="results/eval_checkpoint.pkl",
+        type=str,
+        help="The file to save evaluation checkpoints to. When evaluating a shard, the shard is appended to the name.",
+    )
+    parser.add_argument(
+        "--resume_checkpoint",
+        default=False,
+        dest="resume_checkpoint",
+        action="store_true",
+        help="Continue evaluating from checkpoint_file if it exists. Use the same arguments as the run that saved it.",
+    )
     parser.add_argument(
         "--max_images",
         default=-1,
         type=int,
         help="The maximum number of images from the dataset to consider. Use -1 for all.",
     )
+    parser.add_argument(
+        "--batch_size",
+        default=1,
+        type=int,
+        help="The number of dataset images to send through the network at once. Configs with preserve_aspect_ratio always use 1 since their images differ in size.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        default=0,
+        type=int,
+        help="The number of data loader processes used to load and transform images while the network runs. Use 0 to load them in the main process.",
+    )
     parser.add_argument(
         "--output_coco_json",
         dest="output_coco_json",
@@ -140,7 +272,25 @@ def parse_args(argv=None):
         type=str,
         help="The output file for coco mask results if --coco_results is set.",
     )
+    parser.add_argument(
+        "--rle_workers",
+        default=2,
+        type=int,
+        help="If output_coco_json is set, the number of processes that RLE encode masks while the network works on the next image. Use 0 to encode on the main thread.",
+    )
     parser.add_argument("--config", default=None, help="The config object to use.")
+    parser.add_argument(
+        "--coco_eval",
+        dest="coco_eval",
+        action="store_true",
+        help="In quantitative mode, also compute the full set of COCO metrics (what run_coco_eval.py reports) in-process, without going through the json files. This needs a dataset with ground truth.",
+    )
+    parser.add_argument(
+        "--coco_eval_file",
+        default="results/coco_eval.pkl",
+        type=str,
+        help="If coco_eval is set, the file to save the in-process COCO evaluation data to.",
+    )
     parser.add_argument(
         "--output_web_json",
         dest="output_web_json",
@@ -170,7 +320,37 @@ def parse_args(argv=None):
         default=False,
         dest="benchmark",
         action="store_true",
-        help="Equivalent to running display mode but without displaying an image.",
+        help="Equivalent to running display mode but without displaying an image. Reports the latency percentiles of each stage (see the benchmark_* options below).",
+    )
+    parser.add_argument(
+        "--benchmark_warmup",
+        default=2,
+        type=int,
+        help="In benchmark mode, the number of batches to run before timing starts.",
+    )
+    parser.add_argument(
+        "--benchmark_iters",
+        default=-1,
+        type=int,
+        help="In benchmark mode, the number of batches to time (looping over the images if needed). Use -1 for one pass over max_images.",
+    )
+    parser.add_argument(
+        "--benchmark_sizes",
+        default=None,
+        type=str2ints,
+        help="In benchmark mode, a comma separated list of input sizes (i.e., max_size) to benchmark. Defaults to the config's max_size.",
+    )
+    parser.add_argument(
+        "--benchmark_batch_sizes",
+        default=None,
+        type=str2ints,
+        help="In benchmark mode, a comma separated list of batch sizes to benchmark. Defaults to batch_size.",
+    )
+    parser.add_argument(
+        "--benchmark_output",
+        default=None,
+        type=str,
+        help="In benchmark mode, a .json or .csv file to write the results to. If it already exists the results are appended, so runs with different configs can share one file.",
     )
     parser.add_argument(
         "--no_sort",
@@ -253,6 +433,18 @@ def parse_args(argv=None):
         action="store_true",
         help="When saving a video, emulate the framerate that you'd get running in real-time mode.",
     )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        type=str2shard,
+        help="In quantitative mode, only evaluate shard i of N (given as i/N) and save the partial results next to ap_data_file (or the coco json files). Run every shard with the same arguments.",
+    )
+    parser.add_argument(
+        "--merge_shards",
+        default=0,
+        type=int,
+        help="Merges the partial results saved by --shard i/N for all i in [0, N) and computes mAP (or dumps the coco / web json if --output_coco_json is set).",
+    )
 
     parser.set_defaults(
         no_bar=False,
@@ -260,6 +452,7 @@ def parse_args(argv=None):
         resume=False,
         output_coco_json=False,
         output_web_json=False,
+        coco_eval=False,
         shuffle=False,
         benchmark=False,
         no_sort=False,
@@ -282,6 +475,13 @@ def parse_args(argv=None):
 
 
 iou_thresholds = [x / 100 for x in range(50, 100, 5)]
+
+
+def get_device():
+    """ Returns the device that everything should be evaluated on, as set by --cuda. """
+    return torch.device("cuda" if args.cuda else "cpu")
+
+
 coco_cats = {}  # Call prep_coco_cats to fill this
 coco_cats_inv = {}
 color_cache = defaultdict(lambda: {})
@@ -296,13 +496,15 @@ def prep_display(
     class_color=False,
     mask_alpha=0.45,
     fps_str="",
+    batch_idx=0,
 ):
     """
     Note: If undo_transform=False then im_h and im_w are allowed to be None.
+    batch_idx selects which image of a batched dets_out to display.
     """
     if undo_transform:
         img_numpy = undo_image_transformation(img, w, h)
-        img_gpu = torch.Tensor(img_numpy).cuda()
+        img_gpu = torch.Tensor(img_numpy).to(get_device())
     else:
         img_gpu = img / 255.0
         h, w, _ = img.shape
@@ -314,9 +516,13 @@ def prep_display(
             dets_out,
             w,
             h,
+            batch_idx=batch_idx,
             visualize_lincomb=args.display_lincomb,
             crop_masks=args.crop,
             score_threshold=args.score_threshold,
+            top_k=args.top_k,
+            lazy_masks=True,
+            mask_upsample=args.mask_upsample,
         )
         cfg.rescore_bbox = save
 
@@ -324,7 +530,7 @@ def prep_display(
         idx = t[1].argsort(0, descending=True)[: args.top_k]
 
         if cfg.eval_mask_branch:
-            # Masks are drawn on the GPU, so don't copy
+            # Masks are drawn on the GPU, so don't copy. They're only upsampled if they get drawn.
             masks = t[3][idx]
         classes, scores, boxes = [x[idx].cpu().numpy() for x in t[:3]]
 
@@ -357,12 +563,12 @@ def prep_display(
     # I wish I had access to OpenGL or Vulkan but alas, I guess Pytorch tensor operations will have to suffice
     if args.display_masks and cfg.eval_mask_branch and num_dets_to_consider > 0:
         # After this, mask is of size [num_dets, h, w, 1]
-        masks = masks[:num_dets_to_consider, :, :, None]
+        masks = masks[:num_dets_to_consider].materialize()[:, :, :, None]
 
         # Prepare the RGB images for each mask given their color (size [num_dets, h, w, 1])
         colors = torch.cat(
             [
-                get_color(j, on_gpu=img_gpu.device.index).view(1, 1, 1, 3)
+                get_color(j, on_gpu=img_gpu.device).view(1, 1, 1, 3)
                 for j in range(num_dets_to_consider)
             ],
             dim=0,
@@ -461,14 +667,22 @@ def prep_display(
     return img_numpy
 
 
-def prep_benchmark(dets_out, h, w):
+def prep_benchmark(dets_out, h, w, batch_idx=0):
     with timer.env("Postprocess"):
         t = postprocess(
-            dets_out, w, h, crop_masks=args.crop, score_threshold=args.score_threshold
+            dets_out,
+            w,
+            h,
+            batch_idx=batch_idx,
+            crop_masks=args.crop,
+            score_threshold=args.score_threshold,
+            top_k=args.top_k,
+            mask_upsample=args.mask_upsample,
+            mask_format=args.mask_format,
         )
 
     with timer.env("Copy"):
-        classes, scores, boxes, masks = [x[: args.top_k] for x in t]
+        classes, scores, boxes, masks = t
         if isinstance(scores, list):
             box_scores = scores[0].cpu().numpy()
             mask_scores = scores[1].cpu().numpy()
@@ -476,11 +690,15 @@ def prep_benchmark(dets_out, h, w):
             scores = scores.cpu().numpy()
         classes = classes.cpu().numpy()
         boxes = boxes.cpu().numpy()
-        masks = masks.cpu().numpy()
+        if isinstance(masks, torch.Tensor):
+            masks = masks.cpu().numpy()
+        else:
+            masks = masks.cpu()
 
     with timer.env("Sync"):
         # Just in case
-        torch.cuda.synchronize()
+        if args.cuda:
+            torch.cuda.synchronize()
 
 
 def prep_coco_cats():
@@ -501,10 +719,103 @@ def get_transformed_cat(coco_cat_id):
     return coco_cats_inv[coco_cat_id]
 
 
+def encode_masks(masks: np.ndarray, h: int = None, w: int = None):
+    """
+    RLE encodes a [h, w, n] Fortran ordered uint8 array of masks into a list of json-able RLEs.
+    If h and w are given, masks should instead be the [n, ceil(h*w / 8)] bits of PackedMasks.
+    """
+    if h is not None:
+        masks = np.unpackbits(masks, axis=1)[:, : h * w].reshape(-1, h, w)
+        masks = np.asfortranarray(masks.transpose(1, 2, 0))
+
+    rles = pycocotools.mask.encode(masks)
+
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode(
+            "ascii"
+        )  # json.dump doesn't like bytes strings
+
+    return rles
+
+
 class Detections:
-    def __init__(self):
-        self.bbox_data = []
-        self.mask_data = []
+    """
+    Streams detections out to the coco json files as they're added, so that memory use stays flat
+    no matter how many images there are. Call dump (or dump_web) at the end to finish the files.
+
+    Images added with add_image get their masks RLE encoded by a pool of args.rle_workers processes
+    in the background. They're still written out in the order they were added.
+    """
+
+    def __init__(self, bbox_det_file: str = None, mask_det_file: str = None):
+        """ If not given, the files to write to are the ones in args. """
+        self.bbox_writer = JSONArrayWriter(bbox_det_file or args.bbox_det_file)
+        self.mask_writer = JSONArrayWriter(mask_det_file or args.mask_det_file)
+
+        self.pool = None
+        self.pending = deque()
+
+    def add_image(
+        self,
+        image_id: int,
+        classes: list,
+        boxes: np.ndarray,
+        box_scores: list,
+        mask_scores: list,
+        masks: np.ndarray,
+    ):
+        """
+        Adds all the detections for one image. Boxes should be [n, 4] in (x1, y1, x2, y2) form and
+        masks should be a Fortran ordered [h, w, n] uint8 array (i.e., what pycocotools wants), or
+        cpu PackedMasks or RLEMasks.
+        """
+        if isinstance(masks, RLEMasks):
+            # These only need to be compressed, which is quick
+            rles = masks.to_coco()
+        else:
+            if isinstance(masks, PackedMasks):
+                encode_args = (masks.bits.numpy(), masks.h, masks.w)
+            else:
+                encode_args = (masks,)
+
+            if args.rle_workers > 0:
+                if self.pool is None:
+                    self.pool = multiprocessing.Pool(args.rle_workers)
+
+                rles = self.pool.apply_async(encode_masks, encode_args)
+            else:
+                rles = encode_masks(*encode_args)
+
+        self.pending.append((image_id, classes, boxes, box_scores, mask_scores, rles))
+
+        # Don't let too many images pile up waiting for the workers
+        self.flush(max_pending=2 * args.rle_workers)
+
+    def flush(self, max_pending: int = 0):
+        """
+        Writes out the images whose masks are done encoding, in order. Blocks until there are at
+        most max_pending images left waiting on the workers.
+        """
+        while len(self.pending) > 0:
+            image_id, classes, boxes, box_scores, mask_scores, rles = self.pending[0]
+
+            if not isinstance(rles, list):
+                if len(self.pending) <= max_pending and not rles.ready():
+                    break
+                rles = rles.get()
+
+            self.pending.popleft()
+
+            for i in range(len(rles)):
+                self.add_bbox(image_id, classes[i], boxes[i, :], box_scores[i])
+                self.mask_writer.write(
+                    {
+                        "image_id": int(image_id),
+                        "category_id": get_coco_cat(int(classes[i])),
+                        "segmentation": rles[i],
+                        "score": float(mask_scores[i]),
+                    }
+                )
 
     def add_bbox(self, image_id: int, category_id: int, bbox: list, score: float):
         """ Note that bbox should be a list or tuple of (x1, y1, x2, y2) """
@@ -513,7 +824,7 @@ class Detections:
         # Round to the nearest 10th to avoid huge file sizes, as COCO suggests
         bbox = [round(float(x) * 10) / 10 for x in bbox]
 
-        self.bbox_data.append(
+        self.bbox_writer.write(
             {
                 "image_id": int(image_id),
                 "category_id": get_coco_cat(int(category_id)),
@@ -522,36 +833,32 @@ class Detections:
             }
         )
 
-    def add_mask(
-        self, image_id: int, category_id: int, segmentation: np.ndarray, score: float
-    ):
-        """ The segmentation should be the full mask, the size of the image and with size [h, w]. """
-        rle = pycocotools.mask.encode(np.asfortranarray(segmentation.astype(np.uint8)))
-        rle["counts"] = rle["counts"].decode(
-            "ascii"
-        )  # json.dump doesn't like bytes strings
+    def state(self):
+        """ Writes out every pending image and returns where both files are at, for checkpointing. """
+        self.flush()
+        return {"bbox": self.bbox_writer.state(), "mask": self.mask_writer.state()}
 
-        self.mask_data.append(
-            {
-                "image_id": int(image_id),
-                "category_id": get_coco_cat(int(category_id)),
-                "segmentation": rle,
-                "score": float(score),
-            }
-        )
+    def restore(self, state: dict):
+        """ Continues writing the files from a state returned by state(). """
+        self.bbox_writer.restore(*state["bbox"])
+        self.mask_writer.restore(*state["mask"])
 
     def dump(self):
-        dump_arguments = [
-            (self.bbox_data, args.bbox_det_file),
-            (self.mask_data, args.mask_det_file),
-        ]
+        """ Finishes off both json files. """
+        self.flush()
 
-        for data, path in dump_arguments:
-            with open(path, "w") as f:
-                json.dump(data, f)
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        self.bbox_writer.close()
+        self.mask_writer.close()
 
     def dump_web(self):
         """ Dumps it in the format for my web app. Warning: bad code ahead! """
+        self.dump()
+
         config_outs = [
             "preserve_aspect_ratio",
             "use_prediction_module",
@@ -560,37 +867,69 @@ class Detections:
             "train_masks",
         ]
 
-        output = {"info": {"Config": {key: getattr(cfg, key) for key in config_outs},}}
+        info = {"Config": {key: getattr(cfg, key) for key in config_outs}}
 
-        image_ids = list(set([x["image_id"] for x in self.bbox_data]))
-        image_ids.sort()
-        image_lookup = {_id: idx for idx, _id in enumerate(image_ids)}
+        with open(self.bbox_writer.path, "rb") as bbox_file, open(
+            self.mask_writer.path, "rb"
+        ) as mask_file:
+            # First find where each image's detections are in the files. All the detections for an
+            # image get written at once, so store runs of (bbox_offset, mask_offset, num_dets).
+            image_runs = defaultdict(list)
+            last_image_id = None
 
-        output["images"] = [
-            {"image_id": image_id, "dets": []} for image_id in image_ids
-        ]
+            for (bbox_offset, bbox), (mask_offset, _) in zip(
+                read_json_array_lines(bbox_file), read_json_array_lines(mask_file)
+            ):
+                image_id = json.loads(bbox)["image_id"]
 
-        # These should already be sorted by score with the way prep_metrics works.
-        for bbox, mask in zip(self.bbox_data, self.mask_data):
-            image_obj = output["images"][image_lookup[bbox["image_id"]]]
-            image_obj["dets"].append(
-                {
-                    "score": bbox["score"],
-                    "bbox": bbox["bbox"],
-                    "category": cfg.dataset.class_names[
-                        get_transformed_cat(bbox["category_id"])
-                    ],
-                    "mask": mask["segmentation"],
-                }
-            )
+                if image_id == last_image_id:
+                    image_runs[image_id][-1][2] += 1
+                else:
+                    image_runs[image_id].append([bbox_offset, mask_offset, 1])
+                    last_image_id = image_id
+
+            # Then read each image's detections back in and write the output one image at a time
+            with open(
+                os.path.join(args.web_det_path, "%s.json" % cfg.name), "w"
+            ) as out_file:
+                out_file.write('{"info": %s, "images": [' % json.dumps(info))
+
+                for idx, image_id in enumerate(sorted(image_runs.keys())):
+                    image_obj = {"image_id": image_id, "dets": []}
 
-        with open(os.path.join(args.web_det_path, "%s.json" % cfg.name), "w") as f:
-            json.dump(output, f)
+                    # These should already be sorted by score with the way prep_metrics works.
+                    for bbox_offset, mask_offset, num_dets in image_runs[image_id]:
+                        bbox_file.seek(bbox_offset)
+                        mask_file.seek(mask_offset)
+
+                        for _ in range(num_dets):
+                            bbox = json.loads(bbox_file.readline().strip().rstrip(b","))
+                            mask = json.loads(mask_file.readline().strip().rstrip(b","))
+
+                            image_obj["dets"].append(
+                                {
+                                    "score": bbox["score"],
+                                    "bbox": bbox["bbox"],
+                                    "category": cfg.dataset.class_names[
+                                        get_transformed_cat(bbox["category_id"])
+                                    ],
+                                    "mask": mask["segmentation"],
+                                }
+                            )
+
+                    out_file.write((", " if idx > 0 else "") + json.dumps(image_obj))
+
+                out_file.write("]}")
 
 
 def _mask_iou(mask1, mask2, iscrowd=False):
     with timer.env("Mask IoU"):
-        ret = mask_iou(mask1, mask2, iscrowd)
+        if isinstance(mask1, RLEMasks):
+            ret = mask1.iou(mask2, iscrowd)
+        else:
+            if isinstance(mask1, PackedMasks):
+                mask1 = mask1.to_dense().view(len(mask1), -1)
+            ret = mask_iou(mask1, mask2, iscrowd)
     return ret.cpu()
 
 
@@ -600,6 +939,87 @@ def _bbox_iou(bbox1, bbox2, iscrowd=False):
     return ret.cpu()
 
 
+def match_dets(
+    iou, crowd_iou, pred_classes, gt_classes, crowd_classes, indices, thresholds
+):
+    """
+    Greedily matches detections to ground truth for every IoU threshold at once.
+
+    This gives exactly the same result as walking through the detections in the given order and
+    matching each to the unused gt of the same class with the highest IoU over the threshold. Since
+    detections of different classes can't compete for the same gt, the k-th detection of every
+    class is matched in the same step, so this only loops max(detections per class) times.
+
+    Args:
+        - iou:           [num_pred, num_gt] array of IoUs between each detection and each gt.
+        - crowd_iou:     [num_pred, num_crowd] array of crowd IoUs, or None if there are no crowds.
+        - pred_classes:  [num_pred] The class of each detection.
+        - gt_classes:    [num_gt] The class of each gt.
+        - crowd_classes: [num_crowd] The class of each crowd, or None if there are no crowds.
+        - indices:       The order to match detections in (i.e., sorted by descending score).
+        - thresholds:    A list of IoU thresholds to match with.
+
+    Returns two boolean arrays of size [num_thresholds, num_pred], indexed by detection:
+        - is_true:    Whether the detection matched a gt (otherwise it's a false positive).
+        - is_ignored: Whether the detection didn't match a gt but did match a crowd.
+    """
+    iou = np.asarray(iou, dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    pred_classes = np.asarray(pred_classes, dtype=np.int64)
+    gt_classes = np.asarray(gt_classes, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+
+    num_pred, num_gt = iou.shape
+    is_true = np.zeros((thresholds.shape[0], num_pred), dtype=bool)
+
+    if num_gt > 0 and num_pred > 0:
+        # A detection can only ever match a gt of the same class. Also, nan never passes a threshold.
+        same_class = pred_classes[:, None] == gt_classes[None, :]
+        iou = np.where(same_class & ~np.isnan(iou), iou, -1)
+
+        # For each detection in indices, the number of detections of its class that come before it
+        ordered_classes = pred_classes[indices]
+        class_sort = np.argsort(ordered_classes, kind="stable")
+        sorted_classes = ordered_classes[class_sort]
+        group_start = np.searchsorted(sorted_classes, sorted_classes, side="left")
+        rank = np.empty_like(class_sort)
+        rank[class_sort] = np.arange(class_sort.shape[0]) - group_start
+
+        # Index gt_used[threshold, gt]
+        gt_used = np.zeros((thresholds.shape[0], num_gt), dtype=bool)
+
+        for step in range(rank.max() + 1):
+            # At most one detection per class, so these don't compete with each other
+            rows = indices[rank == step]
+
+            cur_iou = np.where(gt_used[:, None, :], -1, iou[None, rows, :])
+
+            # Note that argmax picks the first gt out of any that tie, just like the > in a loop would
+            best_gt = cur_iou.argmax(axis=2)
+            best_iou = np.take_along_axis(cur_iou, best_gt[:, :, None], axis=2)[:, :, 0]
+            matched = best_iou > thresholds[:, None]
+
+            is_true[:, rows] = matched
+            thresh_idx, row_idx = np.nonzero(matched)
+            gt_used[thresh_idx, best_gt[thresh_idx, row_idx]] = True
+
+    is_ignored = np.zeros_like(is_true)
+
+    if crowd_iou is not None and num_pred > 0:
+        crowd_iou = np.asarray(crowd_iou, dtype=np.float64)
+        crowd_classes = np.asarray(crowd_classes, dtype=np.int64)
+
+        if crowd_iou.shape[1] > 0:
+            # If the detection doesn't match a gt but matches a crowd, we can just ignore it
+            same_class = pred_classes[:, None] == crowd_classes[None, :]
+            matched_crowd = (
+                (crowd_iou[None, :, :] > thresholds[:, None, None]) & same_class[None]
+            ).any(axis=2)
+            is_ignored = ~is_true & matched_crowd
+
+    return is_true, is_ignored
+
+
 def prep_metrics(
     ap_data,
     dets,
@@ -611,6 +1031,8 @@ def prep_metrics(
     num_crowd,
     image_id,
     detections: Detections = None,
+    batch_idx=0,
+    coco_evaluator: COCOEvaluator = None,
 ):
     """ Returns a list of APs for this image, with each element being for a class  """
     if not args.output_coco_json:
@@ -619,7 +1041,11 @@ def prep_metrics(
             gt_boxes[:, [0, 2]] *= w
             gt_boxes[:, [1, 3]] *= h
             gt_classes = list(gt[:, 4].astype(int))
-            gt_masks = torch.Tensor(gt_masks).view(-1, h * w)
+
+            if args.mask_format == "rle":
+                gt_masks = RLEMasks.from_masks(torch.Tensor(gt_masks).view(-1, h, w))
+            else:
+                gt_masks = torch.Tensor(gt_masks).view(-1, h * w)
 
             if num_crowd > 0:
                 split = lambda x: (x[-num_crowd:], x[:-num_crowd])
@@ -629,10 +1055,19 @@ def prep_metrics(
 
     with timer.env("Postprocess"):
         classes, scores, boxes, masks = postprocess(
-            dets, w, h, crop_masks=args.crop, score_threshold=args.score_threshold
+            dets,
+            w,
+            h,
+            batch_idx=batch_idx,
+            crop_masks=args.crop,
+            score_threshold=args.score_threshold,
+            mask_upsample=args.mask_upsample,
+            mask_format=args.mask_format,
         )
 
         if classes.size(0) == 0:
+            if coco_evaluator is not None:
+                coco_evaluator.add_image(image_id, [], np.zeros((0, 4)), [], [], None)
             return
 
         classes = list(classes.cpu().numpy().astype(int))
@@ -643,22 +1078,56 @@ def prep_metrics(
             scores = list(scores.cpu().numpy().astype(float))
             box_scores = scores
             mask_scores = scores
-        masks = masks.view(-1, h * w).cuda()
-        boxes = boxes.cuda()
+        if isinstance(masks, ROIMasks):
+            masks = masks.to_dense()
+        if isinstance(masks, torch.Tensor):
+            masks = masks.view(-1, h * w).to(get_device())
+        boxes = boxes.to(get_device())
+
+    if coco_evaluator is not None:
+        with timer.env("COCO Eval"):
+            # Use the same detections that would be written to the coco json files
+            keep = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0]) > 0
+            keep_idx = keep.nonzero().view(-1)
+            keep_list = keep_idx.cpu().numpy()
+
+            coco_evaluator.add_image(
+                image_id,
+                [get_coco_cat(classes[i]) for i in keep_list],
+                boxes[keep_idx].cpu().numpy(),
+                [box_scores[i] for i in keep_list],
+                [mask_scores[i] for i in keep_list],
+                masks[keep_idx],
+            )
 
     if args.output_coco_json:
         with timer.env("JSON Output"):
-            boxes = boxes.cpu().numpy()
-            masks = masks.view(-1, h, w).cpu().numpy()
-            for i in range(masks.shape[0]):
-                # Make sure that the bounding box actually makes sense and a mask was produced
-                if (boxes[i, 3] - boxes[i, 1]) * (boxes[i, 2] - boxes[i, 0]) > 0:
-                    detections.add_bbox(
-                        image_id, classes[i], boxes[i, :], box_scores[i]
-                    )
-                    detections.add_mask(
-                        image_id, classes[i], masks[i, :, :], mask_scores[i]
-                    )
+            # Make sure that the bounding box actually makes sense and a mask was produced
+            keep = (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0]) > 0
+            keep_idx = keep.nonzero().view(-1)
+
+            if keep_idx.size(0) == 0:
+                return
+
+            if isinstance(masks, torch.Tensor):
+                # pycocotools wants [h, w, n] uint8 masks in Fortran order, which has the same memory layout
+                # as [n, w, h] in C order. So do the conversion and transpose on the GPU and only copy bytes.
+                masks = (
+                    masks.view(-1, h, w)[keep_idx].byte().transpose(1, 2).contiguous()
+                )
+                masks = masks.cpu().numpy().transpose(2, 1, 0)
+            else:
+                masks = masks[keep_idx].cpu()
+
+            keep_idx = keep_idx.cpu().numpy()
+            detections.add_image(
+                image_id,
+                [classes[i] for i in keep_idx],
+                boxes[keep_idx].cpu().numpy(),
+                [box_scores[i] for i in keep_idx],
+                [mask_scores[i] for i in keep_idx],
+                masks,
+            )
             return
 
     with timer.env("Eval Setup"):
@@ -681,75 +1150,38 @@ def prep_metrics(
         mask_indices = sorted(box_indices, key=lambda i: -mask_scores[i])
 
         iou_types = [
-            (
-                "box",
-                lambda i, j: bbox_iou_cache[i, j].item(),
-                lambda i, j: crowd_bbox_iou_cache[i, j].item(),
-                lambda i: box_scores[i],
-                box_indices,
-            ),
-            (
-                "mask",
-                lambda i, j: mask_iou_cache[i, j].item(),
-                lambda i, j: crowd_mask_iou_cache[i, j].item(),
-                lambda i: mask_scores[i],
-                mask_indices,
-            ),
+            ("box", bbox_iou_cache, crowd_bbox_iou_cache, box_scores, box_indices),
+            ("mask", mask_iou_cache, crowd_mask_iou_cache, mask_scores, mask_indices),
         ]
 
     timer.start("Main loop")
-    for _class in set(classes + gt_classes):
-        ap_per_iou = []
-        num_gt_for_class = sum([1 for x in gt_classes if x == _class])
-
-        for iouIdx in range(len(iou_thresholds)):
-            iou_threshold = iou_thresholds[iouIdx]
+    for iou_type, iou_cache, crowd_iou_cache, type_scores, indices in iou_types:
+        # All this crowd code so that we can make sure that our eval code gives the
+        # same result as COCOEval. There aren't even that many crowd annotations to
+        # begin with, but accuracy is of the utmost importance.
+        is_true, is_ignored = match_dets(
+            iou_cache.numpy(),
+            None if crowd_iou_cache is None else crowd_iou_cache.numpy(),
+            classes,
+            gt_classes,
+            crowd_classes if num_crowd > 0 else None,
+            indices,
+            iou_thresholds,
+        )
+        indices = np.array(indices, dtype=np.int64)
+        type_scores = np.array(type_scores, dtype=np.float64)
+        ordered_classes = np.array(classes, dtype=np.int64)[indices]
 
-            for iou_type, iou_func, crowd_func, score_func, indices in iou_types:
-                gt_used = [False] * len(gt_classes)
+        for _class in set(classes + gt_classes):
+            num_gt_for_class = sum([1 for x in gt_classes if x == _class])
+            class_indices = indices[ordered_classes == _class]
 
+            for iouIdx in range(len(iou_thresholds)):
                 ap_obj = ap_data[iou_type][iouIdx][_class]
                 ap_obj.add_gt_positives(num_gt_for_class)
 
-                for i in indices:
-                    if classes[i] != _class:
-                        continue
-
-                    max_iou_found = iou_threshold
-                    max_match_idx = -1
-                    for j in range(num_gt):
-                        if gt_used[j] or gt_classes[j] != _class:
-                            continue
-
-                        iou = iou_func(i, j)
-
-                        if iou > max_iou_found:
-                            max_iou_found = iou
-                            max_match_idx = j
-
-                    if max_match_idx >= 0:
-                        gt_used[max_match_idx] = True
-                        ap_obj.push(score_func(i), True)
-                    else:
-                        # If the detection matches a crowd, we can just ignore it
-                        matched_crowd = False
-
-                        if num_crowd > 0:
-                            for j in range(len(crowd_classes)):
-                                if crowd_classes[j] != _class:
-                                    continue
-
-                                iou = crowd_func(i, j)
-
-                                if iou > iou_threshold:
-                                    matched_crowd = True
-                                    break
-
-                        # All this crowd code so that we can make sure that our eval code gives the
-                        # same result as COCOEval. There aren't even that many crowd annotations to
-                        # begin with, but accuracy is of the utmost importance.
-                        if not matched_crowd:
-                            ap_obj.push(score_func(i), False)
+                counted = class_indices[~is_ignored[iouIdx, class_indices]]
+                ap_obj.push_many(type_scores[counted], is_true[iouIdx, counted])
     timer.stop("Main loop")
 
 
@@ -757,21 +1189,100 @@ class APDataObject:
     """
     Stores all the information necessary to calculate the AP for one IoU and one class.
     Note: I type annotated this because why not.
+
+    Scores and true / false positive flags are kept in growable numpy buffers instead of a list
+    of tuples, since across every class, IoU threshold and type there are millions of them.
     """
 
     def __init__(self):
-        self.data_points = []
+        self.scores = np.empty(0, dtype=np.float64)
+        self.is_true = np.empty(0, dtype=np.bool_)
+        self.num_points = 0
         self.num_gt_positives = 0
 
+    def _reserve(self, num_new: int):
+        """ Makes sure there's room for num_new more data points, growing the buffers geometrically. """
+        needed = self.num_points + num_new
+
+        if needed > self.scores.shape[0]:
+            capacity = max(needed, 2 * self.scores.shape[0], 64)
+
+            scores = np.empty(capacity, dtype=np.float64)
+            is_true = np.empty(capacity, dtype=np.bool_)
+            scores[: self.num_points] = self.scores[: self.num_points]
+            is_true[: self.num_points] = self.is_true[: self.num_points]
+
+            self.scores = scores
+            self.is_true = is_true
+
     def push(self, score: float, is_true: bool):
-        self.data_points.append((score, is_true))
+        self._reserve(1)
+        self.scores[self.num_points] = score
+        self.is_true[self.num_points] = is_true
+        self.num_points += 1
+
+    def push_many(self, scores: np.ndarray, is_true: np.ndarray):
+        """ Same as calling push for each (score, is_true) pair, in order. """
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)
+        is_true = np.asarray(is_true, dtype=np.bool_).reshape(-1)
+        num_new = scores.shape[0]
+
+        self._reserve(num_new)
+        self.scores[self.num_points : self.num_points + num_new] = scores
+        self.is_true[self.num_points : self.num_points + num_new] = is_true
+        self.num_points += num_new
 
     def add_gt_positives(self, num_positives: int):
         """ Call this once per image. """
         self.num_gt_positives += num_positives
 
+    def merge(self, other: "APDataObject"):
+        """ Adds all of the data points and gt positives from other into this object. """
+        self.push_many(
+            other.scores[: other.num_points], other.is_true[: other.num_points]
+        )
+        self.num_gt_positives += other.num_gt_positives
+
     def is_empty(self) -> bool:
-        return len(self.data_points) == 0 and self.num_gt_positives == 0
+        return self.num_points == 0 and self.num_gt_positives == 0
+
+    def __getstate__(self):
+        """
+        Only pickle the used part of the buffers, with the flags packed into bits. The scores come
+        from float tensors, so store them as float32 when that doesn't lose anything.
+        """
+        scores = self.scores[: self.num_points]
+        scores_32 = scores.astype(np.float32)
+
+        if np.array_equal(scores_32, scores):
+            scores = scores_32
+
+        return {
+            "scores": scores,
+            "is_true": np.packbits(self.is_true[: self.num_points]),
+            "num_points": self.num_points,
+            "num_gt_positives": self.num_gt_positives,
+        }
+
+    def __setstate__(self, state):
+        # For backward compatibility with ap_data files saved with a list of (score, is_true) tuples
+        if "data_points" in state:
+            data_points = state["data_points"]
+            state = {
+                "scores": np.array([x[0] for x in data_points], dtype=np.float64),
+                "is_true": np.packbits(
+                    np.array([x[1] for x in data_points], dtype=np.bool_)
+                ),
+                "num_points": len(data_points),
+                "num_gt_positives": state["num_gt_positives"],
+            }
+
+        self.num_points = state["num_points"]
+        self.num_gt_positives = state["num_gt_positives"]
+        self.scores = state["scores"].astype(np.float64)
+        self.is_true = np.unpackbits(state["is_true"])[: self.num_points].astype(
+            np.bool_
+        )
 
     def get_ap(self) -> float:
         """ Warning: result not cached. """
@@ -779,51 +1290,34 @@ class APDataObject:
         if self.num_gt_positives == 0:
             return 0
 
-        # Sort descending by score
-        self.data_points.sort(key=lambda x: -x[0])
-
-        precisions = []
-        recalls = []
-        num_true = 0
-        num_false = 0
+        # Sort descending by score. The sort is stable so that ties stay in the order they were pushed.
+        order = np.argsort(-self.scores[: self.num_points], kind="stable")
+        is_true = self.is_true[: self.num_points][order]
 
         # Compute the precision-recall curve. The x axis is recalls and the y axis precisions.
-        for datum in self.data_points:
-            # datum[1] is whether the detection a true or false positive
-            if datum[1]:
-                num_true += 1
-            else:
-                num_false += 1
-
-            precision = num_true / (num_true + num_false)
-            recall = num_true / self.num_gt_positives
-
-            precisions.append(precision)
-            recalls.append(recall)
+        num_true = np.cumsum(is_true)
+        precisions = num_true / np.arange(1, self.num_points + 1)
+        recalls = num_true / self.num_gt_positives
 
         # Smooth the curve by computing [max(precisions[i:]) for i in range(len(precisions))]
         # Basically, remove any temporary dips from the curve.
         # At least that's what I think, idk. COCOEval did it so I do too.
-        for i in range(len(precisions) - 1, 0, -1):
-            if precisions[i] > precisions[i - 1]:
-                precisions[i - 1] = precisions[i]
+        precisions = np.maximum.accumulate(precisions[::-1])[::-1]
 
         # Compute the integral of precision(recall) d_recall from recall=0->1 using fixed-length riemann summation with 101 bars.
-        y_range = [0] * 101  # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
+        y_range = np.zeros(101)  # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
         x_range = np.array([x / 100 for x in range(101)])
-        recalls = np.array(recalls)
 
         # I realize this is weird, but all it does is find the nearest precision(x) for a given x in x_range.
         # Basically, if the closest recall we have to 0.01 is 0.009 this sets precision(0.01) = precision(0.009).
         # I approximate the integral this way, because that's how COCOEval does it.
         indices = np.searchsorted(recalls, x_range, side="left")
-        for bar_idx, precision_idx in enumerate(indices):
-            if precision_idx < len(precisions):
-                y_range[bar_idx] = precisions[precision_idx]
+        valid = indices < self.num_points
+        y_range[valid] = precisions[indices[valid]]
 
         # Finally compute the riemann sum to get our integral.
-        # avg([precision(x) for x in 0:0.01:1])
-        return sum(y_range) / len(y_range)
+        # avg([precision(x) for x in 0:0.01:1]), summed left to right like the old loop (np.sum adds pairwise)
+        return sum(y_range.tolist()) / y_range.shape[0]
 
 
 def badhash(x):
@@ -839,8 +1333,139 @@ def badhash(x):
     return x
 
 
+def make_ap_data():
+    """
+    For each class and iou, stores the scores and whether each was a true positive.
+    Index ap_data[type][iouIdx][classIdx]
+    """
+    return {
+        "box": [
+            [APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds
+        ],
+        "mask": [
+            [APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds
+        ],
+    }
+
+
+def shard_path(path: str, shard: tuple):
+    """ Returns where shard (i, N) saves its part of the results that would otherwise go in path. """
+    root, ext = os.path.splitext(path)
+    return "%s_shard%dof%d%s" % (root, shard[0], shard[1], ext)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    """ Saves atomically so that getting killed in the middle never leaves a broken checkpoint. """
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "wb") as f:
+        pickle.dump(checkpoint, f)
+
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str, dataset_indices: list):
+    """
+    Returns the checkpoint saved at path, or None if there isn't one. The checkpoint has to be for
+    the same images in the same order, otherwise resuming from it would give a different mAP.
+    """
+    if not os.path.exists(path):
+        print("No checkpoint found at %s, starting from the beginning." % path)
+        return None
+
+    with open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+
+    if checkpoint["dataset_indices"] != dataset_indices:
+        print(
+            "Error: The checkpoint at %s was saved for a different set of images."
+            % path
+        )
+        exit()
+
+    if checkpoint["output_coco_json"] != args.output_coco_json:
+        print(
+            "Error: The checkpoint at %s was saved with output_coco_json=%s."
+            % (path, checkpoint["output_coco_json"])
+        )
+        exit()
+
+    return checkpoint
+
+
+def print_coco_eval(coco_evaluator: COCOEvaluator):
+    """ Prints the COCO metrics for both boxes and masks, like run_coco_eval.py does. """
+    for iou_type, name in (("bbox", "BBoxes"), ("segm", "Masks")):
+        print("\nEvaluating %s:" % name)
+        coco_evaluator.summarize(iou_type)
+
+
+def merge_shards(num_shards: int):
+    """
+    Merges the partial results saved by running with --shard i/num_shards for every i, then either
+    computes the mAP or dumps the detections, just like the end of evaluate would.
+    """
+    shards = [(shard_idx, num_shards) for shard_idx in range(num_shards)]
+
+    if args.coco_eval:
+        coco_evaluator = None
+
+        for shard in shards:
+            with open(shard_path(args.coco_eval_file, shard), "rb") as f:
+                shard_coco_evaluator = pickle.load(f)
+
+            if coco_evaluator is None:
+                coco_evaluator = shard_coco_evaluator
+            else:
+                coco_evaluator.merge(shard_coco_evaluator)
+
+        with open(args.coco_eval_file, "wb") as f:
+            pickle.dump(coco_evaluator, f)
+
+        print_coco_eval(coco_evaluator)
+
+    if args.output_coco_json:
+        detections = Detections()
+
+        # Stream each shard's detections into the full files one line at a time
+        for writer, path in (
+            (detections.bbox_writer, args.bbox_det_file),
+            (detections.mask_writer, args.mask_det_file),
+        ):
+            for shard in shards:
+                with open(shard_path(path, shard), "rb") as f:
+                    for _, line in read_json_array_lines(f):
+                        writer.write_raw(line)
+
+        print("Dumping detections...")
+        if args.output_web_json:
+            detections.dump_web()
+        else:
+            detections.dump()
+    else:
+        ap_data = make_ap_data()
+
+        # Merge in shard order so the data points end up in the same order as without sharding
+        for shard in shards:
+            with open(shard_path(args.ap_data_file, shard), "rb") as f:
+                shard_ap_data = pickle.load(f)
+
+            for iou_type in ("box", "mask"):
+                for iou_idx in range(len(iou_thresholds)):
+                    for ap_obj, shard_ap_obj in zip(
+                        ap_data[iou_type][iou_idx], shard_ap_data[iou_type][iou_idx]
+                    ):
+                        ap_obj.merge(shard_ap_obj)
+
+        print("Saving data...")
+        with open(args.ap_data_file, "wb") as f:
+            pickle.dump(ap_data, f)
+
+        return calc_map(ap_data)
+
+
 def evalimage(net: Yolact, path: str, save_path: str = None):
-    frame = torch.from_numpy(cv2.imread(path)).cuda().float()
+    frame = torch.from_numpy(cv2.imread(path)).to(get_device()).float()
     batch = FastBaseTransform()(frame.unsqueeze(0))
     preds = net(batch)
 
@@ -910,8 +1535,11 @@ def evalvideo(net: Yolact, path: str, out_path: str = None):
     else:
         num_frames = round(vid.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    net = CustomDataParallel(net).cuda()
-    transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
+    if args.cuda:
+        net = CustomDataParallel(net).cuda()
+        transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
+    else:
+        transform = FastBaseTransform()
     frame_times = MovingAverage(100)
     fps = 0
     frame_time_target = 1 / target_fps
@@ -948,7 +1576,9 @@ def evalvideo(net: Yolact, path: str, out_path: str = None):
 
     def transform_frame(frames):
         with torch.no_grad():
-            frames = [torch.from_numpy(frame).cuda().float() for frame in frames]
+            frames = [
+                torch.from_numpy(frame).to(get_device()).float() for frame in frames
+            ]
             return frames, transform(torch.stack(frames, 0))
 
     def eval_network(inp):
@@ -1166,9 +1796,43 @@ def evalvideo(net: Yolact, path: str, out_path: str = None):
     cleanup_and_exit()
 
 
+class EvalDataset(torch.utils.data.Dataset):
+    """
+    Wraps a dataset so that a DataLoader pulls the images at dataset_indices, in order.
+    Each item is (image_idx, img, gt, gt_masks, h, w, num_crowd).
+    """
+
+    def __init__(self, dataset, dataset_indices: list):
+        self.dataset = dataset
+        self.dataset_indices = dataset_indices
+
+    def __len__(self):
+        return len(self.dataset_indices)
+
+    def __getitem__(self, idx):
+        image_idx = self.dataset_indices[idx]
+        return (image_idx,) + self.dataset.pull_item(image_idx)
+
+
+def eval_collate(batch):
+    """ Keep the samples as a list, since the gt and masks of each image differ in size. """
+    return batch
+
+
 def evaluate(net: Yolact, dataset, train_mode=False):
-    net.detect.use_fast_nms = args.fast_nms
+    if args.nms_mask_iou and cfg.mask_type != mask_type.lincomb:
+        print("Error: --nms_mask_iou needs a config with mask_type.lincomb.")
+        exit()
+
+    if args.nms_mode is None:
+        net.detect.use_fast_nms = args.fast_nms
+    else:
+        net.detect.use_fast_nms = args.nms_mode == "fast"
     net.detect.use_cross_class_nms = args.cross_class_nms
+    net.detect.nms_mode = args.nms_mode
+    net.detect.nms_kernel = args.nms_kernel
+    net.detect.nms_sigma = args.nms_sigma
+    net.detect.use_mask_iou_nms = args.nms_mask_iou
     cfg.mask_proto_debug = args.mask_proto_debug
 
     # TODO Currently we do not support Fast Mask Re-scroing in evalimage, evalimages, and evalvideo
@@ -1195,24 +1859,27 @@ def evaluate(net: Yolact, dataset, train_mode=False):
     dataset_size = (
         len(dataset) if args.max_images < 0 else min(args.max_images, len(dataset))
     )
-    progress_bar = ProgressBar(30, dataset_size)
 
     print()
 
     if not args.display and not args.benchmark:
-        # For each class and iou, stores tuples (score, isPositive)
-        # Index ap_data[type][iouIdx][classIdx]
-        ap_data = {
-            "box": [
-                [APDataObject() for _ in cfg.dataset.class_names]
-                for _ in iou_thresholds
-            ],
-            "mask": [
-                [APDataObject() for _ in cfg.dataset.class_names]
-                for _ in iou_thresholds
-            ],
-        }
-        detections = Detections()
+        ap_data = make_ap_data()
+
+        if args.shard is not None:
+            detections = Detections(
+                shard_path(args.bbox_det_file, args.shard),
+                shard_path(args.mask_det_file, args.shard),
+            )
+        else:
+            detections = Detections()
+
+        if args.coco_eval:
+            if not cfg.dataset.has_gt:
+                print("Error: --coco_eval needs a dataset with ground truth.")
+                exit()
+            coco_evaluator = COCOEvaluator(dataset.coco)
+        else:
+            coco_evaluator = None
     else:
         timer.disable("Load Data")
 
@@ -1234,66 +1901,144 @@ def evaluate(net: Yolact, dataset, train_mode=False):
 
     dataset_indices = dataset_indices[:dataset_size]
 
+    if args.shard is not None:
+        # Use contiguous chunks so that merging the shards in order pushes everything into ap_data
+        # in the same order as a single process would, which gives exactly the same mAP.
+        shard_idx, num_shards = args.shard
+        shard_start = dataset_size * shard_idx // num_shards
+        shard_end = dataset_size * (shard_idx + 1) // num_shards
+        dataset_indices = dataset_indices[shard_start:shard_end]
+        dataset_size = len(dataset_indices)
+
+    if args.benchmark:
+        return benchmark(net, dataset, dataset_indices)
+
+    use_checkpoints = not args.display
+    checkpoint_path = args.checkpoint_file
+    if args.shard is not None:
+        checkpoint_path = shard_path(args.checkpoint_file, args.shard)
+
+    num_done = 0
+    if use_checkpoints and args.resume_checkpoint:
+        checkpoint = load_checkpoint(checkpoint_path, dataset_indices)
+
+        if checkpoint is not None:
+            num_done = checkpoint["position"]
+            ap_data = checkpoint["ap_data"]
+            detections.restore(checkpoint["detections"])
+
+            if coco_evaluator is not None:
+                coco_evaluator = checkpoint["coco_evaluator"]
+                coco_evaluator.coco = dataset.coco
+            print("Resuming from image %d / %d." % (num_done, dataset_size))
+
+    progress_bar = ProgressBar(30, max(dataset_size, 1))
+
+    # Images from configs that preserve aspect ratio differ in size, so they can't be stacked
+    batch_size = 1 if cfg.preserve_aspect_ratio else max(args.batch_size, 1)
+    data_loader = torch.utils.data.DataLoader(
+        EvalDataset(dataset, dataset_indices[num_done:]),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        collate_fn=eval_collate,
+        pin_memory=args.cuda and args.num_workers > 0,
+    )
+    data_iter = iter(data_loader)
+
     try:
         # Main eval loop
-        for it, image_idx in enumerate(dataset_indices):
+        for it in range(len(data_loader)):
             timer.reset()
 
             with timer.env("Load Data"):
-                img, gt, gt_masks, h, w, num_crowd = dataset.pull_item(image_idx)
+                samples = next(data_iter)
 
                 # Test flag, do not upvote
                 if cfg.mask_proto_debug:
                     with open("scripts/info.txt", "w") as f:
-                        f.write(str(dataset.ids[image_idx]))
-                    np.save("scripts/gt.npy", gt_masks)
+                        f.write(str(dataset.ids[samples[0][0]]))
+                    np.save("scripts/gt.npy", samples[0][2])
 
-                batch = Variable(img.unsqueeze(0))
+                batch = Variable(torch.stack([sample[1] for sample in samples], 0))
                 if args.cuda:
-                    batch = batch.cuda()
+                    batch = batch.cuda(non_blocking=True)
 
             with timer.env("Network Extra"):
                 preds = net(batch)
+
             # Perform the meat of the operation here depending on our mode.
-            if args.display:
-                img_numpy = prep_display(preds, img, h, w)
-            elif args.benchmark:
-                prep_benchmark(preds, h, w)
-            else:
-                prep_metrics(
-                    ap_data,
-                    preds,
-                    img,
-                    gt,
-                    gt_masks,
-                    h,
-                    w,
-                    num_crowd,
-                    dataset.ids[image_idx],
-                    detections,
-                )
+            display_imgs = []
+            for batch_idx, sample in enumerate(samples):
+                image_idx, img, gt, gt_masks, h, w, num_crowd = sample
 
-            # First couple of images take longer because we're constructing the graph.
+                if args.display:
+                    display_imgs.append(
+                        (prep_display(preds, img, h, w, batch_idx=batch_idx), image_idx)
+                    )
+                else:
+                    prep_metrics(
+                        ap_data,
+                        preds,
+                        img,
+                        gt,
+                        gt_masks,
+                        h,
+                        w,
+                        num_crowd,
+                        dataset.ids[image_idx],
+                        detections,
+                        batch_idx=batch_idx,
+                        coco_evaluator=coco_evaluator,
+                    )
+
+            num_done += len(samples)
+
+            # First couple of batches take longer because we're constructing the graph.
             # Since that's technically initialization, don't include those in the FPS calculations.
+            # The time for a batch is split evenly over its images so the fps stays per image.
             if it > 1:
-                frame_times.add(timer.total_time())
+                frame_time = timer.total_time() / len(samples)
+                for _ in samples:
+                    frame_times.add(frame_time)
+
+            # Not timed, so that checkpointing doesn't affect the fps
+            if (
+                use_checkpoints
+                and args.checkpoint_every > 0
+                and num_done < dataset_size
+                and num_done // args.checkpoint_every
+                != (num_done - len(samples)) // args.checkpoint_every
+            ):
+                save_checkpoint(
+                    checkpoint_path,
+                    {
+                        "dataset_indices": dataset_indices,
+                        "output_coco_json": args.output_coco_json,
+                        "position": num_done,
+                        "ap_data": ap_data,
+                        "detections": detections.state(),
+                        "coco_evaluator": coco_evaluator,
+                    },
+                )
 
             if args.display:
-                if it > 1:
-                    print("Avg FPS: %.4f" % (1 / frame_times.get_avg()))
-                plt.imshow(img_numpy)
-                plt.title(str(dataset.ids[image_idx]))
-                plt.show()
+                for img_numpy, image_idx in display_imgs:
+                    if it > 1:
+                        print("Avg FPS: %.4f" % (1 / frame_times.get_avg()))
+                    plt.imshow(img_numpy)
+                    plt.title(str(dataset.ids[image_idx]))
+                    plt.show()
             elif not args.no_bar:
                 if it > 1:
                     fps = 1 / frame_times.get_avg()
                 else:
                     fps = 0
-                progress = (it + 1) / dataset_size * 100
-                progress_bar.set_val(it + 1)
+                progress = num_done / dataset_size * 100
+                progress_bar.set_val(num_done)
                 print(
                     "\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f fps        "
-                    % (repr(progress_bar), it + 1, dataset_size, progress, fps),
+                    % (repr(progress_bar), num_done, dataset_size, progress, fps),
                     end="",
                 )
 
@@ -1301,32 +2046,263 @@ def evaluate(net: Yolact, dataset, train_mode=False):
             print()
             if args.output_coco_json:
                 print("Dumping detections...")
-                if args.output_web_json:
+                if args.output_web_json and args.shard is None:
                     detections.dump_web()
                 else:
                     detections.dump()
-            else:
-                if not train_mode:
-                    print("Saving data...")
-                    with open(args.ap_data_file, "wb") as f:
-                        pickle.dump(ap_data, f)
+            elif args.shard is not None:
+                print("Saving data for shard %d/%d..." % args.shard)
+                with open(shard_path(args.ap_data_file, args.shard), "wb") as f:
+                    pickle.dump(ap_data, f)
+            elif not train_mode:
+                print("Saving data...")
+                with open(args.ap_data_file, "wb") as f:
+                    pickle.dump(ap_data, f)
 
-                return calc_map(ap_data)
-        elif args.benchmark:
-            print()
-            print()
-            print("Stats for the last frame:")
-            timer.print_stats()
-            avg_seconds = frame_times.get_avg()
-            print(
-                "Average: %5.2f fps, %5.2f ms"
-                % (1 / frame_times.get_avg(), 1000 * avg_seconds)
-            )
+            if coco_evaluator is not None:
+                coco_eval_path = args.coco_eval_file
+                if args.shard is not None:
+                    coco_eval_path = shard_path(args.coco_eval_file, args.shard)
+
+                with open(coco_eval_path, "wb") as f:
+                    pickle.dump(coco_evaluator, f)
+
+            # The saved results supersede the checkpoint, so don't leave it around to resume from
+            if os.path.exists(checkpoint_path) and (
+                args.checkpoint_every > 0 or args.resume_checkpoint
+            ):
+                os.remove(checkpoint_path)
+
+            if args.shard is None:
+                all_maps = None if args.output_coco_json else calc_map(ap_data)
+
+                if coco_evaluator is not None:
+                    print_coco_eval(coco_evaluator)
+
+                return all_maps
 
     except KeyboardInterrupt:
         print("Stopping...")
 
 
+def benchmark(net: Yolact, dataset, dataset_indices: list):
+    """
+    Times the network and postprocessing on the given images for every combination of
+    --benchmark_sizes and --benchmark_batch_sizes. Prints the latency percentiles of each timer
+    stage and writes them out to --benchmark_output if it's set.
+    """
+    sizes = args.benchmark_sizes or [cfg.max_size]
+    batch_sizes = args.benchmark_batch_sizes or [max(args.batch_size, 1)]
+
+    if cfg.preserve_aspect_ratio:
+        # Images from these configs differ in size, so they can't be stacked
+        batch_sizes = [1]
+
+    if args.cuda:
+        # Otherwise the asynchronous GPU work would get counted toward whichever stage syncs first
+        timer.set_sync(torch.cuda.synchronize)
+
+    old_max_size = cfg.max_size
+    results = []
+
+    try:
+        for max_size in sizes:
+            # The transform reads max_size when it's made, so remake it for each size
+            cfg.max_size = max_size
+            dataset.transform = BaseTransform()
+
+            for batch_size in batch_sizes:
+                results.append(benchmark_run(net, dataset, dataset_indices, batch_size))
+    except KeyboardInterrupt:
+        print("Stopping...")
+    finally:
+        cfg.max_size = old_max_size
+        dataset.transform = BaseTransform()
+        timer.set_sync(None)
+
+    if args.benchmark_output is not None and len(results) > 0:
+        save_benchmark(results, args.benchmark_output)
+
+    return results
+
+
+def benchmark_run(net: Yolact, dataset, dataset_indices: list, batch_size: int):
+    """ Benchmarks one input size and batch size. Returns the results as a dict. """
+    if args.benchmark_iters > 0:
+        num_iters = args.benchmark_iters
+    else:
+        num_iters = max(len(dataset_indices) // batch_size, 1)
+    num_warmup = max(args.benchmark_warmup, 0)
+
+    # Every timed batch should be full, so drop the last one if it's short
+    data_loader = torch.utils.data.DataLoader(
+        EvalDataset(dataset, dataset_indices),
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=args.num_workers,
+        collate_fn=eval_collate,
+        pin_memory=args.cuda and args.num_workers > 0,
+        drop_last=len(dataset_indices) >= batch_size,
+    )
+
+    def loop_batches():
+        while True:
+            yield from data_loader
+
+    batches = loop_batches()
+    iter_times = []
+    num_images = 0
+    progress_bar = ProgressBar(30, num_warmup + num_iters)
+
+    print()
+    print("Benchmarking max_size=%d, batch_size=%d" % (cfg.max_size, batch_size))
+
+    for it in range(num_warmup + num_iters):
+        timer.reset()
+
+        with timer.env("Load Data"):
+            samples = next(batches)
+
+            batch = Variable(torch.stack([sample[1] for sample in samples], 0))
+            if args.cuda:
+                batch = batch.cuda(non_blocking=True)
+
+        with timer.env("Network Extra"):
+            preds = net(batch)
+
+        for batch_idx, sample in enumerate(samples):
+            _, _, _, _, h, w, _ = sample
+            prep_benchmark(preds, h, w, batch_idx=batch_idx)
+
+        if it >= num_warmup:
+            iter_times.append(timer.get_times())
+            num_images += len(samples)
+
+        if not args.no_bar:
+            progress_bar.set_val(it + 1)
+            print(
+                "\r%s %6d / %6d %s"
+                % (
+                    repr(progress_bar),
+                    it + 1,
+                    num_warmup + num_iters,
+                    "(warmup)" if it < num_warmup else "        ",
+                ),
+                end="",
+            )
+
+    if not args.no_bar:
+        print()
+
+    # Keep the stages in the order they first ran, and count a stage that didn't run as 0
+    stages = []
+    for times in iter_times:
+        stages += [name for name in times if name not in stages]
+
+    stage_times = {
+        name: np.array([times.get(name, 0) for times in iter_times]) for name in stages
+    }
+    stage_times["Total"] = np.array([sum(times.values()) for times in iter_times])
+
+    latency = OrderedDict()
+    for name, times in stage_times.items():
+        p50, p90, p99 = np.percentile(times * 1000, [50, 90, 99])
+        latency[name] = {
+            "mean": float(times.mean() * 1000),
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+        }
+
+    result = OrderedDict(
+        [
+            ("config", cfg.name),
+            ("max_size", cfg.max_size),
+            ("batch_size", batch_size),
+            ("device", torch.cuda.get_device_name() if args.cuda else "cpu"),
+            ("warmup", num_warmup),
+            ("iterations", num_iters),
+            ("images", num_images),
+            ("fps", float(num_images / max(stage_times["Total"].sum(), 1e-10))),
+            ("latency_ms", latency),
+        ]
+    )
+
+    print_benchmark(result)
+    return result
+
+
+def print_benchmark(result: dict):
+    """ Prints the per batch latency of each stage of a benchmark_run result into a table. """
+    names = list(result["latency_ms"].keys())
+    name_width = max([len(k) for k in names] + [5])
+
+    header = (" {:^%d} |" % name_width).format("Stage") + "".join(
+        " {:^9} |".format(x + " (ms)") for x in ("mean", "p50", "p90", "p99")
+    )
+    sep_idx = header.find("|")
+    sep_text = ("-" * sep_idx) + "+" + "-" * (len(header) - sep_idx - 1)
+
+    print()
+    print(header)
+    print(sep_text)
+    for name in names:
+        if name == "Total":
+            print(sep_text)
+
+        print(
+            (" {:>%d} |" % name_width).format(name)
+            + "".join(
+                " {:>9.3f} |".format(result["latency_ms"][name][x])
+                for x in ("mean", "p50", "p90", "p99")
+            )
+        )
+    print()
+    print(
+        "%d images in %d batches of %d: %.2f fps"
+        % (result["images"], result["iterations"], result["batch_size"], result["fps"])
+    )
+
+
+def save_benchmark(results: list, path: str):
+    """ Appends benchmark_run results to a json file (as a list) or a csv file (one row per stage). """
+    if path.endswith(".csv"):
+        fields = [
+            "config",
+            "max_size",
+            "batch_size",
+            "device",
+            "warmup",
+            "iterations",
+            "images",
+            "fps",
+        ]
+        write_header = not os.path.exists(path)
+
+        with open(path, "a", newline="") as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(
+                    fields + ["stage", "mean_ms", "p50_ms", "p90_ms", "p99_ms"]
+                )
+
+            for result in results:
+                for name, latency in result["latency_ms"].items():
+                    row = [result[x] for x in fields] + [name]
+                    row += [latency[x] for x in ("mean", "p50", "p90", "p99")]
+                    writer.writerow(row)
+    else:
+        all_results = []
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                all_results = json.load(f)
+
+        with open(path, "w") as f:
+            json.dump(all_results + results, f, indent=2)
+
+    print("Saved benchmark results to %s" % path)
+
+
 def calc_map(ap_data):
     print("Calculating mAP...")
     aps = [{"box": [], "mask": []} for _ in iou_thresholds]
@@ -1392,6 +2368,100 @@ def print_maps(all_maps):
     print()
 
 
+def make_quantized_net(dataset):
+    """
+    Makes the int8 network, either by loading --quantized_model or by calibrating on
+    --quantize_calib_images validation images (and then saving it to --quantized_model if that's set).
+    """
+    # Imported here because torch.ao only exists in newer versions of Pytorch
+    from utils.quantization import quantize, save_quantized, load_quantized
+
+    net = Yolact()
+    net.eval()
+
+    if args.quantized_model is not None and os.path.exists(args.quantized_model):
+        return load_quantized(net, args.quantized_model)
+
+    if dataset is None:
+        dataset = COCODetection(
+            cfg.dataset.valid_images,
+            cfg.dataset.valid_info,
+            transform=BaseTransform(),
+            has_gt=cfg.dataset.has_gt,
+        )
+
+    net.load_weights(args.trained_model)
+    quantize(net, dataset, args.quantize_calib_images)
+
+    if args.quantized_model is not None:
+        save_quantized(net, args.quantized_model)
+
+    return net
+
+
+# The arguments for every file evaluate reads or writes, which compare_quantized keeps separate for each network
+eval_file_args = [
+    "ap_data_file",
+    "checkpoint_file",
+    "bbox_det_file",
+    "mask_det_file",
+    "coco_eval_file",
+]
+
+
+def compare_quantized(net: Yolact, qnet: Yolact, dataset):
+    """
+    Evaluates the fp32 and int8 networks on the same images, times both of them with benchmark_run,
+    and then prints their mAP and latency side by side. Each network gets its own results and
+    checkpoint files, with _fp32 or _int8 added to the names.
+    """
+    dataset_size = (
+        len(dataset) if args.max_images < 0 else min(args.max_images, len(dataset))
+    )
+    batch_size = 1 if cfg.preserve_aspect_ratio else max(args.batch_size, 1)
+    results = []
+
+    file_paths = {arg: getattr(args, arg) for arg in eval_file_args}
+
+    for name, model in (("fp32", net), ("int8", qnet)):
+        for arg, path in file_paths.items():
+            root, ext = os.path.splitext(path)
+            setattr(args, arg, "%s_%s%s" % (root, name, ext))
+
+        try:
+            print()
+            print("Evaluating the %s network..." % name)
+            all_maps = evaluate(model, dataset)
+        finally:
+            for arg, path in file_paths.items():
+                setattr(args, arg, path)
+
+        result = benchmark_run(model, dataset, list(range(dataset_size)), batch_size)
+        results.append((name, all_maps, result))
+
+    make_row = lambda vals: (" %9s |" * len(vals)) % tuple(vals)
+
+    print()
+    print(make_row(["", "box mAP", "mask mAP", "mean (ms)", "p90 (ms)", "fps"]))
+    print("-----------+" * 6)
+    for name, all_maps, result in results:
+        if all_maps is None:
+            maps = ["-", "-"]
+        else:
+            maps = ["%.2f" % all_maps[iou_type]["all"] for iou_type in ("box", "mask")]
+
+        latency = result["latency_ms"]["Total"]
+        print(
+            make_row(
+                [name]
+                + maps
+                + ["%.2f" % latency["mean"], "%.2f" % latency["p90"]]
+                + ["%.2f" % result["fps"]]
+            )
+        )
+    print()
+
+
 if __name__ == "__main__":
     parse_args()
 
@@ -1420,16 +2490,40 @@ if __name__ == "__main__":
         if not os.path.exists("results"):
             os.makedirs("results")
 
+        if args.cuda and not torch.cuda.is_available():
+            print("No GPU found, so evaluating on the CPU instead.")
+            args.cuda = False
+
         if args.cuda:
             cudnn.fastest = True
             torch.set_default_tensor_type("torch.cuda.FloatTensor")
         else:
             torch.set_default_tensor_type("torch.FloatTensor")
 
+            if args.cpu_threads > 0:
+                torch.set_num_threads(args.cpu_threads)
+                cv2.setNumThreads(args.cpu_threads)
+
+            # Denormal floats are really slow on the CPU and don't change the results in any real way
+            torch.set_flush_denormal(True)
+
+        if args.quantize and args.cuda:
+            print("Error: --quantize only runs on the CPU, so also pass --cuda=False.")
+            exit()
+
         if args.resume and not args.display:
             with open(args.ap_data_file, "rb") as f:
                 ap_data = pickle.load(f)
             calc_map(ap_data)
+
+            if args.coco_eval:
+                with open(args.coco_eval_file, "rb") as f:
+                    print_coco_eval(pickle.load(f))
+            exit()
+
+        if args.merge_shards > 0:
+            prep_coco_cats()
+            merge_shards(args.merge_shards)
             exit()
 
         if args.image is None and args.video is None and args.images is None:
@@ -1447,9 +2541,22 @@ if __name__ == "__main__":
         net = Yolact()
         net.load_weights(args.trained_model)
         net.eval()
+
+        if args.fuse_conv_bn:
+            net.fuse_for_inference()
         print(" Done.")
 
         if args.cuda:
             net = net.cuda()
 
-        evaluate(net, dataset)
+        if args.quantize:
+            print("Quantizing model...", end="")
+            qnet = make_quantized_net(dataset)
+            print(" Done.")
+
+            if dataset is not None and not args.display and not args.benchmark:
+                compare_quantized(net, qnet, dataset)
+            else:
+                evaluate(qnet, dataset)
+        else:
+            evaluate(net, dataset)
@@ -0,0 +1,95 @@
+"""
+Exports a trained model as a single TorchScript or ONNX graph, from the input images through Fast NMS,
+with the priors baked in for one input size. See utils/export.py for the inputs and outputs.
+"""
+
+from data import cfg, set_cfg
+from yolact import Yolact
+from utils.functions import SavePath
+from utils.export import YolactExport, export_torchscript, export_onnx
+
+import argparse
+import os
+import torch
+
+
+def str2bool(v):
+    return v.lower() in ("yes", "true", "t", "1")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YOLACT Export")
+    parser.add_argument(
+        "--trained_model",
+        default="weights/yolact_base_54_800000.pth",
+        type=str,
+        help="The model to export.",
+    )
+    parser.add_argument(
+        "--format",
+        default="torchscript",
+        type=str,
+        choices=["torchscript", "onnx"],
+        help="What to export the model as.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        type=str,
+        help="Where to save the exported model. Defaults to the trained model's path with a .pt or .onnx extension.",
+    )
+    parser.add_argument(
+        "--max_size",
+        default=None,
+        type=int,
+        help="The input size to export for (the images get resized to this in the graph, and the priors are made for it). Defaults to the config's max_size.",
+    )
+    parser.add_argument(
+        "--cross_class_nms",
+        default=False,
+        type=str2bool,
+        help="Whether the exported Fast NMS is cross-class or per-class.",
+    )
+    parser.add_argument(
+        "--opset", default=14, type=int, help="The ONNX opset version to export with.",
+    )
+    parser.add_argument("--config", default=None, help="The config object to use.")
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.config is None:
+        model_path = SavePath.from_str(args.trained_model)
+        args.config = model_path.model_name + "_config"
+        print("Config not specified. Parsed %s from the file name.\n" % args.config)
+    set_cfg(args.config)
+
+    if args.max_size is not None:
+        cfg.max_size = args.max_size
+
+    if args.output is None:
+        extension = ".pt" if args.format == "torchscript" else ".onnx"
+        args.output = os.path.splitext(args.trained_model)[0] + extension
+
+    torch.set_default_tensor_type("torch.FloatTensor")
+
+    print("Loading model...", end="")
+    net = Yolact()
+    net.load_weights(args.trained_model)
+    net.eval()
+    net.fuse_for_inference()
+    net.detect.use_cross_class_nms = args.cross_class_nms
+    print(" Done.")
+
+    model = YolactExport(net)
+    example_img = torch.zeros(1, cfg.max_size, cfg.max_size, 3)
+
+    print("Exporting to %s..." % args.output, end="")
+    if args.format == "torchscript":
+        export_torchscript(model, example_img, args.output)
+    else:
+        export_onnx(model, example_img, args.output, args.opset)
+    print(" Done.")
@@ -181,6 +181,82 @@ def change(gt, priors):
     return -torch.sqrt((diff ** 2).sum(dim=2))
 
 
+def force_match_sequential(overlaps, best_truth_overlap, best_truth_idx):
+    """
+    Forces each gt to be matched with its highest overlap prior, one gt at a time. Modifies all of the
+    arguments in place.
+
+    Args:
+        - overlaps:           [num_objects, num_priors] overlaps between each gt and prior.
+        - best_truth_overlap: [num_priors] the overlap of each prior with its matched gt.
+        - best_truth_idx:     [num_priors] the index of each prior's matched gt.
+    """
+    for _ in range(overlaps.size(0)):
+        # Find j, the gt with the highest overlap with a prior
+        # In effect, this will loop through overlaps.size(0) in a "smart" order,
+        # always choosing the highest overlap first.
+        best_prior_overlap, best_prior_idx = overlaps.max(1)
+        j = best_prior_overlap.max(0)[1]
+
+        # Find i, the highest overlap anchor with this gt
+        i = best_prior_idx[j]
+
+        # Set all other overlaps with i to be -1 so that no other gt uses it
+        overlaps[:, i] = -1
+        # Set all other overlaps with j to be -1 so that this loop never uses j again
+        overlaps[j, :] = -1
+
+        # Overwrite i's score to be 2 so it doesn't get thresholded ever
+        best_truth_overlap[i] = 2
+        # Set the gt to be used for i to be j, overwriting whatever was there
+        best_truth_idx[i] = j
+
+
+def force_match(overlaps, best_truth_overlap, best_truth_idx):
+    """
+    Does the same thing as force_match_sequential (with the same result, assuming all the overlaps are
+    above -1), but matches many gts at once instead of one per iteration.
+
+    force_match_sequential matches the gt and prior with the highest remaining overlap each iteration.
+    A gt j whose best remaining prior i has its highest overlap with j (the first such gt for ties) is
+    always going to get matched with i like that, because no other gt can take i before j is matched.
+    So every iteration here matches all of those gts at once, and then removes them and their priors
+    the same way force_match_sequential does. The gt force_match_sequential would match first is always
+    one of them, so this takes at most as many iterations, and usually only one or two.
+    """
+    num_objects = overlaps.size(0)
+    gt_idx = torch.arange(num_objects, device=overlaps.device)
+    unmatched = torch.ones(num_objects, dtype=torch.bool, device=overlaps.device)
+
+    # Every iteration matches at least one gt (or stops), so this never needs more than num_objects
+    for _ in range(num_objects):
+        if not unmatched.any():
+            break
+
+        # For each gt, its best prior and then the first gt with the highest overlap with that prior
+        _, best_prior_idx = overlaps.max(1)
+        _, best_gt_idx = overlaps[:, best_prior_idx].max(0)
+
+        matched = (best_gt_idx == gt_idx) & unmatched
+
+        if not matched.any():
+            # This only happens once every prior is used (i.e., there are more gts than priors). Then
+            # everything is -1, so force_match_sequential keeps matching the first gt with the first prior.
+            best_truth_overlap[0] = 2
+            best_truth_idx[0] = 0
+            break
+
+        j = gt_idx[matched]
+        i = best_prior_idx[matched]
+
+        overlaps[:, i] = -1
+        overlaps[j, :] = -1
+
+        best_truth_overlap[i] = 2
+        best_truth_idx[i] = j
+        unmatched[j] = False
+
+
 def match(
     pos_thresh,
     neg_thresh,
@@ -231,25 +307,11 @@ def match(
     # We want to ensure that each gt gets used at least once so that we don't
     # waste any training data. In order to do that, find the max overlap anchor
     # with each gt, and force that anchor to use that gt.
-    for _ in range(overlaps.size(0)):
-        # Find j, the gt with the highest overlap with a prior
-        # In effect, this will loop through overlaps.size(0) in a "smart" order,
-        # always choosing the highest overlap first.
-        best_prior_overlap, best_prior_idx = overlaps.max(1)
-        j = best_prior_overlap.max(0)[1]
-
-        # Find i, the highest overlap anchor with this gt
-        i = best_prior_idx[j]
-
-        # Set all other overlaps with i to be -1 so that no other gt uses it
-        overlaps[:, i] = -1
-        # Set all other overlaps with j to be -1 so that this loop never uses j again
-        overlaps[j, :] = -1
-
-        # Overwrite i's score to be 2 so it doesn't get thresholded ever
-        best_truth_overlap[i] = 2
-        # Set the gt to be used for i to be j, overwriting whatever was there
-        best_truth_idx[i] = j
+    if cfg.use_change_matching:
+        # The batched version relies on -1 being lower than any overlap, which isn't true for -change
+        force_match_sequential(overlaps, best_truth_overlap, best_truth_idx)
+    else:
+        force_match(overlaps, best_truth_overlap, best_truth_idx)
 
     matches = truths[best_truth_idx]  # Shape: [num_priors,4]
     conf = labels[best_truth_idx] + 1  # Shape: [num_priors]
@@ -348,15 +410,12 @@ def decode(loc, priors, use_yolo_regressors: bool = False):
     else:
         variances = [0.1, 0.2]
 
-        boxes = torch.cat(
-            (
-                priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-                priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1]),
-            ),
-            1,
-        )
-        boxes[:, :2] -= boxes[:, 2:] / 2
-        boxes[:, 2:] += boxes[:, :2]
+        centers = priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:]
+        sizes = priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])
+
+        # Not done in place on slices of one tensor so that this also exports to ONNX correctly
+        mins = centers - sizes / 2
+        boxes = torch.cat((mins, sizes + mins), 1)
 
     return boxes
 
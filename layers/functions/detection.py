@@ -1,12 +1,10 @@
 import torch
 import torch.nn.functional as F
-from ..box_utils import decode, jaccard, index2d
+from ..box_utils import decode, jaccard, index2d, crop
 from utils import timer
 
 from data import cfg, mask_type
 
-import numpy as np
-
 
 class Detect(object):
     """At test time, Detect is the final layer of SSD.  Decode location preds,
@@ -30,6 +28,15 @@ class Detect(object):
         self.use_cross_class_nms = False
         self.use_fast_nms = False
 
+        # How many candidates traditional_nms compares against each other at once
+        self.nms_chunk_size = 1024
+
+        # Set to "matrix" or "soft" to decay scores (see decay_nms) instead of using the above
+        self.nms_mode = None
+        self.nms_kernel = "gaussian"
+        self.nms_sigma = 0.5
+        self.use_mask_iou_nms = False
+
     def __call__(self, predictions, net):
         """
         Args:
@@ -45,90 +52,110 @@ class Detect(object):
                 Shape: [batch, mask_h, mask_w, mask_dim]
         
         Returns:
-            output of shape (batch_size, top_k, 1 + 1 + 4 + mask_dim)
-            These outputs are in the order: class idx, confidence, bbox coords, and mask.
+            A list with one dict per image of the form {"detection": dets, "net": net},
+            where dets holds the "box", "mask", "class", "score" (and "proto") tensors
+            for that image, or is None if nothing passed the confidence threshold.
 
+            This is just a view over the padded output of detect_batch.
             Note that the outputs are sorted only if cross_class_nms is False
         """
+        out = self.detect_batch(predictions)
+        num_dets = out["num_dets"].tolist()
+
+        results = []
+
+        for batch_idx, num in enumerate(num_dets):
+            if num == 0:
+                result = None
+            else:
+                result = {
+                    k: out[k][batch_idx, :num]
+                    for k in ("box", "mask", "class", "score")
+                }
+
+                if out["proto"] is not None:
+                    result["proto"] = out["proto"][batch_idx]
+
+            results.append({"detection": result, "net": net})
 
+        return results
+
+    def detect_batch(self, predictions):
+        """
+        Decodes, thresholds and runs NMS on every image in the batch at once.
+
+        Returns a dict with the padded detections for the whole batch:
+            - box:      [batch, K, 4] boxes in point form, relative to the image size
+            - mask:     [batch, K, mask_dim] mask coefficients
+            - class:    [batch, K] class indices, not counting the background class
+            - score:    [batch, K] scores, sorted descending for each image
+            - num_dets: [batch] the number of valid detections for each image
+            - proto:    [batch, mask_h, mask_w, mask_dim] prototypes, or None
+        Only the first num_dets[i] entries of image i are valid. The rest are padding
+        and have a score of -1. K is cfg.max_num_detections (top_k for cc_fast_nms).
+        """
         loc_data = predictions["loc"]
         conf_data = predictions["conf"]
         mask_data = predictions["mask"]
         prior_data = predictions["priors"]
 
         proto_data = predictions["proto"] if "proto" in predictions else None
-        inst_data = predictions["inst"] if "inst" in predictions else None
-
-        out = []
 
         with timer.env("Detect"):
             batch_size = loc_data.size(0)
             num_priors = prior_data.size(0)
 
-            conf_preds = (
-                conf_data.view(batch_size, num_priors, self.num_classes)
-                .transpose(2, 1)
-                .contiguous()
-            )
-
-            for batch_idx in range(batch_size):
-                decoded_boxes = decode(loc_data[batch_idx], prior_data)
-                result = self.detect(
-                    batch_idx, conf_preds, decoded_boxes, mask_data, inst_data
-                )
+            decoded_boxes = decode(
+                loc_data.view(-1, 4), prior_data.repeat(batch_size, 1)
+            ).view(batch_size, num_priors, 4)
+
+            # [batch, num_classes - 1, num_priors] without the background class
+            conf_preds = conf_data.view(
+                batch_size, num_priors, self.num_classes
+            ).transpose(2, 1)[:, 1:, :]
+            conf_scores, _ = conf_preds.max(dim=1)
+
+            # Instead of filtering out the priors that don't pass the threshold (which
+            # gives a different number of priors per image), give them a score of -1.
+            # They get sorted after every real score and so never suppress anything.
+            keep = conf_scores > self.conf_thresh
+            scores = conf_preds.masked_fill(~keep[:, None, :], -1)
+
+            if self.nms_mode in ("matrix", "soft"):
+                out = self.decay_nms(decoded_boxes, mask_data, scores, proto_data)
+            elif self.use_fast_nms:
+                if self.use_cross_class_nms:
+                    out = self.cc_fast_nms(
+                        decoded_boxes, mask_data, scores, self.nms_thresh, self.top_k
+                    )
+                else:
+                    out = self.fast_nms(
+                        decoded_boxes, mask_data, scores, self.nms_thresh, self.top_k
+                    )
+            else:
+                out = self.batch_traditional_nms(decoded_boxes, mask_data, scores, keep)
 
-                if result is not None and proto_data is not None:
-                    result["proto"] = proto_data[batch_idx]
+                if self.use_cross_class_nms:
+                    print("Warning: Cross Class Traditional NMS is not implemented.")
 
-                out.append({"detection": result, "net": net})
+            out["proto"] = proto_data
 
         return out
 
-    def detect(self, batch_idx, conf_preds, decoded_boxes, mask_data, inst_data):
-        """ Perform nms for only the max scoring class that isn't background (class 0) """
-        cur_scores = conf_preds[batch_idx, 1:, :]
-        conf_scores, _ = torch.max(cur_scores, dim=0)
-
-        keep = conf_scores > self.conf_thresh
-        scores = cur_scores[:, keep]
-        boxes = decoded_boxes[keep, :]
-        masks = mask_data[batch_idx, keep, :]
-
-        if inst_data is not None:
-            inst = inst_data[batch_idx, keep, :]
-
-        if scores.size(1) == 0:
-            return None
-
-        if self.use_fast_nms:
-            if self.use_cross_class_nms:
-                boxes, masks, classes, scores = self.cc_fast_nms(
-                    boxes, masks, scores, self.nms_thresh, self.top_k
-                )
-            else:
-                boxes, masks, classes, scores = self.fast_nms(
-                    boxes, masks, scores, self.nms_thresh, self.top_k
-                )
-        else:
-            boxes, masks, classes, scores = self.traditional_nms(
-                boxes, masks, scores, self.nms_thresh, self.conf_thresh
-            )
-
-            if self.use_cross_class_nms:
-                print("Warning: Cross Class Traditional NMS is not implemented.")
-
-        return {"box": boxes, "mask": masks, "class": classes, "score": scores}
-
     def cc_fast_nms(
         self, boxes, masks, scores, iou_threshold: float = 0.5, top_k: int = 200
     ):
+        batch_size = boxes.size(0)
+        batch_idx = torch.arange(batch_size, device=boxes.device)[:, None]
+
         # Collapse all the classes into 1
-        scores, classes = scores.max(dim=0)
+        scores, classes = scores.max(dim=1)
 
-        _, idx = scores.sort(0, descending=True)
-        idx = idx[:top_k]
+        scores, idx = scores.sort(1, descending=True)
+        idx = idx[:, :top_k]
+        scores = scores[:, :top_k]
 
-        boxes_idx = boxes[idx]
+        boxes_idx = boxes[batch_idx, idx]
 
         # Compute the pairwise IoU between the boxes
         iou = jaccard(boxes_idx, boxes_idx)
@@ -139,13 +166,24 @@ class Detect(object):
         # Now that everything in the diagonal and below is zeroed out, if we take the max
         # of the IoU matrix along the columns, each column will represent the maximum IoU
         # between this element and every element with a higher score than this element.
-        iou_max, _ = torch.max(iou, dim=0)
+        iou_max, _ = torch.max(iou, dim=1)
 
         # Now just filter out the ones greater than the threshold, i.e., only keep boxes that
         # don't have a higher scoring box that would supress it in normal NMS.
-        idx_out = idx[iou_max <= iou_threshold]
-
-        return boxes[idx_out], masks[idx_out], classes[idx_out], scores[idx_out]
+        keep = (iou_max <= iou_threshold) & (scores >= 0)
+
+        # Move the kept detections to the front while keeping them in score order
+        pos = torch.arange(idx.size(1), device=boxes.device).expand_as(idx)
+        _, order = torch.where(keep, pos, pos + idx.size(1)).sort(1)
+        idx = idx.gather(1, order)
+
+        return self._pack_dets(
+            boxes[batch_idx, idx],
+            masks[batch_idx, idx],
+            classes.gather(1, idx),
+            scores.gather(1, order),
+            keep.sum(dim=1),
+        )
 
     def fast_nms(
         self,
@@ -156,22 +194,26 @@ class Detect(object):
         top_k: int = 200,
         second_threshold: bool = False,
     ):
-        scores, idx = scores.sort(1, descending=True)
+        batch_size = boxes.size(0)
+        batch_idx = torch.arange(batch_size, device=boxes.device)[:, None, None]
 
-        idx = idx[:, :top_k].contiguous()
-        scores = scores[:, :top_k]
+        scores, idx = scores.sort(2, descending=True)
+
+        idx = idx[:, :, :top_k]
+        scores = scores[:, :, :top_k]
 
-        num_classes, num_dets = idx.size()
+        _, num_classes, num_dets = idx.size()
 
-        boxes = boxes[idx.view(-1), :].view(num_classes, num_dets, 4)
-        masks = masks[idx.view(-1), :].view(num_classes, num_dets, -1)
+        boxes = boxes[batch_idx, idx]
+        masks = masks[batch_idx, idx]
 
-        iou = jaccard(boxes, boxes)
+        iou = jaccard(boxes.view(-1, num_dets, 4), boxes.view(-1, num_dets, 4))
         iou.triu_(diagonal=1)
         iou_max, _ = iou.max(dim=1)
 
-        # Now just filter out the ones higher than the threshold
-        keep = iou_max <= iou_threshold
+        # Now just filter out the ones higher than the threshold. Anything with a negative
+        # score is padding for a prior that didn't pass the confidence threshold.
+        keep = (iou_max.view_as(scores) <= iou_threshold) & (scores >= 0)
 
         # We should also only keep detections over the confidence threshold, but at the cost of
         # maxing out your detection count for every image, you can just not do that. Because we
@@ -179,80 +221,245 @@ class Detect(object):
         # this increase doesn't affect us much (+0.2 mAP for 34 -> 33 fps), so we leave it out.
         # However, when you implement this in your method, you should do this second threshold.
         if second_threshold:
-            keep *= scores > self.conf_thresh
+            keep &= scores > self.conf_thresh
 
-        # Assign each kept detection to its corresponding class
+        # Assign each detection to its corresponding class
         classes = torch.arange(num_classes, device=boxes.device)[:, None].expand_as(
-            keep
+            keep[0]
         )
-        classes = classes[keep]
-
-        boxes = boxes[keep]
-        masks = masks[keep]
-        scores = scores[keep]
 
         # Only keep the top cfg.max_num_detections highest scores across all classes
-        scores, idx = scores.sort(0, descending=True)
-        idx = idx[: cfg.max_num_detections]
-        scores = scores[: cfg.max_num_detections]
+        scores = scores.masked_fill(~keep, -1).view(batch_size, -1)
+        scores, idx = scores.sort(1, descending=True)
+        idx = idx[:, : cfg.max_num_detections]
+        scores = scores[:, : cfg.max_num_detections]
 
-        classes = classes[idx]
-        boxes = boxes[idx]
-        masks = masks[idx]
+        batch_idx = batch_idx.view(-1, 1)
 
-        return boxes, masks, classes, scores
+        return self._pack_dets(
+            boxes.view(batch_size, -1, 4)[batch_idx, idx],
+            masks.view(batch_size, num_classes * num_dets, -1)[batch_idx, idx],
+            classes.reshape(-1)[idx],
+            scores,
+            keep.view(batch_size, -1).sum(dim=1).clamp(max=cfg.max_num_detections),
+        )
 
-    def traditional_nms(
-        self, boxes, masks, scores, iou_threshold=0.5, conf_thresh=0.05
-    ):
-        import pyximport
+    def decay_nms(self, boxes, masks, scores, proto_data=None):
+        """
+        Matrix NMS (SOLOv2) or Soft-NMS, selected with self.nms_mode. Instead of removing
+        overlapping detections, both decay their scores based on the IoU with every higher
+        scoring detection of the same class, and then threshold the decayed scores.
 
-        pyximport.install(
-            setup_args={"include_dirs": np.get_include()}, reload_support=True
-        )
+        Each image's top_k (class, prior) pairs are processed at once. Soft-NMS is done
+        like fast_nms: the decays from higher scoring detections are applied all at once
+        instead of one detection at a time, so detections that were decayed themselves
+        still decay everything below them.
+
+        Args:
+            - boxes:      [batch, num_priors, 4] decoded boxes
+            - masks:      [batch, num_priors, mask_dim] mask coefficients
+            - scores:     [batch, num_classes, num_priors] scores, -1 for removed priors
+            - proto_data: [batch, mask_h, mask_w, mask_dim] only used for mask IoU
+        """
+        batch_size, num_classes, num_priors = scores.size()
+        batch_idx = torch.arange(batch_size, device=boxes.device)[:, None]
 
-        from utils.cython_nms import nms as cnms
+        # Take the top_k (class, prior) pairs for each image
+        scores, idx = scores.view(batch_size, -1).sort(1, descending=True)
+        scores = scores[:, : self.top_k]
+        idx = idx[:, : self.top_k]
 
-        num_classes = scores.size(0)
+        classes = idx // num_priors
+        idx = idx % num_priors
 
-        idx_lst = []
-        cls_lst = []
-        scr_lst = []
+        boxes = boxes[batch_idx, idx]
+        masks = masks[batch_idx, idx]
 
-        # Multiplying by max_size is necessary because of how cnms computes its area and intersections
-        boxes = boxes * cfg.max_size
+        if self.use_mask_iou_nms:
+            # Compute the actual (cropped and binarized) masks from the coefficients
+            mask_h, mask_w = proto_data.size(1), proto_data.size(2)
+            mask_preds = cfg.mask_proto_mask_activation(
+                proto_data @ masks.transpose(1, 2)[:, None]
+            )
+            mask_preds = crop(
+                mask_preds.permute(1, 2, 0, 3).reshape(mask_h, mask_w, -1),
+                boxes.view(-1, 4),
+            )
+            mask_preds = mask_preds.view(mask_h * mask_w, batch_size, -1)
+            mask_preds = (mask_preds > 0.5).float().permute(1, 2, 0)
 
-        for _cls in range(num_classes):
-            cls_scores = scores[_cls, :]
-            conf_mask = cls_scores > conf_thresh
-            idx = torch.arange(cls_scores.size(0), device=boxes.device)
+            inter = mask_preds @ mask_preds.transpose(1, 2)
+            areas = mask_preds.sum(dim=2)
+            iou = inter / (areas[:, :, None] + areas[:, None, :] - inter).clamp(min=1)
+        else:
+            iou = jaccard(boxes, boxes)
+
+        # Detections only decay lower scoring detections of the same class
+        iou = iou * (classes[:, :, None] == classes[:, None, :]).float()
+        iou.triu_(diagonal=1)
+
+        if self.nms_mode == "matrix":
+            # How much each detection was itself decayed by its most overlapping detection
+            compensate, _ = iou.max(dim=1)
+            compensate = compensate[:, :, None]
+
+            if self.nms_kernel == "gaussian":
+                decay = torch.exp((compensate ** 2 - iou ** 2) / self.nms_sigma)
+            else:
+                decay = (1 - iou) / (1 - compensate).clamp(min=1e-6)
+
+            # Pairs that don't overlap (which includes the diagonal, everything below it
+            # and pairs from different classes) shouldn't decay anything.
+            decay = decay.masked_fill(iou == 0, 1)
+            decay, _ = decay.min(dim=1)
+        else:
+            if self.nms_kernel == "gaussian":
+                decay = torch.exp(-(iou ** 2).sum(dim=1) / self.nms_sigma)
+            else:
+                decay = torch.where(
+                    iou >= self.nms_thresh, 1 - iou, torch.ones_like(iou)
+                ).prod(dim=1)
+
+        # Removed priors have a negative score, so this filters them out too
+        scores = scores * decay
+        keep = scores > self.conf_thresh
+
+        scores, order = scores.masked_fill(~keep, -1).sort(1, descending=True)
+        scores = scores[:, : cfg.max_num_detections]
+        order = order[:, : cfg.max_num_detections]
+
+        return self._pack_dets(
+            boxes[batch_idx, order],
+            masks[batch_idx, order],
+            classes.gather(1, order),
+            scores,
+            keep.sum(dim=1).clamp(max=cfg.max_num_detections),
+        )
+
+    def _pack_dets(self, boxes, masks, classes, scores, num_dets):
+        """ Packs padded batch detections into the dict returned by detect_batch. """
+        valid = torch.arange(scores.size(1), device=scores.device)[None, :]
+        valid = valid < num_dets[:, None]
+
+        return {
+            "box": boxes,
+            "mask": masks,
+            "class": classes,
+            "score": scores.masked_fill(~valid, -1),
+            "num_dets": num_dets,
+        }
+
+    def batch_traditional_nms(self, boxes, masks, scores, keep):
+        """ Runs traditional_nms one image at a time and pads the results. """
+        batch_size = boxes.size(0)
+        max_dets = cfg.max_num_detections
+
+        out_boxes = boxes.new_zeros(batch_size, max_dets, 4)
+        out_masks = masks.new_zeros(batch_size, max_dets, masks.size(2))
+        out_classes = torch.zeros(
+            batch_size, max_dets, dtype=torch.long, device=boxes.device
+        )
+        out_scores = scores.new_full((batch_size, max_dets), -1)
+        num_dets = torch.zeros(batch_size, dtype=torch.long, device=boxes.device)
 
-            cls_scores = cls_scores[conf_mask]
-            idx = idx[conf_mask]
+        for batch_idx in range(batch_size):
+            cur_keep = keep[batch_idx]
 
-            if cls_scores.size(0) == 0:
+            if not cur_keep.any():
                 continue
 
-            preds = (
-                torch.cat([boxes[conf_mask], cls_scores[:, None]], dim=1).cpu().numpy()
+            dets = self.traditional_nms(
+                boxes[batch_idx, cur_keep],
+                masks[batch_idx, cur_keep],
+                scores[batch_idx][:, cur_keep],
+                self.nms_thresh,
+                self.conf_thresh,
             )
-            keep = cnms(preds, iou_threshold)
-            keep = torch.Tensor(keep, device=boxes.device).long()
+            num = dets[3].size(0)
+
+            for out, det in zip((out_boxes, out_masks, out_classes, out_scores), dets):
+                out[batch_idx, :num] = det
+            num_dets[batch_idx] = num
+
+        return self._pack_dets(out_boxes, out_masks, out_classes, out_scores, num_dets)
+
+    def traditional_nms(
+        self, boxes, masks, scores, iou_threshold=0.5, conf_thresh=0.05
+    ):
+        """
+        Exact (greedy) NMS done per class, but with every class handled at once.
+
+        Each (class, prior) pair over conf_thresh is a candidate, and candidates can only
+        suppress lower scoring candidates of the same class. This is the offset trick in
+        mask form, since shifting the boxes themselves would change the float math.
+
+        The candidates are handled in score order, nms_chunk_size at a time so that memory
+        stays bounded no matter how many there are. Candidates in a chunk are first checked
+        against everything kept from earlier chunks. The greedy pass within the chunk is then
+        computed by iterating keep[j] = no kept box suppresses j until it stops changing,
+        which gives the same result as the sequential version.
+
+        This matches the old Cython NMS from Fast R-CNN, including its +1 pixel area
+        convention (which is why the boxes are scaled by max_size).
+        """
+        # [num_candidates] class and prior index of everything over the threshold
+        classes, idx = (scores > conf_thresh).nonzero().t()
+        scores, order = scores[classes, idx].sort(0, descending=True)
+        classes = classes[order]
+        idx = idx[order]
+
+        x1, y1, x2, y2 = (boxes[idx] * cfg.max_size).t()
+        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+        def suppresses(a, b):
+            """ [len(a), len(b)] whether each candidate in a would suppress each one in b. """
+            w = torch.min(x2[a, None], x2[None, b]) - torch.max(
+                x1[a, None], x1[None, b]
+            )
+            h = torch.min(y2[a, None], y2[None, b]) - torch.max(
+                y1[a, None], y1[None, b]
+            )
+            inter = (w + 1).clamp(min=0) * (h + 1).clamp(min=0)
+            iou = inter / (areas[a, None] + areas[None, b] - inter)
+
+            return (iou >= iou_threshold) & (classes[a, None] == classes[None, b])
+
+        num_candidates = idx.size(0)
+        keep = torch.zeros_like(idx, dtype=torch.bool)
+        kept = idx.new_zeros(0)
+
+        for start in range(0, num_candidates, self.nms_chunk_size):
+            chunk = torch.arange(
+                start,
+                min(start + self.nms_chunk_size, num_candidates),
+                device=boxes.device,
+            )
+
+            # Anything a kept box from an earlier chunk suppresses is out
+            chunk_keep = ~suppresses(kept, chunk).any(dim=0)
+
+            # suppress[i, j] is whether candidate i would suppress candidate j if it's kept
+            suppress = suppresses(chunk, chunk)
+            suppress &= chunk[:, None] < chunk[None, :]
 
-            idx_lst.append(idx[keep])
-            cls_lst.append(keep * 0 + _cls)
-            scr_lst.append(cls_scores[keep])
+            # After n iterations the first n candidates are final, but this usually stops
+            # much sooner since it only takes as long as the longest chain of suppressions.
+            candidates = chunk_keep
+            while True:
+                new_keep = candidates & ~(suppress & chunk_keep[:, None]).any(dim=0)
+                if torch.equal(new_keep, chunk_keep):
+                    break
+                chunk_keep = new_keep
 
-        idx = torch.cat(idx_lst, dim=0)
-        classes = torch.cat(cls_lst, dim=0)
-        scores = torch.cat(scr_lst, dim=0)
+            keep[chunk] = chunk_keep
+            kept = torch.cat([kept, chunk[chunk_keep]])
 
-        scores, idx2 = scores.sort(0, descending=True)
-        idx2 = idx2[: cfg.max_num_detections]
-        scores = scores[: cfg.max_num_detections]
+            # Nothing past this would make it into the output anyway
+            if kept.size(0) >= cfg.max_num_detections:
+                break
 
-        idx = idx[idx2]
-        classes = classes[idx2]
+        idx = idx[keep][: cfg.max_num_detections]
+        classes = classes[keep][: cfg.max_num_detections]
+        scores = scores[keep][: cfg.max_num_detections]
 
-        # Undo the multiplication above
-        return boxes[idx] / cfg.max_size, masks[idx], classes, scores
+        return boxes[idx], masks[idx], classes, scores
@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import cv2
+import pycocotools.mask
 
 from data import cfg, mask_type, MEANS, STD, activation_func
 from utils.augmentations import Resize
@@ -22,6 +23,10 @@ def postprocess(
     visualize_lincomb=False,
     crop_masks=True,
     score_threshold=0,
+    top_k=None,
+    lazy_masks=False,
+    mask_upsample="full",
+    mask_format="dense",
 ):
     """
     Postprocesses the output of Yolact on testing mode into a format that makes sense,
@@ -33,12 +38,26 @@ def postprocess(
         - h: The real height of the image.
         - batch_idx: If you have multiple images for this batch, the image's index in the batch.
         - interpolation_mode: Can be 'nearest' | 'area' | 'bilinear' (see torch.nn.functional.interpolate)
+        - score_threshold: Detections with a score at or below this are thrown out first.
+        - top_k: If not None, only the top_k highest scoring detections are kept, and masks are
+                 only built for those. If the scores get rescored by the maskiou_net, the top_k
+                 is taken after rescoring (but still before the masks are upsampled).
+        - lazy_masks: If True, return the masks as a LazyMasks that is only upsampled to the
+                      full image once it's materialized.
+        - mask_upsample: 'full' upsamples each mask to the whole image. 'roi' only upsamples the
+                         region of the image each (cropped) mask can cover, and returns the masks
+                         as ROIMasks (only for lincomb masks). The binarized masks are the same up to
+                         float rounding.
+        - mask_format: 'dense' returns the masks as a float tensor (or ROIMasks, see above), 'packed'
+                       as bit-packed PackedMasks and 'rle' as run-length encoded RLEMasks. Both are
+                       computed on the masks' device and are much smaller to copy to the host.
+                       Ignored if lazy_masks is True.
 
     Returns 4 torch Tensors (in the following order):
         - classes [num_det]: The class idx for each detection.
         - scores  [num_det]: The confidence score for each detection.
         - boxes   [num_det, 4]: The bounding box for each detection in absolute point form.
-        - masks   [num_det, h, w]: Full image masks for each detection.
+        - masks   [num_det, h, w]: Full image masks for each detection (or a LazyMasks).
     """
 
     dets = det_output[batch_idx]
@@ -46,7 +65,7 @@ def postprocess(
     dets = dets["detection"]
 
     if dets is None:
-        return [torch.Tensor()] * 4  # Warning, this is 4 copies of the same thing
+        return _empty_output(w, h, lazy_masks)
 
     if score_threshold > 0:
         keep = dets["score"] > score_threshold
@@ -56,7 +75,18 @@ def postprocess(
                 dets[k] = dets[k][keep]
 
         if dets["score"].size(0) == 0:
-            return [torch.Tensor()] * 4
+            return _empty_output(w, h, lazy_masks)
+
+    # If the maskiou_net changes the scores used for sorting, we can only take the top_k after it
+    use_lincomb = cfg.mask_type == mask_type.lincomb and cfg.eval_mask_branch
+    rescore = use_lincomb and cfg.use_maskiou and cfg.rescore_mask and cfg.rescore_bbox
+
+    if top_k is not None and not rescore:
+        idx = dets["score"].argsort(0, descending=True)[:top_k]
+
+        for k in dets:
+            if k != "proto":
+                dets[k] = dets[k][idx]
 
     # Actually extract everything from dets now
     classes = dets["class"]
@@ -64,7 +94,7 @@ def postprocess(
     scores = dets["score"]
     masks = dets["mask"]
 
-    if cfg.mask_type == mask_type.lincomb and cfg.eval_mask_branch:
+    if use_lincomb:
         # At this points masks is only the coefficients
         proto_data = dets["proto"]
 
@@ -98,13 +128,37 @@ def postprocess(
                         else:
                             scores = [scores, scores * maskiou_p]
 
+                    if top_k is not None and rescore:
+                        idx = scores.argsort(0, descending=True)[:top_k]
+                        classes, boxes, scores, masks = [
+                            x[idx] for x in (classes, boxes, scores, masks)
+                        ]
+
+        rois = None
+        if mask_upsample == "roi":
+            proto_h, proto_w = masks.size(1), masks.size(2)
+            rois = torch.zeros(masks.size(0), 4, dtype=torch.long)
+            rois[:, 2], rois[:, 3] = proto_w, proto_h
+
+            if crop_masks:
+                # The region of each proto mask that survived crop (see box_utils.crop)
+                x1, x2 = sanitize_coordinates(
+                    boxes[:, 0], boxes[:, 2], proto_w, 1, False
+                )
+                y1, y2 = sanitize_coordinates(
+                    boxes[:, 1], boxes[:, 3], proto_h, 1, False
+                )
+                rois[:, 0], rois[:, 1] = (
+                    x1.floor().long().cpu(),
+                    y1.floor().long().cpu(),
+                )
+                rois[:, 2], rois[:, 3] = x2.ceil().long().cpu(), y2.ceil().long().cpu()
+
         # Scale masks up to the full image
-        masks = F.interpolate(
-            masks.unsqueeze(0), (h, w), mode=interpolation_mode, align_corners=False
-        ).squeeze(0)
+        masks = LazyMasks(masks, h, w, interpolation_mode, rois)
 
-        # Binarize the masks
-        masks.gt_(0.5)
+        if not lazy_masks:
+            masks = masks.materialize_roi() if rois is not None else masks.materialize()
 
     boxes[:, 0], boxes[:, 2] = sanitize_coordinates(
         boxes[:, 0], boxes[:, 2], w, cast=False
@@ -115,29 +169,453 @@ def postprocess(
     boxes = boxes.long()
 
     if cfg.mask_type == mask_type.direct and cfg.eval_mask_branch:
-        # Upscale masks
-        full_masks = torch.zeros(masks.size(0), h, w)
+        # Upscale masks and paste them into their boxes, all at once
+        masks = paste_direct_masks(masks, boxes, h, w, interpolation_mode)
 
-        for jdx in range(masks.size(0)):
-            x1, y1, x2, y2 = boxes[jdx, :]
+        if lazy_masks:
+            masks = LazyMasks(masks, h, w)
 
-            mask_w = x2 - x1
-            mask_h = y2 - y1
+    if cfg.eval_mask_branch and not lazy_masks:
+        if mask_format == "packed":
+            masks = PackedMasks.from_masks(masks)
+        elif mask_format == "rle":
+            masks = RLEMasks.from_masks(masks)
 
-            # Just in case
-            if mask_w * mask_h <= 0 or mask_w < 0:
-                continue
+    return classes, scores, boxes, masks
 
-            mask = masks[jdx, :].view(1, 1, cfg.mask_size, cfg.mask_size)
+
+def paste_direct_masks(masks, boxes, h, w, interpolation_mode="bilinear"):
+    """
+    Resamples every [mask_size, mask_size] direct mask to the size of its box and pastes it into
+    an [h, w] image on the masks' device. For each detection, this is the same as F.interpolate-ing
+    the mask to (box_h, box_w) and binarizing it.
+
+    With bilinear interpolation, all of the masks are resampled with one grid_sample call over the
+    size of the biggest box (not the whole image). grid_sample can't do the other modes the way
+    F.interpolate does ('nearest' rounds instead of flooring and there's no 'area'), so for those
+    each mask gets interpolated on its own.
+
+    Args:
+        - masks: [num_dets, mask_size * mask_size] (or [num_dets, mask_size, mask_size]) masks.
+        - boxes: [num_dets, 4] long tensor of boxes in absolute point form.
+    Returns a [num_dets, h, w] float tensor of binarized masks.
+    """
+    num_dets = masks.size(0)
+    device = masks.device
+    masks = masks.view(num_dets, 1, cfg.mask_size, cfg.mask_size)
+    boxes = boxes.to(device)
+
+    box_w = boxes[:, 2] - boxes[:, 0]
+    box_h = boxes[:, 3] - boxes[:, 1]
+
+    # Empty boxes just get an empty mask
+    nonempty = (box_w > 0) & (box_h > 0)
+    if not nonempty.any():
+        return torch.zeros(num_dets, h, w, device=device)
+
+    if interpolation_mode != "bilinear":
+        full_masks = torch.zeros(num_dets, h, w, device=device)
+
+        for jdx in nonempty.nonzero()[:, 0].tolist():
+            x1, y1, x2, y2 = boxes[jdx, :].tolist()
             mask = F.interpolate(
-                mask, (mask_h, mask_w), mode=interpolation_mode, align_corners=False
+                masks[jdx : jdx + 1], (y2 - y1, x2 - x1), mode=interpolation_mode
             )
-            mask = mask.gt(0.5).float()
-            full_masks[jdx, y1:y2, x1:x2] = mask
+            full_masks[jdx, y1:y2, x1:x2] = mask[0, 0].gt(0.5).float()
+
+        return full_masks
+
+    max_w = int(box_w.max())
+    max_h = int(box_h.max())
+    xs = torch.arange(max_w, device=device)[None, None, :]
+    ys = torch.arange(max_h, device=device)[None, :, None]
+    box_w = box_w[:, None, None]
+    box_h = box_h[:, None, None]
+
+    # Sample each box's pixels relative to the box. With align_corners=False, these are the same points as
+    # interpolating to the box size, and the border padding mode matches how F.interpolate clamps the edges.
+    grid_x = (2 * xs + 1).float() / box_w.float().clamp(min=1) - 1
+    grid_y = (2 * ys + 1).float() / box_h.float().clamp(min=1) - 1
+    grid = torch.stack(
+        [grid_x.expand(-1, max_h, -1), grid_y.expand(-1, -1, max_w)], dim=3
+    )
 
-        masks = full_masks
+    patches = F.grid_sample(
+        masks, grid, mode="bilinear", padding_mode="border", align_corners=False
+    ).squeeze(1)
+
+    # Paste every patch into its box at once. The parts of the patches outside of their own box get
+    # written to one extra element at the end, which is then thrown away.
+    x1 = boxes[:, 0, None, None]
+    y1 = boxes[:, 1, None, None]
+    det_idx = torch.arange(num_dets, device=device)[:, None, None]
+    idx = (det_idx * h + y1 + ys) * w + x1 + xs
+    idx = torch.where(
+        (xs < box_w) & (ys < box_h), idx, torch.full_like(idx, num_dets * h * w)
+    )
 
-    return classes, scores, boxes, masks
+    full_masks = torch.zeros(num_dets * h * w + 1, device=device)
+    full_masks[idx.view(-1)] = patches.gt(0.5).float().view(-1)
+
+    return full_masks[:-1].view(num_dets, h, w)
+
+
+def _empty_output(w, h, lazy_masks=False):
+    """ What postprocess returns when there are no detections. """
+    if lazy_masks:
+        return [torch.Tensor()] * 3 + [LazyMasks(torch.Tensor(), h, w)]
+    else:
+        return [torch.Tensor()] * 4  # Warning, this is 4 copies of the same thing
+
+
+class LazyMasks:
+    """
+    Full image masks that are only scaled up to (h, w) and binarized when materialized.
+    Indexing a LazyMasks gives another LazyMasks, so you can select the detections you
+    need first and only pay for upsampling those.
+    """
+
+    def __init__(self, masks, h, w, interpolation_mode="bilinear", rois=None):
+        """
+        masks should be a size [num_dets, mask_h, mask_w] tensor. If rois is not None, it
+        should be a size [num_dets, 4] cpu long tensor of the (x1, y1, x2, y2) region of each
+        mask (in mask coordinates) outside of which the mask is 0. Then each mask is only
+        upsampled inside that region.
+        """
+        self.masks = masks
+        self.h = h
+        self.w = w
+        self.interpolation_mode = interpolation_mode
+        self.rois = rois
+
+    def __len__(self):
+        return self.masks.size(0)
+
+    def size(self, dim=None):
+        size = torch.Size((len(self), self.h, self.w))
+        return size if dim is None else size[dim]
+
+    def __getitem__(self, idx):
+        rois = None if self.rois is None else self.rois[_cpu_index(idx)]
+        return LazyMasks(self.masks[idx], self.h, self.w, self.interpolation_mode, rois)
+
+    def materialize(self):
+        """ Returns the binarized [num_dets, h, w] masks. """
+        if self.rois is not None:
+            return self.materialize_roi().to_dense()
+
+        if self.masks.numel() == 0:
+            return torch.zeros(0, self.h, self.w, device=self.masks.device)
+
+        if self.masks.shape[1:] == (self.h, self.w):
+            return self.masks.gt(0.5).float()
+
+        masks = F.interpolate(
+            self.masks.unsqueeze(0),
+            (self.h, self.w),
+            mode=self.interpolation_mode,
+            align_corners=False,
+        ).squeeze(0)
+
+        # Binarize the masks
+        return masks.gt_(0.5)
+
+    def materialize_roi(self):
+        """
+        Returns the binarized masks as ROIMasks, computing each one only in the part of the
+        image that its roi can affect. Other than float rounding, this gives the same masks as
+        materialize does with bilinear upsampling.
+        """
+        if self.interpolation_mode != "bilinear":
+            raise ValueError("ROI upsampling only supports bilinear interpolation.")
+
+        if self.masks.numel() == 0:
+            return ROIMasks([], torch.zeros(0, 4, dtype=torch.long), self.h, self.w)
+
+        mask_h, mask_w = self.masks.size(1), self.masks.size(2)
+        rois = self.rois
+        if rois is None:
+            rois = torch.LongTensor([[0, 0, mask_w, mask_h]]).repeat(len(self), 1)
+
+        out_rois = rois.clone()
+        out_rois[:, 0], out_rois[:, 2] = _upsample_range(
+            rois[:, 0], rois[:, 2], mask_w, self.w
+        )
+        out_rois[:, 1], out_rois[:, 3] = _upsample_range(
+            rois[:, 1], rois[:, 3], mask_h, self.h
+        )
+
+        patches = []
+        for mask, (x1, y1, x2, y2) in zip(self.masks, out_rois.tolist()):
+            # Resample the columns first and then the rows, like F.interpolate does
+            x0, x1_idx, x_weight = _bilinear_indices(
+                x1, x2, mask_w, self.w, mask.device
+            )
+            y0, y1_idx, y_weight = _bilinear_indices(
+                y1, y2, mask_h, self.h, mask.device
+            )
+
+            cols = mask[:, x0] * (1 - x_weight) + mask[:, x1_idx] * x_weight
+            patch = (1 - y_weight)[:, None] * cols[y0] + y_weight[:, None] * cols[
+                y1_idx
+            ]
+            patches.append(patch.gt_(0.5))
+
+        return ROIMasks(patches, out_rois, self.h, self.w)
+
+
+class ROIMasks:
+    """
+    Binarized full image masks, stored as one patch per detection along with the region
+    (x1, y1, x2, y2) of the image each patch covers. Everything outside a patch is 0.
+    """
+
+    def __init__(self, patches, rois, h, w):
+        self.patches = patches
+        self.rois = rois
+        self.h = h
+        self.w = w
+
+    def __len__(self):
+        return len(self.patches)
+
+    def size(self, dim=None):
+        size = torch.Size((len(self), self.h, self.w))
+        return size if dim is None else size[dim]
+
+    def __getitem__(self, idx):
+        idx = torch.arange(len(self))[_cpu_index(idx)].view(-1)
+        patches = [self.patches[i] for i in idx.tolist()]
+        return ROIMasks(patches, self.rois[idx], self.h, self.w)
+
+    def cpu(self):
+        return ROIMasks([x.cpu() for x in self.patches], self.rois, self.h, self.w)
+
+    def to_dense(self):
+        """ Pastes the patches into a [num_dets, h, w] tensor. """
+        device = self.patches[0].device if len(self) > 0 else None
+        out = torch.zeros(len(self), self.h, self.w, device=device)
+
+        for out_mask, patch, (x1, y1, x2, y2) in zip(
+            out, self.patches, self.rois.tolist()
+        ):
+            out_mask[y1:y2, x1:x2] = patch
+
+        return out
+
+
+class PackedMasks:
+    """
+    Binarized [num_dets, h, w] masks with each mask bit-packed (row-major, in the same bit order as
+    np.packbits) into a [num_dets, ceil(h*w / 8)] uint8 tensor. That's 32x smaller than floats.
+    """
+
+    def __init__(self, bits, h, w):
+        self.bits = bits
+        self.h = h
+        self.w = w
+
+    @staticmethod
+    def from_masks(masks):
+        """ Packs a [num_dets, h, w] tensor of binary masks or an ROIMasks. """
+        if isinstance(masks, ROIMasks):
+            masks = masks.to_dense()
+
+        num_dets, h, w = masks.size()
+        flat = (masks.reshape(num_dets, -1) > 0.5).to(torch.uint8)
+        flat = F.pad(flat, (0, -(h * w) % 8)).view(num_dets, -1, 8)
+
+        weights = torch.tensor(
+            [128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=masks.device
+        )
+        return PackedMasks((flat * weights).sum(dim=2).to(torch.uint8), h, w)
+
+    def __len__(self):
+        return self.bits.size(0)
+
+    def size(self, dim=None):
+        size = torch.Size((len(self), self.h, self.w))
+        return size if dim is None else size[dim]
+
+    def __getitem__(self, idx):
+        return PackedMasks(self.bits[idx].view(-1, self.bits.size(1)), self.h, self.w)
+
+    def cpu(self):
+        return PackedMasks(self.bits.cpu(), self.h, self.w)
+
+    def to_dense(self):
+        """ Unpacks into a float [num_dets, h, w] tensor on the same device. """
+        shifts = torch.arange(7, -1, -1, device=self.bits.device).to(torch.uint8)
+        flat = (self.bits[:, :, None] >> shifts) & 1
+        flat = flat.view(len(self), -1)[:, : self.h * self.w]
+        return flat.view(len(self), self.h, self.w).float()
+
+
+class RLEMasks:
+    """
+    Binarized [num_dets, h, w] masks as column-major run lengths (the same runs as a COCO RLE),
+    stored as one flat tensor of run lengths and the offset of each mask's runs in it. As in
+    COCO, each mask's runs start with a run of 0s, and then alternate.
+    """
+
+    def __init__(self, counts, offsets, h, w):
+        """ counts is a 1d long tensor on any device, offsets a [num_dets + 1] list of ints. """
+        self.counts = counts
+        self.offsets = offsets
+        self.h = h
+        self.w = w
+
+    @staticmethod
+    def from_masks(masks):
+        """
+        Encodes a [num_dets, h, w] tensor of binary masks or an ROIMasks on their device. For an
+        ROIMasks only each patch gets looked at, since the runs outside of it are known.
+        """
+        if isinstance(masks, ROIMasks):
+            patches, rois, h, w = masks.patches, masks.rois, masks.h, masks.w
+        else:
+            num_dets, h, w = masks.size()
+            patches = list(masks)
+            rois = torch.LongTensor([[0, 0, w, h]]).repeat(num_dets, 1)
+
+        counts = []
+        offsets = [0]
+
+        for patch, (x1, y1, x2, y2) in zip(patches, rois.tolist()):
+            device = patch.device
+
+            # Pad each column with a 0 above and below so every run in it starts and ends
+            cols = F.pad((patch > 0.5).t().to(torch.uint8), (1, 1))
+            col_idx, row_idx = (cols[:, 1:] != cols[:, :-1]).nonzero().t()
+            changes = (x1 + col_idx) * h + y1 + row_idx
+
+            # For patches as tall as the image, a run from the bottom of one column into the top
+            # of the next shows up as two changes at the same spot, which cancel out.
+            if y1 == 0 and y2 == h and changes.size(0) > 0:
+                changes, num = torch.unique_consecutive(changes, return_counts=True)
+                changes = changes[num == 1]
+
+            # A run going all the way to the end of the image is closed by the end of the image
+            changes = changes[changes < h * w]
+
+            bounds = torch.cat(
+                [
+                    torch.zeros(1, dtype=torch.long, device=device),
+                    changes,
+                    torch.full((1,), h * w, dtype=torch.long, device=device),
+                ]
+            )
+            counts.append(bounds[1:] - bounds[:-1])
+            offsets.append(offsets[-1] + counts[-1].size(0))
+
+        if len(counts) == 0:
+            return RLEMasks(torch.zeros(0, dtype=torch.long), offsets, h, w)
+
+        return RLEMasks(torch.cat(counts), offsets, h, w)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def size(self, dim=None):
+        size = torch.Size((len(self), self.h, self.w))
+        return size if dim is None else size[dim]
+
+    def __getitem__(self, idx):
+        idx = torch.arange(len(self))[_cpu_index(idx)].view(-1).tolist()
+        counts = [self.counts[self.offsets[i] : self.offsets[i + 1]] for i in idx]
+        offsets = np.cumsum([0] + [x.size(0) for x in counts]).tolist()
+
+        if len(counts) == 0:
+            return RLEMasks(self.counts[:0], offsets, self.h, self.w)
+
+        return RLEMasks(torch.cat(counts), offsets, self.h, self.w)
+
+    def cpu(self):
+        return RLEMasks(self.counts.cpu(), self.offsets, self.h, self.w)
+
+    def to_coco(self):
+        """ Returns a list of compressed COCO RLEs (with str counts, so they're json-able). """
+        counts = self.counts.tolist()
+        rles = []
+
+        for i in range(len(self)):
+            rle = pycocotools.mask.frPyObjects(
+                {
+                    "counts": counts[self.offsets[i] : self.offsets[i + 1]],
+                    "size": [self.h, self.w],
+                },
+                self.h,
+                self.w,
+            )
+            rle["counts"] = rle["counts"].decode("ascii")
+            rles.append(rle)
+
+        return rles
+
+    def iou(self, other, iscrowd=False):
+        """
+        Pairwise mask IoU with another RLEMasks as a [len(self), len(other)] float tensor. If
+        iscrowd, the other masks are crowds (so this is intersection over the area of self).
+        """
+        if len(self) == 0 or len(other) == 0:
+            return torch.zeros(len(self), len(other))
+
+        ious = pycocotools.mask.iou(
+            self.to_coco(), other.to_coco(), [int(iscrowd)] * len(other)
+        )
+        return torch.from_numpy(ious).float()
+
+    def to_dense(self):
+        """ Decodes into a float [num_dets, h, w] tensor on the same device. """
+        device = self.counts.device
+        runs_per_mask = torch.tensor(np.diff(self.offsets), device=device)
+        offsets = torch.tensor(self.offsets[:-1], dtype=torch.long, device=device)
+
+        # Every other run is 1s, starting with the second run of each mask
+        mask_idx = torch.arange(len(self), device=device).repeat_interleave(
+            runs_per_mask
+        )
+        values = (
+            torch.arange(self.counts.size(0), device=device) - offsets[mask_idx]
+        ) % 2
+
+        flat = values.repeat_interleave(self.counts)
+        return flat.view(len(self), self.w, self.h).transpose(1, 2).float()
+
+
+def _cpu_index(idx):
+    """ Moves tensor indices to the cpu so they can index cpu tensors. """
+    return idx.cpu() if isinstance(idx, torch.Tensor) else idx
+
+
+def _source_coords(dst, in_size, out_size):
+    """ Where each output pixel samples the input, for F.interpolate with align_corners=False. """
+    scale = torch.tensor(in_size, dtype=torch.float) / out_size
+
+    # Pytorch computes this with a fused multiply-add, so only round to float at the end
+    src = (dst.double() + 0.5) * scale.item() - 0.5
+    return src.float().clamp(min=0)
+
+
+def _upsample_range(lo, hi, in_size, out_size):
+    """
+    Given that an input is 0 outside of [lo, hi), returns the range of output pixels that
+    bilinear upsampling could make nonzero. This is padded by a pixel on each side to be safe.
+    """
+    scale = out_size / in_size
+    out_lo = ((lo.double() - 0.5) * scale - 0.5).floor().long() - 1
+    out_hi = ((hi.double() + 0.5) * scale - 0.5).ceil().long() + 1
+    return out_lo.clamp(0, out_size), torch.max(out_lo, out_hi).clamp(0, out_size)
+
+
+def _bilinear_indices(lo, hi, in_size, out_size, device):
+    """ The two input pixels and the weight of the second for output pixels [lo, hi). """
+    src = _source_coords(
+        torch.arange(lo, hi, device=device, dtype=torch.float), in_size, out_size
+    )
+    idx0 = src.long()
+    idx1 = (idx0 + 1).clamp(max=in_size - 1)
+    return idx0, idx1, src - idx0.float()
 
 
 def undo_image_transformation(img, w, h):
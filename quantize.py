@@ -0,0 +1,94 @@
+"""
+Quantizes a trained model to int8 for CPU inference and saves it. The activation ranges are calibrated on
+images from the validation set. Evaluate the result (and compare it to the fp32 model) with
+
+    python eval.py --trained_model=<fp32 model> --quantize=True --quantized_model=<output> --cuda=False
+"""
+
+from data import COCODetection, cfg, set_cfg, set_dataset
+from yolact import Yolact
+from utils.augmentations import BaseTransform
+from utils.functions import SavePath
+from utils.quantization import quantize, save_quantized
+
+import argparse
+import os
+import torch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YOLACT int8 Quantization")
+    parser.add_argument(
+        "--trained_model",
+        default="weights/yolact_base_54_800000.pth",
+        type=str,
+        help="The fp32 model to quantize.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        type=str,
+        help="Where to save the int8 model. Defaults to the trained model's path with _int8 added to the name.",
+    )
+    parser.add_argument(
+        "--calib_images",
+        default=100,
+        type=int,
+        help="The number of validation images to calibrate the activation ranges on.",
+    )
+    parser.add_argument(
+        "--cpu_threads",
+        default=0,
+        type=int,
+        help="The number of threads Pytorch should use. Use 0 for Pytorch's default.",
+    )
+    parser.add_argument("--config", default=None, help="The config object to use.")
+    parser.add_argument(
+        "--dataset",
+        default=None,
+        type=str,
+        help="If specified, override the dataset specified in the config with this one (example: coco2017_dataset).",
+    )
+
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.config is None:
+        model_path = SavePath.from_str(args.trained_model)
+        args.config = model_path.model_name + "_config"
+        print("Config not specified. Parsed %s from the file name.\n" % args.config)
+    set_cfg(args.config)
+
+    if args.dataset is not None:
+        set_dataset(args.dataset)
+
+    if args.output is None:
+        args.output = os.path.splitext(args.trained_model)[0] + "_int8.pth"
+
+    torch.set_default_tensor_type("torch.FloatTensor")
+    if args.cpu_threads > 0:
+        torch.set_num_threads(args.cpu_threads)
+
+    dataset = COCODetection(
+        cfg.dataset.valid_images,
+        cfg.dataset.valid_info,
+        transform=BaseTransform(),
+        has_gt=cfg.dataset.has_gt,
+    )
+
+    print("Loading model...", end="")
+    net = Yolact()
+    net.load_weights(args.trained_model)
+    net.eval()
+    print(" Done.")
+
+    print("Calibrating on %d images..." % args.calib_images, end="")
+    with torch.no_grad():
+        quantize(net, dataset, args.calib_images)
+    print(" Done.")
+
+    save_quantized(net, args.output)
+    print("Saved the int8 model to %s" % args.output)
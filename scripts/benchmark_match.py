@@ -0,0 +1,99 @@
+"""
+Micro-benchmark for the part of layers/box_utils.match that forces every gt to get a prior. Compares the
+batched force_match to the one gt at a time force_match_sequential on random gt boxes (checking that both
+give the same result) against a config's priors, for increasingly crowded images.
+
+Usage (from the Yolact root directory):
+    python scripts/benchmark_match.py [config] [iterations]
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import torch
+from data import cfg, set_cfg
+from yolact import Yolact
+from layers.box_utils import force_match, force_match_sequential, jaccard, point_form
+
+config = sys.argv[1] if len(sys.argv) > 1 else "yolact_base_config"
+iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+num_objects_list = [5, 20, 50, 100]
+
+set_cfg(config)
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def sync():
+    if device == "cuda":
+        torch.cuda.synchronize()
+
+
+def random_boxes(num_objects):
+    """ Random gt boxes in point form, with sizes anywhere from tiny to half the image. """
+    centers = torch.rand(num_objects, 2, device=device)
+    sizes = torch.rand(num_objects, 2, device=device) * 0.5 + 0.01
+    return torch.cat((centers - sizes / 2, centers + sizes / 2), 1).clamp(0, 1)
+
+
+def time_force_match(fn, overlaps):
+    """ Returns the average time per call in ms and the result of the last call. """
+    total = 0
+    for _ in range(iterations):
+        args = overlaps.clone(), *overlaps.max(0)
+
+        sync()
+        start = time.perf_counter()
+        fn(*args)
+        sync()
+        total += time.perf_counter() - start
+
+    return total / iterations * 1000, args[1:]
+
+
+# The priors are made in the forward pass
+net = Yolact().to(device)
+net.train()
+with torch.no_grad():
+    priors = net(torch.zeros(1, 3, cfg.max_size, cfg.max_size, device=device))["priors"]
+priors = point_form(priors)
+
+print(
+    "%s: %d priors on %s, %d iterations\n"
+    % (config, priors.size(0), device, iterations)
+)
+print(
+    " %11s | %15s | %12s | %7s | %s"
+    % ("num_objects", "sequential (ms)", "batched (ms)", "speedup", "same")
+)
+print("-------------+-----------------+--------------+---------+------")
+
+for num_objects in num_objects_list:
+    overlaps = jaccard(random_boxes(num_objects), priors)
+
+    sequential_time, sequential_out = time_force_match(force_match_sequential, overlaps)
+    batched_time, batched_out = time_force_match(force_match, overlaps)
+
+    same = all(torch.equal(x, y) for x, y in zip(sequential_out, batched_out))
+    print(
+        " %11d | %15.3f | %12.3f | %6.1fx | %s"
+        % (
+            num_objects,
+            sequential_time,
+            batched_time,
+            sequential_time / batched_time,
+            same,
+        )
+    )
+
+# With more gts than priors, some gts can't get a prior of their own, so check that both agree there too
+same = True
+for seed in range(100):
+    torch.manual_seed(seed)
+    overlaps = jaccard(random_boxes(10), random_boxes(3))
+
+    _, sequential_out = time_force_match(force_match_sequential, overlaps)
+    _, batched_out = time_force_match(force_match, overlaps)
+    same &= all(torch.equal(x, y) for x, y in zip(sequential_out, batched_out))
+
+print("\nMore gts than priors (10 gts, 3 priors, 100 seeds) same: %s" % same)
@@ -0,0 +1,26 @@
+"""
+Converts a .pth weights file to the memory-mapped format in utils/mmap_weights.py, which loads in no time
+and is shared between every process that loads it. Use the output anywhere a .pth goes (e.g., eval.py's
+--trained_model).
+
+Usage (from the Yolact root directory):
+    python scripts/convert_to_mmap.py weights/yolact_base_54_800000.pth [weights/yolact_base_54_800000.mm]
+"""
+
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import torch
+from utils.mmap_weights import extension, save_mmap_state_dict
+
+in_path = sys.argv[1]
+out_path = (
+    sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(in_path)[0] + extension
+)
+
+print("Loading state dict...")
+state_dict = torch.load(in_path, map_location="cpu")
+
+print("Saving to %s..." % out_path)
+save_mmap_state_dict(state_dict, out_path)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules in this repo are imported relative to its root (e.g. "from data import cfg")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
@@ -0,0 +1,45 @@
+""" Checks the batched forced matching in match() against the one gt at a time loop, on random overlaps. """
+
+import pytest
+import torch
+
+from layers.box_utils import force_match, force_match_sequential, jaccard
+
+
+def random_boxes(num_boxes, gen):
+    centers = torch.rand(num_boxes, 2, generator=gen)
+    sizes = torch.rand(num_boxes, 2, generator=gen) * 0.5 + 0.01
+    return torch.cat((centers - sizes / 2, centers + sizes / 2), 1).clamp(0, 1)
+
+
+def assert_same_force_match(overlaps):
+    """ Runs both versions on the same overlaps and initial matches. """
+    results = []
+
+    for fn in (force_match, force_match_sequential):
+        best_truth_overlap, best_truth_idx = overlaps.max(0)
+        fn(overlaps.clone(), best_truth_overlap, best_truth_idx)
+        results.append((best_truth_overlap, best_truth_idx))
+
+    (overlap, idx), (ref_overlap, ref_idx) = results
+    assert torch.equal(overlap, ref_overlap)
+    assert torch.equal(idx, ref_idx)
+
+
+@pytest.mark.parametrize("seed", range(100))
+@pytest.mark.parametrize(
+    "num_objects, num_priors", [(1, 50), (20, 300), (10, 3), (7, 7)]
+)
+def test_force_match_matches_sequential(seed, num_objects, num_priors):
+    gen = torch.Generator().manual_seed(seed)
+    overlaps = jaccard(random_boxes(num_objects, gen), random_boxes(num_priors, gen))
+    assert_same_force_match(overlaps)
+
+
+@pytest.mark.parametrize("seed", range(100))
+@pytest.mark.parametrize("num_objects, num_priors", [(20, 30), (10, 3), (5, 5)])
+def test_force_match_ties(seed, num_objects, num_priors):
+    # Only a few distinct overlaps, so lots of gts and priors tie
+    gen = torch.Generator().manual_seed(seed)
+    overlaps = torch.randint(4, (num_objects, num_priors), generator=gen).float() / 4
+    assert_same_force_match(overlaps)
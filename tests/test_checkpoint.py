@@ -0,0 +1,78 @@
+""" Checks that activation checkpointing doesn't change gradients or batch norm stats. """
+
+import pytest
+import torch
+import torch.nn as nn
+
+from backbone import ResNetBackbone
+from utils.functions import checkpoint_module
+
+
+def run(module, x, checkpoint):
+    """ One training step's forward and backward. Returns the input gradient. """
+    x = x.clone().requires_grad_()
+    outs = checkpoint_module(module, x) if checkpoint else module(x)
+    outs = outs if isinstance(outs, (list, tuple)) else [outs]
+
+    sum(
+        (out * torch.linspace(-1, 1, out.numel()).view_as(out)).sum() for out in outs
+    ).backward()
+    return x.grad
+
+
+def assert_same_state(module, ref):
+    for (name, param), ref_param in zip(module.named_parameters(), ref.parameters()):
+        assert torch.equal(param.grad, ref_param.grad), name
+
+    for (name, buffer), ref_buffer in zip(module.named_buffers(), ref.buffers()):
+        assert torch.equal(buffer, ref_buffer), name
+
+
+def conv_bn(scripted):
+    """
+    A small conv / batch norm net, or like the FPN a TorchScript one without batch norms (non-reentrant
+    checkpointing can't recompute batch norms inside TorchScript in training mode).
+    """
+    if scripted:
+        return torch.jit.script(
+            nn.Sequential(
+                nn.Conv2d(3, 8, 3, padding=1), nn.ReLU(), nn.Conv2d(8, 4, 3, stride=2),
+            )
+        )
+
+    return nn.Sequential(
+        nn.Conv2d(3, 8, 3, padding=1),
+        nn.BatchNorm2d(8),
+        nn.ReLU(),
+        nn.Conv2d(8, 4, 3, stride=2),
+        nn.BatchNorm2d(4),
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("scripted", [False, True])
+def test_checkpoint_module_matches_plain(seed, scripted):
+    # Make the same net twice (deepcopy doesn't copy TorchScript modules properly)
+    torch.manual_seed(seed)
+    ref = conv_bn(scripted).train()
+    torch.manual_seed(seed)
+    module = conv_bn(scripted).train()
+    x = torch.randn(2, 3, 17, 19)
+
+    # Two steps, so the second one starts from running stats the first one updated
+    for _ in range(2):
+        assert torch.equal(run(module, x, True), run(ref, x, False))
+    assert_same_state(module, ref)
+
+
+@pytest.mark.parametrize("checkpoint_layers", [[0], [1, 3], [0, 1, 2, 3]])
+def test_checkpointed_backbone_matches_plain(checkpoint_layers):
+    torch.manual_seed(0)
+    ref = ResNetBackbone([1, 1, 1, 1]).train()
+    torch.manual_seed(0)
+    backbone = ResNetBackbone([1, 1, 1, 1]).train()
+    backbone.checkpoint_layers = checkpoint_layers
+    x = torch.randn(2, 3, 64, 64)
+
+    assert torch.equal(run(backbone, x, False), run(ref, x, False))
+    assert_same_state(backbone, ref)
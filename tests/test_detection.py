@@ -0,0 +1,236 @@
+""" Checks the batched Detect against the per-image version it replaced, on random predictions. """
+
+import numpy as np
+import pytest
+import torch
+
+from data import cfg
+from layers.box_utils import decode, jaccard
+from layers.functions.detection import Detect
+
+num_classes = 5
+conf_thresh = 0.05
+nms_thresh = 0.5
+top_k = 200
+
+
+def old_fast_nms(boxes, masks, scores):
+    scores, idx = scores.sort(1, descending=True)
+
+    idx = idx[:, :top_k].contiguous()
+    scores = scores[:, :top_k]
+
+    num_classes, num_dets = idx.size()
+
+    boxes = boxes[idx.view(-1), :].view(num_classes, num_dets, 4)
+    masks = masks[idx.view(-1), :].view(num_classes, num_dets, -1)
+
+    iou = jaccard(boxes, boxes)
+    iou.triu_(diagonal=1)
+    iou_max, _ = iou.max(dim=1)
+
+    keep = iou_max <= nms_thresh
+
+    classes = torch.arange(num_classes)[:, None].expand_as(keep)
+    classes = classes[keep]
+
+    boxes = boxes[keep]
+    masks = masks[keep]
+    scores = scores[keep]
+
+    scores, idx = scores.sort(0, descending=True)
+    idx = idx[: cfg.max_num_detections]
+    scores = scores[: cfg.max_num_detections]
+
+    return boxes[idx], masks[idx], classes[idx], scores
+
+
+def old_cc_fast_nms(boxes, masks, scores):
+    scores, classes = scores.max(dim=0)
+
+    _, idx = scores.sort(0, descending=True)
+    idx = idx[:top_k]
+
+    boxes_idx = boxes[idx]
+
+    iou = jaccard(boxes_idx, boxes_idx)
+    iou.triu_(diagonal=1)
+    iou_max, _ = torch.max(iou, dim=0)
+
+    idx_out = idx[iou_max <= nms_thresh]
+
+    return boxes[idx_out], masks[idx_out], classes[idx_out], scores[idx_out]
+
+
+def cython_nms(dets, thresh):
+    """ A straight port of the greedy utils/cython_nms.pyx that traditional_nms used to build. """
+    x1, y1, x2, y2, scores = dets.T
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    order = scores.argsort()[::-1]
+    suppressed = np.zeros(dets.shape[0], dtype=bool)
+
+    for _i, i in enumerate(order):
+        if suppressed[i]:
+            continue
+
+        for j in order[_i + 1 :]:
+            if suppressed[j]:
+                continue
+
+            w = max(np.float32(0), min(x2[i], x2[j]) - max(x1[i], x1[j]) + 1)
+            h = max(np.float32(0), min(y2[i], y2[j]) - max(y1[i], y1[j]) + 1)
+            inter = w * h
+            if inter / (areas[i] + areas[j] - inter) >= thresh:
+                suppressed[j] = True
+
+    return np.where(~suppressed)[0]
+
+
+def old_traditional_nms(boxes, masks, scores):
+    idx_lst = []
+    cls_lst = []
+    scr_lst = []
+
+    boxes = boxes * cfg.max_size
+
+    for _cls in range(scores.size(0)):
+        cls_scores = scores[_cls, :]
+        conf_mask = cls_scores > conf_thresh
+        idx = torch.arange(cls_scores.size(0))
+
+        cls_scores = cls_scores[conf_mask]
+        idx = idx[conf_mask]
+
+        if cls_scores.size(0) == 0:
+            continue
+
+        preds = torch.cat([boxes[conf_mask], cls_scores[:, None]], dim=1).numpy()
+        keep = torch.from_numpy(cython_nms(preds, np.float32(nms_thresh)))
+
+        idx_lst.append(idx[keep])
+        cls_lst.append(keep * 0 + _cls)
+        scr_lst.append(cls_scores[keep])
+
+    idx = torch.cat(idx_lst, dim=0)
+    classes = torch.cat(cls_lst, dim=0)
+    scores = torch.cat(scr_lst, dim=0)
+
+    scores, idx2 = scores.sort(0, descending=True)
+    idx2 = idx2[: cfg.max_num_detections]
+    scores = scores[: cfg.max_num_detections]
+
+    idx = idx[idx2]
+    classes = classes[idx2]
+
+    return boxes[idx] / cfg.max_size, masks[idx], classes, scores
+
+
+def old_detect(predictions, nms):
+    """ The old Detect.__call__, which decoded and ran NMS on one image at a time. """
+    loc_data = predictions["loc"]
+    batch_size, num_priors = loc_data.size(0), loc_data.size(1)
+    conf_preds = (
+        predictions["conf"]
+        .view(batch_size, num_priors, num_classes)
+        .transpose(2, 1)
+        .contiguous()
+    )
+
+    out = []
+    for batch_idx in range(batch_size):
+        decoded_boxes = decode(loc_data[batch_idx], predictions["priors"])
+        cur_scores = conf_preds[batch_idx, 1:, :]
+        conf_scores, _ = torch.max(cur_scores, dim=0)
+
+        keep = conf_scores > conf_thresh
+        scores = cur_scores[:, keep]
+
+        if scores.size(1) == 0:
+            out.append(None)
+            continue
+
+        boxes, masks, classes, scores = nms(
+            decoded_boxes[keep, :], predictions["mask"][batch_idx, keep, :], scores
+        )
+        out.append({"box": boxes, "mask": masks, "class": classes, "score": scores})
+
+    return out
+
+
+def random_predictions(seed, batch_size=3, mask_dim=4):
+    """ Predictions with lots of overlapping boxes, where the last image has nothing over conf_thresh. """
+    gen = torch.Generator().manual_seed(seed)
+    num_priors = 20 + 60 * (seed % 5)
+
+    # Cluster the priors around a few centers so that NMS has something to suppress
+    centers = torch.rand(4, 2, generator=gen)[
+        torch.randint(4, (num_priors,), generator=gen)
+    ]
+    priors = torch.cat(
+        [
+            centers + torch.randn(num_priors, 2, generator=gen) * 0.03,
+            torch.rand(num_priors, 2, generator=gen) * 0.3 + 0.05,
+        ],
+        dim=1,
+    )
+
+    conf = torch.randn(batch_size, num_priors, num_classes, generator=gen) * 2
+    conf[:, :, 0] += 2
+    conf[-1, :, 0] += 100
+
+    return {
+        "loc": torch.randn(batch_size, num_priors, 4, generator=gen) * 0.1,
+        "conf": conf.softmax(dim=2),
+        "mask": torch.randn(batch_size, num_priors, mask_dim, generator=gen),
+        "priors": priors,
+    }
+
+
+def assert_same_dets(out, ref, box_round_trip=False):
+    """ If box_round_trip, ref's boxes were multiplied and divided by max_size, so may be off by a rounding error. """
+    assert len(out) == len(ref)
+
+    for result, ref_dets in zip(out, ref):
+        dets = result["detection"]
+
+        if ref_dets is None:
+            assert dets is None
+            continue
+
+        for k in ("mask", "class", "score"):
+            assert torch.equal(dets[k], ref_dets[k]), k
+
+        if box_round_trip:
+            assert torch.allclose(dets["box"], ref_dets["box"], rtol=1e-6, atol=1e-7)
+        else:
+            assert torch.equal(dets["box"], ref_dets["box"])
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("cross_class", [False, True])
+def test_batched_fast_nms_matches_per_image(seed, cross_class):
+    detect = Detect(num_classes, 0, top_k, conf_thresh, nms_thresh)
+    detect.use_fast_nms = True
+    detect.use_cross_class_nms = cross_class
+
+    predictions = random_predictions(seed)
+    ref = old_detect(predictions, old_cc_fast_nms if cross_class else old_fast_nms)
+
+    assert_same_dets(detect(predictions, None), ref)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("chunk_size", [5, 37, 1024])
+@pytest.mark.parametrize("max_num_detections", [10, 100, 1000])
+def test_traditional_nms_matches_cython(
+    seed, chunk_size, max_num_detections, monkeypatch
+):
+    monkeypatch.setattr(cfg, "max_num_detections", max_num_detections)
+
+    detect = Detect(num_classes, 0, top_k, conf_thresh, nms_thresh)
+    detect.nms_chunk_size = chunk_size
+
+    predictions = random_predictions(seed)
+    ref = old_detect(predictions, old_traditional_nms)
+
+    assert_same_dets(detect(predictions, None), ref, box_round_trip=True)
@@ -0,0 +1,134 @@
+""" Checks the vectorized eval metrics against the loops they replaced, on random inputs. """
+
+import numpy as np
+import pytest
+
+from eval import APDataObject, iou_thresholds, match_dets
+
+
+def loop_match_dets(
+    iou, crowd_iou, pred_classes, gt_classes, crowd_classes, indices, thresholds
+):
+    """ The per-class, per-threshold matching loop prep_metrics used to run. """
+    num_pred, num_gt = iou.shape
+    is_true = np.zeros((len(thresholds), num_pred), dtype=bool)
+    is_ignored = np.zeros_like(is_true)
+
+    for _class in set(list(pred_classes) + list(gt_classes)):
+        for iouIdx, iou_threshold in enumerate(thresholds):
+            gt_used = [False] * num_gt
+
+            for i in indices:
+                if pred_classes[i] != _class:
+                    continue
+
+                max_iou_found = iou_threshold
+                max_match_idx = -1
+                for j in range(num_gt):
+                    if gt_used[j] or gt_classes[j] != _class:
+                        continue
+
+                    if iou[i, j] > max_iou_found:
+                        max_iou_found = iou[i, j]
+                        max_match_idx = j
+
+                if max_match_idx >= 0:
+                    gt_used[max_match_idx] = True
+                    is_true[iouIdx, i] = True
+                elif crowd_iou is not None:
+                    for j in range(len(crowd_classes)):
+                        if (
+                            crowd_classes[j] == _class
+                            and crowd_iou[i, j] > iou_threshold
+                        ):
+                            is_ignored[iouIdx, i] = True
+                            break
+
+    return is_true, is_ignored
+
+
+def loop_get_ap(data_points, num_gt_positives):
+    """ APDataObject.get_ap as it was with a list of (score, is_true) tuples. """
+    if num_gt_positives == 0:
+        return 0
+
+    data_points = sorted(data_points, key=lambda x: -x[0])
+
+    precisions = []
+    recalls = []
+    num_true = 0
+    num_false = 0
+
+    for datum in data_points:
+        if datum[1]:
+            num_true += 1
+        else:
+            num_false += 1
+
+        precisions.append(num_true / (num_true + num_false))
+        recalls.append(num_true / num_gt_positives)
+
+    for i in range(len(precisions) - 1, 0, -1):
+        if precisions[i] > precisions[i - 1]:
+            precisions[i - 1] = precisions[i]
+
+    y_range = [0] * 101
+    x_range = np.array([x / 100 for x in range(101)])
+    recalls = np.array(recalls)
+
+    indices = np.searchsorted(recalls, x_range, side="left")
+    for bar_idx, precision_idx in enumerate(indices):
+        if precision_idx < len(precisions):
+            y_range[bar_idx] = precisions[precision_idx]
+
+    return sum(y_range) / len(y_range)
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_match_dets_matches_loop(seed):
+    rng = np.random.RandomState(seed)
+    num_pred = rng.randint(0, 25)
+    num_gt = rng.randint(0, 10)
+    num_crowd = rng.randint(0, 3)
+    num_classes = rng.randint(1, 4)
+
+    # Draw the IoUs from a few values so that there are plenty of ties, plus some nans
+    iou = rng.choice([0, 0.3, 0.5, 0.55, 0.7, 0.75, 0.9, 1, np.nan], (num_pred, num_gt))
+    pred_classes = list(rng.randint(num_classes, size=num_pred))
+    gt_classes = list(rng.randint(num_classes, size=num_gt))
+    scores = rng.choice([0.2, 0.5, 0.8, 0.9], num_pred)
+    indices = sorted(range(num_pred), key=lambda i: -scores[i])
+
+    if num_crowd > 0:
+        crowd_iou = rng.choice([0, 0.5, 0.6, 0.95], (num_pred, num_crowd))
+        crowd_classes = list(rng.randint(num_classes, size=num_crowd))
+    else:
+        crowd_iou = crowd_classes = None
+
+    args = (iou, crowd_iou, pred_classes, gt_classes, crowd_classes, indices)
+    is_true, is_ignored = match_dets(*args, iou_thresholds)
+    ref_true, ref_ignored = loop_match_dets(*args, iou_thresholds)
+
+    np.testing.assert_array_equal(is_true, ref_true)
+    np.testing.assert_array_equal(is_ignored, ref_ignored)
+
+
+@pytest.mark.parametrize("seed", range(100))
+def test_get_ap_matches_loop(seed):
+    rng = np.random.RandomState(seed)
+    num_points = rng.randint(0, 300)
+    num_gt_positives = rng.randint(0, 50)
+
+    # Tied scores have to keep the order they were pushed in
+    scores = rng.choice([rng.rand(), 0.5, 0.25], num_points)
+    is_true = rng.rand(num_points) < 0.4
+
+    ap_obj = APDataObject()
+    ap_obj.add_gt_positives(num_gt_positives)
+    split = num_points // 2
+    ap_obj.push_many(scores[:split], is_true[:split])
+    for score, true in zip(scores[split:], is_true[split:]):
+        ap_obj.push(score, true)
+
+    data_points = list(zip(scores.tolist(), is_true.tolist()))
+    assert ap_obj.get_ap() == loop_get_ap(data_points, num_gt_positives)
@@ -0,0 +1,158 @@
+""" Checks the ROI, packed, RLE and direct mask paths of postprocess against the dense versions, on random masks. """
+
+import numpy as np
+import pycocotools.mask
+import pytest
+import torch
+import torch.nn.functional as F
+
+from data import cfg, mask_type
+from layers.box_utils import mask_iou
+from layers.output_utils import (
+    PackedMasks,
+    RLEMasks,
+    ROIMasks,
+    paste_direct_masks,
+    postprocess,
+)
+
+
+def random_dets(seed, num_dets=12, proto_h=30, proto_w=36, mask_dim=8):
+    """ Detect output for one image, with boxes that can be tiny, huge or partly outside of the image. """
+    gen = torch.Generator().manual_seed(seed)
+
+    centers = torch.rand(num_dets, 2, generator=gen) * 1.2 - 0.1
+    sizes = torch.rand(num_dets, 2, generator=gen) ** 2 * 1.2
+    boxes = torch.cat([centers - sizes / 2, centers + sizes / 2], dim=1)
+
+    dets = {
+        "box": boxes,
+        "mask": torch.randn(num_dets, mask_dim, generator=gen),
+        "class": torch.randint(3, (num_dets,), generator=gen),
+        "score": torch.rand(num_dets, generator=gen),
+        "proto": torch.randn(proto_h, proto_w, mask_dim, generator=gen),
+    }
+    return [{"detection": dets, "net": None}]
+
+
+def dense_masks(seed, h, w, crop_masks=True):
+    return postprocess(random_dets(seed), w, h, crop_masks=crop_masks)[3]
+
+
+@pytest.fixture(autouse=True)
+def lincomb_cfg(monkeypatch):
+    monkeypatch.setattr(cfg, "mask_type", mask_type.lincomb)
+    monkeypatch.setattr(cfg, "eval_mask_branch", True)
+    monkeypatch.setattr(cfg, "use_maskiou", False)
+
+    # Normally set by eval.py
+    monkeypatch.setattr(cfg, "mask_proto_debug", False, raising=False)
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("crop_masks", [True, False])
+@pytest.mark.parametrize("h, w", [(97, 131), (240, 180)])
+def test_roi_upsample_matches_full(seed, crop_masks, h, w):
+    roi_masks = postprocess(
+        random_dets(seed), w, h, crop_masks=crop_masks, mask_upsample="roi"
+    )[3]
+
+    assert isinstance(roi_masks, ROIMasks)
+    assert torch.equal(roi_masks.to_dense(), dense_masks(seed, h, w, crop_masks))
+
+
+def edge_case_masks(h, w):
+    """ Empty and full masks, and runs that go from the bottom of a column into the next one. """
+    masks = torch.zeros(4, h, w)
+    masks[1] = 1
+    masks[2, h // 2 :, :] = 1
+    masks[3, -1, :] = 1
+    masks[3, 0, 1:] = 1
+    return masks
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("h, w", [(97, 131), (240, 180)])
+def test_packed_and_rle_match_dense(seed, h, w):
+    dense = torch.cat([dense_masks(seed, h, w), edge_case_masks(h, w)])
+    roi_masks = postprocess(random_dets(seed), w, h, mask_upsample="roi")[3]
+    bits = np.packbits(dense.numpy().astype(np.uint8).reshape(len(dense), -1), axis=1)
+
+    for packed in (PackedMasks.from_masks(dense), PackedMasks.from_masks(roi_masks)):
+        np.testing.assert_array_equal(packed.bits.numpy(), bits[: len(packed)])
+        assert torch.equal(packed.to_dense(), dense[: len(packed)])
+
+    coco = [
+        pycocotools.mask.encode(np.asfortranarray(x.numpy().astype(np.uint8)))
+        for x in dense
+    ]
+
+    for rle in (RLEMasks.from_masks(dense), RLEMasks.from_masks(roi_masks)):
+        assert torch.equal(rle.to_dense(), dense[: len(rle)])
+        assert [x["counts"] for x in rle.to_coco()] == [
+            x["counts"].decode("ascii") for x in coco[: len(rle)]
+        ]
+
+    # Indexing with a mask has to pick the same detections as with dense masks
+    keep = torch.arange(len(dense)) % 3 != 1
+    assert torch.equal(PackedMasks.from_masks(dense)[keep].to_dense(), dense[keep])
+    assert torch.equal(RLEMasks.from_masks(dense)[keep].to_dense(), dense[keep])
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("iscrowd", [False, True])
+def test_rle_iou_matches_dense(seed, iscrowd):
+    h, w = 97, 131
+    dets = torch.cat([dense_masks(seed, h, w), edge_case_masks(h, w)])
+    gt = torch.cat([dense_masks(seed + 100, h, w), edge_case_masks(h, w)])
+
+    iou = RLEMasks.from_masks(dets).iou(RLEMasks.from_masks(gt), iscrowd)
+    ref = mask_iou(dets, gt, iscrowd)
+
+    # pycocotools gives 0 instead of nan when there's nothing to divide by
+    assert torch.allclose(
+        iou, torch.where(torch.isnan(ref), torch.zeros_like(ref), ref)
+    )
+
+
+def loop_paste_direct_masks(masks, boxes, h, w, interpolation_mode):
+    """ How postprocess used to paste direct masks, one detection at a time. """
+    full_masks = torch.zeros(masks.size(0), h, w)
+
+    for jdx in range(masks.size(0)):
+        x1, y1, x2, y2 = boxes[jdx, :].tolist()
+
+        if (x2 - x1) * (y2 - y1) <= 0:
+            continue
+
+        # align_corners can only be passed for the linear modes
+        kwargs = {"align_corners": False} if interpolation_mode == "bilinear" else {}
+        mask = masks[jdx, :].view(1, 1, cfg.mask_size, cfg.mask_size)
+        mask = F.interpolate(
+            mask, (y2 - y1, x2 - x1), mode=interpolation_mode, **kwargs
+        )
+        full_masks[jdx, y1:y2, x1:x2] = mask.gt(0.5).float()
+
+    return full_masks
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("interpolation_mode", ["bilinear", "nearest", "area"])
+def test_paste_direct_masks_matches_loop(seed, interpolation_mode):
+    gen = torch.Generator().manual_seed(seed)
+    h, w = 83, 120
+    num_dets = 15
+
+    # Corners anywhere in the image, so some boxes are empty, one pixel wide or cover everything
+    xs = torch.randint(w + 1, (num_dets, 2), generator=gen).sort(dim=1)[0]
+    ys = torch.randint(h + 1, (num_dets, 2), generator=gen).sort(dim=1)[0]
+    boxes = torch.stack([xs[:, 0], ys[:, 0], xs[:, 1], ys[:, 1]], dim=1)
+    boxes[0] = torch.LongTensor([0, 0, w, h])
+    boxes[1, 2] = boxes[1, 0] + 1
+
+    masks = torch.rand(num_dets, cfg.mask_size ** 2, generator=gen)
+
+    assert torch.equal(
+        paste_direct_masks(masks, boxes, h, w, interpolation_mode),
+        loop_paste_direct_masks(masks, boxes, h, w, interpolation_mode),
+    )
@@ -425,6 +425,10 @@ def train():
                 # Zero the grad to get ready to compute gradients
                 optimizer.zero_grad()
 
+                # Measure the peak memory of each iteration on its own
+                for device in range(torch.cuda.device_count()):
+                    torch.cuda.reset_peak_memory_stats(device)
+
                 # Forward Pass + Compute loss at the same time (see CustomDataParallel and NetLoss)
                 losses = net(datum)
 
@@ -441,6 +445,15 @@ def train():
                 if torch.isfinite(loss).item():
                     optimizer.step()
 
+                # In GB, for whichever GPU used the most
+                peak_mem = (
+                    max(
+                        torch.cuda.max_memory_allocated(device)
+                        for device in range(torch.cuda.device_count())
+                    )
+                    / 1024 ** 3
+                )
+
                 # Add the loss to the moving average for bookkeeping
                 for k in losses:
                     loss_avgs[k].add(losses[k].item())
@@ -474,10 +487,12 @@ def train():
                         (
                             "[%3d] %7d ||"
                             + (" %s: %.3f |" * len(losses))
-                            + " T: %.3f || ETA: %s || timer: %.3f"
+                            + " T: %.3f || ETA: %s || timer: %.3f || mem: %.2fG"
                         )
                         % tuple(
-                            [epoch, iteration] + loss_labels + [total, eta_str, elapsed]
+                            [epoch, iteration]
+                            + loss_labels
+                            + [total, eta_str, elapsed, peak_mem]
                         ),
                         flush=True,
                     )
@@ -497,6 +512,7 @@ def train():
                         iter=iteration,
                         lr=round(cur_lr, 10),
                         elapsed=elapsed,
+                        peak_mem=round(peak_mem, 3),
                     )
 
                     log.log_gpu_stats = args.log_gpu
@@ -632,7 +632,7 @@ import torch.nn.functional as F
 
 class FastBaseTransform(torch.nn.Module):
     """
-    Transform that does all operations on the GPU for super speed.
+    Transform that does all operations on the input's device (i.e., the GPU) for super speed.
     This doesn't suppport a lot of config settings and should only be used for production.
     Maintain this as necessary.
     """
@@ -640,8 +640,9 @@ class FastBaseTransform(torch.nn.Module):
     def __init__(self):
         super().__init__()
 
-        self.mean = torch.Tensor(MEANS).float().cuda()[None, :, None, None]
-        self.std = torch.Tensor(STD).float().cuda()[None, :, None, None]
+        # These get moved to the device of the input in forward
+        self.mean = torch.Tensor(MEANS).float()[None, :, None, None]
+        self.std = torch.Tensor(STD).float()[None, :, None, None]
         self.transform = cfg.backbone.transform
 
     def forward(self, img):
@@ -0,0 +1,440 @@
+""" An in-process version of pycocotools' COCOeval that works right off of postprocess' output. """
+
+import numpy as np
+import torch
+import pycocotools.mask
+
+
+class COCOEvaluator:
+    """
+    Computes the same 12 summary metrics as pycocotools' COCOeval for bboxes and segmentations,
+    but without first writing every detection out to json and reading it back in. Add the
+    detections for each image with add_image, then call summarize at the end.
+
+    This follows COCOeval's rules exactly (crowds, area ranges, maxDets, tie breaking, etc.), so
+    it gives the same numbers as running run_coco_eval.py over the images that were added.
+    The difference is that matching is done for every category, iou threshold and area range at
+    once and accumulating is done with array ops, instead of in per image Python loops.
+    """
+
+    iou_types = ("bbox", "segm")
+
+    # These are the defaults in pycocotools' Params
+    iou_thresholds = np.linspace(0.5, 0.95, 10, endpoint=True)
+    recall_thresholds = np.linspace(0.0, 1.00, 101, endpoint=True)
+    max_dets = [1, 10, 100]
+    area_ranges = [
+        [0 ** 2, 1e5 ** 2],
+        [0 ** 2, 32 ** 2],
+        [32 ** 2, 96 ** 2],
+        [96 ** 2, 1e5 ** 2],
+    ]
+    area_names = ["all", "small", "medium", "large"]
+
+    def __init__(self, coco):
+        """ coco should be the pycocotools COCO object with the ground truth (i.e., dataset.coco). """
+        self.coco = coco
+        self.cat_ids = sorted(coco.getCatIds())
+        self.cat_idx = {cat_id: idx for idx, cat_id in enumerate(self.cat_ids)}
+
+        # The number of non-ignored gt for each category and area range
+        self.num_gt = np.zeros(
+            (len(self.cat_ids), len(self.area_ranges)), dtype=np.int64
+        )
+        self.images = {iou_type: [] for iou_type in self.iou_types}
+
+    def __getstate__(self):
+        # The ground truth can be huge and is only needed while adding images, so don't pickle it
+        state = self.__dict__.copy()
+        state["coco"] = None
+        return state
+
+    def add_image(
+        self,
+        image_id: int,
+        cat_ids: list,
+        boxes: np.ndarray,
+        box_scores: list,
+        mask_scores: list,
+        masks: torch.Tensor,
+    ):
+        """
+        Evaluates the detections for one image. Add every image that was evaluated, even if it has
+        no detections, since its ground truth still counts.
+
+        Args:
+            - image_id:    The coco image id.
+            - cat_ids:     [num_dets] The coco category id of each detection.
+            - boxes:       [num_dets, 4] Boxes in absolute (x1, y1, x2, y2) form.
+            - box_scores:  [num_dets] The score of each detection for bbox evaluation.
+            - mask_scores: [num_dets] The score of each detection for segm evaluation.
+            - masks:       [num_dets, h, w] (or [num_dets, h*w]) binary masks, on any device.
+                           This can also be PackedMasks or RLEMasks from postprocess, or None if
+                           there are no detections.
+        """
+        img_info = self.coco.imgs[image_id]
+        h, w = img_info["height"], img_info["width"]
+        gts = self.coco.imgToAnns[image_id]
+
+        gt_cats = np.array([gt["category_id"] for gt in gts], dtype=np.int64)
+        gt_crowd = np.array([bool(gt.get("iscrowd", 0)) for gt in gts], dtype=bool)
+        gt_area = np.array([gt["area"] for gt in gts], dtype=np.float64)
+        gt_ignored = gt_crowd[None, :] | self._outside_area(gt_area)
+
+        gt_cat_idx = np.array([self.cat_idx[c] for c in gt_cats], dtype=np.int64)
+        np.add.at(self.num_gt, gt_cat_idx, (~gt_ignored).T.astype(np.int64))
+
+        cat_ids = np.array(cat_ids, dtype=np.int64)
+        box_scores = np.array(box_scores, dtype=np.float64)
+        mask_scores = np.array(mask_scores, dtype=np.float64)
+
+        # These are the boxes COCOeval would see after the trip through json. Like Detections.add_bbox,
+        # get the width and height in the boxes' own dtype and only then round them as doubles.
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        boxes = np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+        boxes = np.round(boxes.astype(np.float64) * 10) / 10
+
+        if "bbox" in self.images:
+            gt_boxes = np.array([gt["bbox"] for gt in gts], dtype=np.float64)
+            ious = self._bbox_iou(boxes, gt_boxes.reshape(-1, 4), gt_crowd)
+            dt_area = boxes[:, 2] * boxes[:, 3]
+            self._add_matches(
+                "bbox",
+                image_id,
+                cat_ids,
+                box_scores,
+                dt_area,
+                ious,
+                gt_cats,
+                gt_crowd,
+                gt_ignored,
+            )
+
+        if "segm" in self.images:
+            if hasattr(masks, "to_coco"):
+                # RLEMasks from postprocess can go straight to pycocotools, just like in COCOeval
+                ious, dt_area = self._rle_iou(masks.to_coco(), gts, gt_crowd)
+            else:
+                if hasattr(masks, "to_dense"):
+                    masks = masks.to_dense()
+                ious, dt_area = self._mask_iou(masks, len(cat_ids), gts, gt_crowd, h, w)
+
+            self._add_matches(
+                "segm",
+                image_id,
+                cat_ids,
+                mask_scores,
+                dt_area,
+                ious,
+                gt_cats,
+                gt_crowd,
+                gt_ignored,
+            )
+
+    def _mask_iou(self, masks, num_dets, gts, gt_crowd, h, w):
+        """ Computes the mask IoU with the gt from dense masks. Returns (ious, dt_area). """
+        if num_dets > 0:
+            masks = masks.reshape(num_dets, h * w).float()
+            dt_area = masks.sum(1)
+        else:
+            masks = torch.zeros(0, h * w)
+            dt_area = torch.zeros(0)
+
+        if len(gts) > 0 and num_dets > 0:
+            gt_masks = np.stack([self.coco.annToMask(gt).reshape(-1) for gt in gts])
+            gt_masks = torch.from_numpy(gt_masks).to(masks.device).float()
+
+            # Every partial sum here is an integer under 2^24, so this is exact in float32
+            intersection = (masks @ gt_masks.t()).cpu().numpy().astype(np.float64)
+            gt_mask_area = gt_masks.sum(1).cpu().numpy().astype(np.float64)
+        else:
+            intersection = np.zeros((num_dets, len(gts)))
+            gt_mask_area = np.zeros(len(gts))
+
+        dt_area = dt_area.cpu().numpy().astype(np.float64)
+        union = np.where(
+            gt_crowd[None, :],
+            dt_area[:, None],
+            dt_area[:, None] + gt_mask_area[None, :] - intersection,
+        )
+        ious = np.where(intersection > 0, intersection / np.maximum(union, 1), 0)
+
+        return ious, dt_area
+
+    def _rle_iou(self, rles, gts, gt_crowd):
+        """ Computes the mask IoU with the gt from COCO RLEs. Returns (ious, dt_area). """
+        dt_area = np.array(pycocotools.mask.area(rles) if rles else [], np.float64)
+
+        if len(gts) > 0 and len(rles) > 0:
+            gt_rles = [self.coco.annToRLE(gt) for gt in gts]
+            ious = pycocotools.mask.iou(
+                rles, gt_rles, gt_crowd.astype(np.uint8).tolist()
+            )
+        else:
+            ious = np.zeros((len(rles), len(gts)))
+
+        return np.array(ious, dtype=np.float64), dt_area
+
+    def _outside_area(self, area: np.ndarray):
+        """ Returns [num_area_ranges, len(area)], whether each area is outside each area range. """
+        ranges = np.array(self.area_ranges, dtype=np.float64)
+        return (area[None, :] < ranges[:, 0:1]) | (area[None, :] > ranges[:, 1:2])
+
+    @staticmethod
+    def _bbox_iou(dt_boxes: np.ndarray, gt_boxes: np.ndarray, gt_crowd: np.ndarray):
+        """ The same as pycocotools' bbIou, with boxes in (x, y, w, h) form. Returns [num_dt, num_gt]. """
+        dt = dt_boxes[:, None, :]
+        gt = gt_boxes[None, :, :]
+
+        iw = np.minimum(dt[..., 2] + dt[..., 0], gt[..., 2] + gt[..., 0]) - np.maximum(
+            dt[..., 0], gt[..., 0]
+        )
+        ih = np.minimum(dt[..., 3] + dt[..., 1], gt[..., 3] + gt[..., 1]) - np.maximum(
+            dt[..., 1], gt[..., 1]
+        )
+        inter = np.where((iw > 0) & (ih > 0), iw * ih, 0)
+
+        dt_area = dt[..., 2] * dt[..., 3]
+        gt_area = gt[..., 2] * gt[..., 3]
+        union = np.where(gt_crowd[None, :], dt_area, dt_area + gt_area - inter)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(inter > 0, inter / union, 0)
+
+    def _add_matches(
+        self,
+        iou_type: str,
+        image_id: int,
+        cat_ids: np.ndarray,
+        scores: np.ndarray,
+        dt_area: np.ndarray,
+        ious: np.ndarray,
+        gt_cats: np.ndarray,
+        gt_crowd: np.ndarray,
+        gt_ignored: np.ndarray,
+    ):
+        """
+        Does what COCOeval.evaluateImg does for every category and area range of this image at once.
+        gt_ignored is [num_area_ranges, num_gt], and ious is [num_dt, num_gt].
+        """
+        num_areas = len(self.area_ranges)
+        num_thresholds = len(self.iou_thresholds)
+        num_gt = len(gt_cats)
+
+        # Sort the detections by category, then by score. Sorts are stable, like COCOeval's mergesort.
+        order = np.lexsort((-scores, cat_ids))
+        cat_ids, scores, dt_area, ious = (
+            cat_ids[order],
+            scores[order],
+            dt_area[order],
+            ious[order],
+        )
+
+        # The rank of each detection within its category
+        cat_start = np.searchsorted(cat_ids, cat_ids, side="left")
+        rank = np.arange(len(cat_ids)) - cat_start
+
+        # COCOeval only looks at the top maxDets detections per category
+        keep = rank < self.max_dets[-1]
+        cat_ids, scores, dt_area, ious, rank = (
+            cat_ids[keep],
+            scores[keep],
+            dt_area[keep],
+            ious[keep],
+            rank[keep],
+        )
+        num_dt = len(cat_ids)
+
+        dt_matched = np.zeros((num_areas, num_thresholds, num_dt), dtype=bool)
+        dt_ignored = np.zeros((num_areas, num_thresholds, num_dt), dtype=bool)
+
+        if num_dt > 0 and num_gt > 0:
+            gt_matched = np.zeros((num_areas, num_thresholds, num_gt), dtype=bool)
+
+            ious = np.where(cat_ids[:, None] == gt_cats[None, :], ious, -1)
+            thresholds = np.minimum(self.iou_thresholds, 1 - 1e-10)[None, :, None, None]
+            not_ignored = ~gt_ignored[:, None, None, :]
+            area_idx = np.arange(num_areas)[:, None, None]
+
+            # Detections in different categories can't compete for the same gt, so match the
+            # top detection of every category at once, then the second, and so on.
+            for r in range(rank.max() + 1):
+                dets = np.nonzero(rank == r)[0]
+                det_ious = ious[dets][None, None, :, :]
+
+                # Crowds can be matched any number of times
+                available = (~gt_matched | gt_crowd[None, None, :])[:, :, None, :]
+                candidates = available & (det_ious >= thresholds)
+
+                # A gt that isn't ignored always wins over one that is
+                preferred = candidates & not_ignored
+                candidates = np.where(
+                    preferred.any(axis=-1, keepdims=True), preferred, candidates
+                )
+
+                # Take the best iou, and for ties the last gt (since COCOeval uses >= when looping)
+                candidate_ious = np.where(candidates, det_ious, -np.inf)
+                best = num_gt - 1 - candidate_ious[..., ::-1].argmax(axis=-1)
+                found = candidates.any(axis=-1)
+
+                dt_matched[:, :, dets] = found
+                dt_ignored[:, :, dets] = found & gt_ignored[area_idx, best]
+
+                a, t, d = np.nonzero(found)
+                gt_matched[a, t, best[a, t, d]] = True
+
+        # Unmatched detections outside of the area range are ignored
+        dt_ignored |= ~dt_matched & self._outside_area(dt_area)[:, None, :]
+
+        self.images[iou_type].append(
+            {
+                "image_id": image_id,
+                "cat_idx": np.array([self.cat_idx[c] for c in cat_ids], dtype=np.int64),
+                "score": scores,
+                "rank": rank,
+                "matched": dt_matched,
+                "ignored": dt_ignored,
+            }
+        )
+
+    def merge(self, other):
+        """ Adds in the images from another evaluator, e.g., one from a different shard. """
+        self.num_gt += other.num_gt
+
+        for iou_type in self.iou_types:
+            self.images[iou_type] += other.images[iou_type]
+
+    def accumulate(self, iou_type: str):
+        """
+        Does what COCOeval.accumulate does. Returns precision [T, R, K, A, M] and recall [T, K, A, M],
+        with -1 wherever a category has no gt.
+        """
+        num_thresholds = len(self.iou_thresholds)
+        num_cats = len(self.cat_ids)
+        num_areas = len(self.area_ranges)
+        num_max_dets = len(self.max_dets)
+
+        precision = -np.ones(
+            (
+                num_thresholds,
+                len(self.recall_thresholds),
+                num_cats,
+                num_areas,
+                num_max_dets,
+            )
+        )
+        recall = -np.ones((num_thresholds, num_cats, num_areas, num_max_dets))
+
+        images = sorted(self.images[iou_type], key=lambda x: x["image_id"])
+        image_order = np.concatenate(
+            [np.full(len(x["score"]), idx) for idx, x in enumerate(images)] + [[]]
+        )
+        cat_idx = np.concatenate([x["cat_idx"] for x in images] + [[]]).astype(np.int64)
+        scores = np.concatenate([x["score"] for x in images] + [[]])
+        rank = np.concatenate([x["rank"] for x in images] + [[]])
+        matched = np.concatenate(
+            [x["matched"] for x in images] + [np.zeros((num_areas, num_thresholds, 0))],
+            axis=-1,
+        ).astype(bool)
+        ignored = np.concatenate(
+            [x["ignored"] for x in images] + [np.zeros((num_areas, num_thresholds, 0))],
+            axis=-1,
+        ).astype(bool)
+
+        # COCOeval concatenates the images in order and then mergesorts by score. That's the same
+        # as sorting by score, then image, then the detection's position in that image.
+        order = np.lexsort((rank, image_order, -scores, cat_idx))
+        cat_idx, rank = cat_idx[order], rank[order]
+        matched, ignored = matched[..., order], ignored[..., order]
+        cat_bounds = np.searchsorted(cat_idx, np.arange(num_cats + 1))
+
+        for k in range(num_cats):
+            cat_slice = slice(cat_bounds[k], cat_bounds[k + 1])
+
+            for a in range(num_areas):
+                num_positives = self.num_gt[k, a]
+                if num_positives == 0:
+                    continue
+
+                for m, max_det in enumerate(self.max_dets):
+                    keep = rank[cat_slice] < max_det
+                    dt_matched = matched[a, :, cat_slice][:, keep]
+                    dt_ignored = ignored[a, :, cat_slice][:, keep]
+
+                    tp_sum = np.cumsum(
+                        dt_matched & ~dt_ignored, axis=1, dtype=np.float64
+                    )
+                    fp_sum = np.cumsum(
+                        ~dt_matched & ~dt_ignored, axis=1, dtype=np.float64
+                    )
+                    num_dets = tp_sum.shape[1]
+
+                    rc = tp_sum / num_positives
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if num_dets > 0 else 0
+
+                    # Make precision monotonically decreasing
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+                    for t in range(num_thresholds):
+                        inds = np.searchsorted(
+                            rc[t], self.recall_thresholds, side="left"
+                        )
+                        valid = inds < num_dets
+                        q = np.zeros(len(self.recall_thresholds))
+                        q[valid] = pr[t, inds[valid]]
+                        precision[t, :, k, a, m] = q
+
+        return precision, recall
+
+    def summarize(self, iou_type: str):
+        """ Prints and returns the 12 COCOeval stats, in the same order and format as COCOeval. """
+        precision, recall = self.accumulate(iou_type)
+
+        def _summarize(ap: bool, iou_thresh=None, area="all", max_det=100):
+            a = self.area_names.index(area)
+            m = self.max_dets.index(max_det)
+
+            if ap:
+                s = precision[..., a, m]
+            else:
+                s = recall[..., a, m]
+
+            if iou_thresh is not None:
+                s = s[list(np.isclose(self.iou_thresholds, iou_thresh)).index(True)]
+                iou_str = "{:0.2f}".format(iou_thresh)
+            else:
+                iou_str = "{:0.2f}:{:0.2f}".format(
+                    self.iou_thresholds[0], self.iou_thresholds[-1]
+                )
+
+            mean_s = np.mean(s[s > -1]) if (s > -1).any() else -1
+
+            print(
+                " {:<18} {} @[ IoU={:<9} | area={:>6s} | maxDets={:>3d} ] = {:0.3f}".format(
+                    "Average Precision" if ap else "Average Recall",
+                    "(AP)" if ap else "(AR)",
+                    iou_str,
+                    area,
+                    max_det,
+                    mean_s,
+                )
+            )
+            return mean_s
+
+        stats = [
+            _summarize(True),
+            _summarize(True, iou_thresh=0.5),
+            _summarize(True, iou_thresh=0.75),
+            _summarize(True, area="small"),
+            _summarize(True, area="medium"),
+            _summarize(True, area="large"),
+            _summarize(False, max_det=1),
+            _summarize(False, max_det=10),
+            _summarize(False),
+            _summarize(False, area="small"),
+            _summarize(False, area="medium"),
+            _summarize(False, area="large"),
+        ]
+
+        return np.array(stats)
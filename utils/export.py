@@ -0,0 +1,107 @@
+"""
+Exports Yolact as one TorchScript or ONNX graph for serving. The graph goes from a batch of BGR images
+all the way to the padded output of Detect.detect_batch (decoded boxes after Fast NMS, plus the mask
+coefficients and prototypes), with the priors for one input size baked in. Running it only needs torch
+(or an ONNX runtime), not the config, the prior generation or the NMS code:
+
+    model = torch.jit.load("weights/yolact_base_54_800000.pt")
+    boxes, masks, classes, scores, num_dets, proto = model(img)
+
+export.py does this from the command line.
+"""
+
+import inspect
+
+import torch
+import torch.nn as nn
+
+from data.config import cfg, mask_type
+from utils.augmentations import FastBaseTransform
+from yolact import TraceableFPN
+
+output_names = ["boxes", "masks", "classes", "scores", "num_dets", "proto"]
+
+
+class ExportDetect:
+    """ Stands in for a Yolact's Detect so that the network returns detect_batch's padded tensors. """
+
+    def __init__(self, detect):
+        self.detect = detect
+
+    def __call__(self, predictions, net):
+        return self.detect.detect_batch(predictions)
+
+
+class YolactExport(nn.Module):
+    """
+    The whole inference graph of a Yolact network in eval mode. Note that this swaps out net.detect
+    and net.fpn.
+
+    Takes a [batch_size, h, w, 3] float BGR image tensor (0-255, any size, since it gets resized to
+    cfg.max_size) and returns a tuple of (boxes, masks, classes, scores, num_dets, proto), which are the
+    box, mask, class, score, num_dets and proto outputs of Detect.detect_batch. Only the first num_dets[i]
+    detections of image i are valid, and boxes are relative to the image size.
+    """
+
+    def __init__(self, net):
+        super().__init__()
+
+        if cfg.preserve_aspect_ratio:
+            print(
+                "Error: Exporting configs that preserve aspect ratio isn't supported."
+            )
+            exit()
+
+        if cfg.mask_type != mask_type.lincomb or not cfg.eval_mask_branch:
+            print("Error: Exporting needs a config with mask_type.lincomb masks.")
+            exit()
+
+        # Only Fast NMS has a fixed number of outputs and no data dependent control flow
+        net.detect.use_fast_nms = True
+        net.detect.nms_mode = None
+
+        # The FPN is a ScriptModule, which the ONNX exporter can't trace through
+        if cfg.fpn is not None:
+            net.fpn = TraceableFPN(net.fpn)
+
+        self.net = net
+        self.net.detect = ExportDetect(net.detect)
+        self.transform = FastBaseTransform()
+
+    def forward(self, img):
+        out = self.net(self.transform(img))
+        return tuple(
+            out[k] for k in ("box", "mask", "class", "score", "num_dets", "proto")
+        )
+
+
+def export_torchscript(model: YolactExport, example_img, path: str):
+    """ Traces model on example_img and saves the TorchScript module to path. Returns the traced module. """
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_img, check_trace=False)
+
+    traced.save(path)
+    return traced
+
+
+def export_onnx(model: YolactExport, example_img, path: str, opset_version: int = 14):
+    """ Exports model to an ONNX file at path, with a dynamic batch size and image size. """
+    dynamic_axes = {"image": {0: "batch_size", 1: "height", 2: "width"}}
+    dynamic_axes.update({name: {0: "batch_size"} for name in output_names})
+
+    # Newer versions of Pytorch default to the dynamo based exporter, which needs onnxscript
+    extra_args = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        extra_args["dynamo"] = False
+
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (example_img,),
+            path,
+            input_names=["image"],
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            **extra_args
+        )
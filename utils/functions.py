@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 import os
 import math
+import json
 from collections import deque
 from pathlib import Path
 from layers.interpolate import InterpolateModule
@@ -87,6 +89,84 @@ class ProgressBar:
         return self.string
 
 
+class JSONArrayWriter:
+    """
+    Writes a json array to a file one element at a time, so the whole array never has to be in
+    memory. Each element is put on its own line so it can be read back with read_json_array_lines.
+    Note that the file is only created once something is written or the writer is closed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.num_items = 0
+
+    def write(self, item):
+        """ Appends one json serializable item to the array. """
+        self.write_raw(json.dumps(item))
+
+    def write_raw(self, text):
+        """ Appends an element that's already been serialized to json. """
+        if self.file is None:
+            self.file = open(self.path, "w")
+            self.file.write("[")
+
+        self.file.write("\n" if self.num_items == 0 else ",\n")
+        self.file.write(text)
+        self.num_items += 1
+
+    def state(self):
+        """
+        Returns (offset, num_items) for everything written so far. Passing these to restore later
+        throws away whatever was written after this point.
+        """
+        if self.file is None:
+            return 0, 0
+
+        self.file.flush()
+        return self.file.tell(), self.num_items
+
+    def restore(self, offset, num_items):
+        """ Reopens a partially written array at a point returned by state, to keep writing it. """
+        if num_items == 0:
+            self.file = None
+        else:
+            self.file = open(self.path, "r+")
+            self.file.seek(offset)
+            self.file.truncate()
+
+        self.num_items = num_items
+
+    def close(self):
+        """ Closes the array off. After this the file is valid json. """
+        if self.file is None:
+            self.file = open(self.path, "w")
+            self.file.write("[")
+
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+def read_json_array_lines(f):
+    """
+    Given a file written by JSONArrayWriter and opened in binary mode, yields (offset, text) for
+    each element of the array without parsing it, where offset is where that element's line starts.
+    """
+    f.seek(0)
+
+    while True:
+        offset = f.tell()
+        line = f.readline()
+
+        if not line:
+            break
+
+        line = line.strip().rstrip(b",")
+
+        if line not in (b"", b"[", b"]"):
+            yield offset, line.decode("utf-8")
+
+
 def init_console():
     """
     Initialize the console to be able to use ANSI escape characters on Windows.
@@ -119,8 +199,9 @@ class SavePath:
     def from_str(path: str):
         file_name = os.path.basename(path)
 
-        if file_name.endswith(".pth"):
-            file_name = file_name[:-4]
+        for extension in (".pth", ".mm"):
+            if file_name.endswith(extension):
+                file_name = file_name[: -len(extension)]
 
         params = file_name.split("_")
 
@@ -226,3 +307,77 @@ def make_net(in_channels, conf, include_last_relu=True):
         net = net[:-1]
 
     return nn.Sequential(*(net)), in_channels
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Folds an eval mode BatchNorm2d into the conv layer that comes right before it, so that conv(x)
+    afterwards gives what bn(conv(x)) did before. The conv is modified in place (and gets a bias if
+    it didn't have one), after which bn can be replaced by an identity.
+
+    Everything is computed in double and then cast back so the folded weights only round once.
+    """
+    with torch.no_grad():
+        scale = torch.rsqrt(bn.running_var.double() + bn.eps)
+        shift = -bn.running_mean.double() * scale
+
+        if bn.affine:
+            scale = scale * bn.weight.double()
+            shift = shift * bn.weight.double() + bn.bias.double()
+
+        weight = conv.weight.double() * scale.view(-1, *([1] * (conv.weight.dim() - 1)))
+
+        if conv.bias is not None:
+            bias = conv.bias.double() * scale + shift
+        else:
+            bias = shift
+
+        conv.weight.copy_(weight)
+
+        if conv.bias is not None:
+            conv.bias.copy_(bias)
+        else:
+            conv.bias = nn.Parameter(
+                bias.to(dtype=conv.weight.dtype, device=conv.weight.device)
+            )
+
+    return conv
+
+
+def checkpoint_module(module, *inputs):
+    """
+    Calls module on inputs with activation checkpointing, i.e., without keeping the activations inside
+    module for the backward pass and instead recomputing them during it. The gradients are the same as
+    with module(*inputs) but the memory use is much lower.
+
+    Batch norm running stats only get updated by the first forward pass and not the recomputation.
+    """
+    batch_norms = [
+        m
+        for m in module.modules()
+        if isinstance(m, nn.modules.batchnorm._BatchNorm)
+        and m.training
+        and m.track_running_stats
+    ]
+    recomputing = False
+
+    def run(*inputs):
+        nonlocal recomputing
+
+        if not recomputing:
+            recomputing = True
+            return module(*inputs)
+
+        stats = [[x.clone() for x in bn.buffers()] for bn in batch_norms]
+        out = module(*inputs)
+
+        with torch.no_grad():
+            for bn, bn_stats in zip(batch_norms, stats):
+                for x, saved in zip(bn.buffers(), bn_stats):
+                    x.copy_(saved)
+
+        return out
+
+    # Stopping the recomputation early works by raising an exception, which TorchScript modules (like FPN) don't pass on
+    with torch.utils.checkpoint.set_checkpoint_early_stop(False):
+        return torch.utils.checkpoint.checkpoint(run, *inputs, use_reentrant=False)
@@ -0,0 +1,97 @@
+"""
+A flat weights format that can be memory-mapped straight into a network instead of unpickled. The file is
+
+    b"YOLACTMM" | header size (8 byte little endian) | json header | padding | tensor data
+
+where the header maps each state dict key to the dtype, shape and byte offset of its tensor, and every
+tensor starts on an alignment boundary. Loading one just maps the file and makes views into it, so it
+takes no time, and tensors are only read from disk once they're used. Since the mapping is copy-on-write,
+every process that loads the same file shares one copy of the weights in the page cache (until one of
+them writes to a tensor, e.g. when training or folding batch norms).
+
+Convert a .pth file with scripts/convert_to_mmap.py. Yolact.load_weights reads both formats.
+"""
+
+import json
+import os
+import struct
+
+import torch
+
+magic = b"YOLACTMM"
+alignment = 64
+extension = ".mm"
+
+
+def is_mmap_weights(path: str) -> bool:
+    """ Returns whether path is a file in this format (rather than a torch.save file). """
+    with open(path, "rb") as f:
+        return f.read(len(magic)) == magic
+
+
+def _align(offset: int) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_mmap_state_dict(state_dict, path: str):
+    """ Saves a state dict of tensors to path in this format. """
+    tensors = {k: v.detach().cpu().contiguous() for k, v in state_dict.items()}
+
+    # The offsets depend on the header size, so lay out the data relative to the start of it first
+    index = {}
+    data_size = 0
+    for key, tensor in tensors.items():
+        index[key] = {
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
+            "offset": data_size,
+        }
+        data_size = _align(data_size + tensor.numel() * tensor.element_size())
+
+    header = json.dumps(index).encode("utf-8")
+    data_start = _align(len(magic) + 8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+
+        for key, tensor in tensors.items():
+            f.seek(data_start + index[key]["offset"])
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+        # Pad the file out so that the last tensor's alignment padding is there too
+        f.truncate(data_start + data_size)
+
+
+def load_mmap_state_dict(path: str):
+    """
+    Maps a file saved by save_mmap_state_dict into memory and returns its state dict. The tensors are CPU
+    views into the mapping, so writing to them doesn't change the file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s isn't a memory-mapped weights file." % path)
+
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        index = json.loads(f.read(header_size).decode("utf-8"))
+
+    data_start = _align(len(magic) + 8 + header_size)
+    buffer = torch.from_file(
+        path, shared=False, size=os.path.getsize(path), dtype=torch.uint8
+    )
+
+    state_dict = {}
+    for key, info in index.items():
+        dtype = getattr(torch, info["dtype"])
+        start = data_start + info["offset"]
+        num_bytes = (
+            torch.Size(info["shape"]).numel()
+            * torch.empty((), dtype=dtype).element_size()
+        )
+
+        state_dict[key] = (
+            buffer[start : start + num_bytes].view(dtype).view(info["shape"])
+        )
+
+    return state_dict
@@ -0,0 +1,201 @@
+"""
+Static post-training int8 quantization of Yolact for CPU inference, using FX graph mode quantization.
+
+The backbone, FPN, protonet and prediction head convs are quantized. Everything after them (the priors,
+softmax, detection and mask assembly) stays in fp32. The usual flow is
+
+    net = Yolact()
+    net.load_weights(path)
+    net.eval()
+    quantize(net, dataset, num_images)
+    save_quantized(net, "weights/net_int8.pth")
+
+and then later load_quantized(net, "weights/net_int8.pth") on a new Yolact in eval mode, with the same
+config set. quantize.py does the first part from the command line.
+"""
+
+import random
+from contextlib import contextmanager
+from itertools import chain
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from data.config import cfg
+from yolact import TraceableFPN
+
+# The prediction module convs that get quantized (whichever of them the config uses)
+head_layers = (
+    "upfeature",
+    "bbox_layer",
+    "conf_layer",
+    "mask_layer",
+    "score_layer",
+    "inst_layer",
+    "gate_layer",
+)
+
+
+@contextmanager
+def fast_detect(net):
+    """ The detections aren't used when running images through net here, so use the cheapest NMS. """
+    use_fast_nms = net.detect.use_fast_nms
+    net.detect.use_fast_nms = True
+
+    try:
+        yield
+    finally:
+        net.detect.use_fast_nms = use_fast_nms
+
+
+def quantized_parts(net):
+    """ Returns a list of (module, attribute name) for every part of net that gets quantized. """
+    parts = [(net, "backbone")]
+
+    if cfg.fpn is not None:
+        parts.append((net, "fpn"))
+
+    if hasattr(net, "proto_net"):
+        parts.append((net, "proto_net"))
+
+    for pred_layer in net.prediction_layers:
+        # Shared prediction modules use the first one's layers
+        if pred_layer.parent[0] is None:
+            parts += [(pred_layer, x) for x in head_layers if hasattr(pred_layer, x)]
+
+    return parts
+
+
+def get_example_inputs(net, batch):
+    """
+    Runs batch through net in fp32 and returns the inputs each quantized part got, keyed by
+    (id(module), attribute name). FX needs these to prepare the parts.
+    """
+    example_inputs = {}
+    hooks = []
+
+    def save_inputs(key):
+        def hook(module, inputs):
+            if key not in example_inputs:
+                example_inputs[key] = inputs
+
+        return hook
+
+    for module, name in quantized_parts(net):
+        if name != "fpn":
+            part = getattr(module, name)
+            hooks.append(
+                part.register_forward_pre_hook(save_inputs((id(module), name)))
+            )
+
+    def save_fpn_inputs(module, inputs, outs):
+        fpn_key = (id(net), "fpn")
+        if fpn_key not in example_inputs:
+            example_inputs[fpn_key] = ([outs[i] for i in cfg.backbone.selected_layers],)
+
+    # The FPN is a ScriptModule, so get its inputs from the backbone instead
+    hooks.append(net.backbone.register_forward_hook(save_fpn_inputs))
+
+    try:
+        with torch.no_grad(), fast_detect(net):
+            net(batch)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    return example_inputs
+
+
+def prepare_quantization(net, example_batch):
+    """
+    Swaps every quantized part of net (which should be in eval mode) for an FX observed version, in place.
+    Run some calibration images through net after this and then call convert_quantization.
+
+    Args:
+        - net:           The fp32 Yolact network.
+        - example_batch: A [batch_size, 3, h, w] image tensor that's used to trace the network.
+    """
+    if any(type(m).__name__ == "DCN" for m in net.modules()):
+        print("Error: int8 quantization doesn't support the DCN layers in YOLACT++.")
+        exit()
+
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    example_inputs = get_example_inputs(net, example_batch)
+
+    for module, name in quantized_parts(net):
+        part = getattr(module, name)
+
+        if name == "fpn":
+            part = TraceableFPN(part)
+        elif isinstance(part, nn.Conv2d):
+            # Wrap single convs so that FX sees them as a module call
+            part = nn.Sequential(part)
+
+        setattr(
+            module,
+            name,
+            prepare_fx(part, qconfig_mapping, example_inputs[(id(module), name)]),
+        )
+
+
+def calibrate(net, images):
+    """ Runs each [batch_size, 3, h, w] image tensor in images through a prepared net to observe the activation ranges. """
+    with torch.no_grad(), fast_detect(net):
+        for image in images:
+            net(image)
+
+
+def convert_quantization(net):
+    """ Converts the parts observed by prepare_quantization to int8, in place. """
+    for module, name in quantized_parts(net):
+        setattr(module, name, convert_fx(getattr(module, name)))
+
+
+def calibration_images(dataset, num_images: int, seed: int = 0):
+    """ Yields num_images random (but always the same) images from a COCODetection dataset as [1, 3, h, w] tensors. """
+    indices = list(range(len(dataset)))
+    random.Random(seed).shuffle(indices)
+
+    for idx in indices[:num_images]:
+        yield dataset.pull_item(idx)[0][None]
+
+
+def quantize(net, dataset, num_images: int):
+    """
+    Quantizes an fp32 network in eval mode to int8 in place, calibrating the activation ranges on
+    num_images images from dataset (which should use BaseTransform). Returns net.
+    """
+    images = calibration_images(dataset, max(num_images, 1))
+    first_image = next(images)
+
+    prepare_quantization(net, first_image)
+    calibrate(net, chain([first_image], images))
+    convert_quantization(net)
+    return net
+
+
+def save_quantized(net, path: str):
+    """ Saves a network quantized by quantize. """
+    torch.save(
+        {"engine": torch.backends.quantized.engine, "state_dict": net.state_dict()},
+        path,
+    )
+
+
+def load_quantized(net, path: str):
+    """
+    Loads a network saved by save_quantized into net, which should be a new fp32 Yolact in eval mode
+    made with the same config. Returns net.
+    """
+    data = torch.load(path, map_location="cpu")
+    torch.backends.quantized.engine = data["engine"]
+
+    # The calibration doesn't matter here since it gets overwritten by the saved state
+    example_batch = torch.zeros(1, 3, cfg.max_size, cfg.max_size)
+    prepare_quantization(net, example_batch)
+    calibrate(net, [example_batch])
+    convert_quantization(net)
+    net.load_state_dict(data["state_dict"])
+    return net
@@ -7,6 +7,7 @@ _disabled_names = set()
 _timer_stack = []
 _running_timer = None
 _disable_all = False
+_sync_fn = None
 
 
 def disable_all():
@@ -29,6 +30,15 @@ def enable(fn_name):
     _disabled_names.remove(fn_name)
 
 
+def set_sync(fn=None):
+    """
+    Sets a function to call every time a timer starts or stops, e.g. torch.cuda.synchronize so that
+    asynchronous GPU work gets counted toward the stage that launched it. Pass None to turn it off.
+    """
+    global _sync_fn
+    _sync_fn = fn
+
+
 def reset():
     """ Resets the current timer. Call this at the start of an iteration. """
     global _running_timer
@@ -49,6 +59,9 @@ def start(fn_name, use_stack=True):
     if _disable_all:
         return
 
+    if _sync_fn is not None:
+        _sync_fn()
+
     if use_stack:
         if _running_timer is not None:
             stop(_running_timer, use_stack=False)
@@ -72,6 +85,9 @@ def stop(fn_name=None, use_stack=True):
     if _disable_all:
         return
 
+    if _sync_fn is not None:
+        _sync_fn()
+
     if use_stack:
         if _running_timer is not None:
             stop(_running_timer, use_stack=False)
@@ -115,6 +131,15 @@ def print_stats():
     print()
 
 
+def get_times():
+    """ Returns a dict of the time in seconds accumulated by each function since the last reset. """
+    return {
+        name: elapsed_time
+        for name, elapsed_time in _total_times.items()
+        if name not in _disabled_names
+    }
+
+
 def total_time():
     """ Returns the total amount accumulated across all functions in seconds. """
     return sum(
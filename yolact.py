@@ -1,25 +1,28 @@
+import copy
 import torch, torchvision
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision.models.resnet import Bottleneck
 import numpy as np
-from itertools import product
 from math import sqrt
 from typing import List
-from collections import defaultdict
+from functools import lru_cache
 
 from data.config import cfg, mask_type
 from layers import Detect
 from layers.interpolate import InterpolateModule
-from backbone import construct_backbone
+from backbone import construct_backbone, ResNetBackbone
 
 import torch.backends.cudnn as cudnn
 from utils import timer
-from utils.functions import MovingAverage, make_net
+from utils.functions import MovingAverage, make_net, fuse_conv_bn, checkpoint_module
+from utils.mmap_weights import is_mmap_weights, load_mmap_state_dict
 
 # This is required for Pytorch 1.0.1 on Windows to initialize Cuda on some driver versions.
 # See the bug report here: https://github.com/pytorch/pytorch/issues/17108
-torch.cuda.current_device()
+# Skip it on machines without a GPU so the model can still be used on the CPU.
+if torch.cuda.is_available():
+    torch.cuda.current_device()
 
 # As of March 10, 2019, Pytorch DataParallel still doesn't support JIT Script Modules
 use_jit = torch.cuda.device_count() <= 1
@@ -42,7 +45,60 @@ class Concat(nn.Module):
         return torch.cat([net(x) for net in self.nets], dim=1, **self.extra_params)
 
 
-prior_cache = defaultdict(lambda: None)
+@lru_cache(maxsize=128)
+def make_prior_data(
+    conv_h: int,
+    conv_w: int,
+    aspect_ratios: tuple,
+    scales: tuple,
+    max_size: int,
+    preapply_sqrt: bool,
+    use_pixel_scales: bool,
+    use_square_anchors: bool,
+    device: torch.device,
+):
+    """
+    Makes the [conv_h * conv_w * num_priors_per_cell, 4] priors for one prediction layer on
+    the given device, in [x, y, width, height] form where (x, y) is the center of the box.
+
+    The results are cached for the whole process, so this only ever runs once for each conv size,
+    prior configuration and device (which also means DataParallel doesn't copy them each iteration).
+    Don't modify the returned tensor in place, since it's shared.
+    """
+    # Every cell has the same widths and heights, in this order (it has to sync up with the convout)
+    prior_wh = []
+    for ars in aspect_ratios:
+        for scale in scales:
+            for ar in ars:
+                if not preapply_sqrt:
+                    ar = sqrt(ar)
+
+                if use_pixel_scales:
+                    w = scale * ar / max_size
+                    h = scale / ar / max_size
+                else:
+                    w = scale * ar / conv_w
+                    h = scale / ar / conv_h
+
+                # This is for backward compatability with a bug where I made everything square by accident
+                if use_square_anchors:
+                    h = w
+
+                prior_wh.append([w, h])
+
+    # +0.5 because priors are in center-size notation. Rows are the outer loop, then columns.
+    y = (torch.arange(conv_h, dtype=torch.float64) + 0.5) / conv_h
+    x = (torch.arange(conv_w, dtype=torch.float64) + 0.5) / conv_w
+    y = y[:, None].expand(conv_h, conv_w)
+    x = x[None, :].expand(conv_h, conv_w)
+
+    num_priors = len(prior_wh)
+    centers = torch.stack([x, y], dim=2).view(-1, 1, 2).expand(-1, num_priors, -1)
+    prior_wh = torch.tensor(prior_wh, dtype=torch.float64)[None].expand_as(centers)
+
+    # Do everything in double and then round once, like making a Tensor out of a list of floats
+    priors = torch.cat([centers, prior_wh], dim=2).view(-1, 4).float()
+    return priors.to(device)
 
 
 class PredictionModule(nn.Module):
@@ -174,10 +230,6 @@ class PredictionModule(nn.Module):
         self.aspect_ratios = aspect_ratios
         self.scales = scales
 
-        self.priors = None
-        self.last_conv_size = None
-        self.last_img_size = None
-
     def forward(self, x):
         """
         Args:
@@ -303,57 +355,26 @@ class PredictionModule(nn.Module):
         return preds
 
     def make_priors(self, conv_h, conv_w, device):
-        """ Note that priors are [x,y,width,height] where (x,y) is the center of the box. """
-        global prior_cache
-        size = (conv_h, conv_w)
+        """
+        Note that priors are [x,y,width,height] where (x,y) is the center of the box.
 
+        This doesn't store anything on the module (the priors only depend on the conv size, which
+        is passed in), so one network can run on differently sized images from several threads.
+        """
         with timer.env("makepriors"):
-            if self.last_img_size != (cfg._tmp_img_w, cfg._tmp_img_h):
-                prior_data = []
-
-                # Iteration order is important (it has to sync up with the convout)
-                for j, i in product(range(conv_h), range(conv_w)):
-                    # +0.5 because priors are in center-size notation
-                    x = (i + 0.5) / conv_w
-                    y = (j + 0.5) / conv_h
-
-                    for ars in self.aspect_ratios:
-                        for scale in self.scales:
-                            for ar in ars:
-                                if not cfg.backbone.preapply_sqrt:
-                                    ar = sqrt(ar)
-
-                                if cfg.backbone.use_pixel_scales:
-                                    w = scale * ar / cfg.max_size
-                                    h = scale / ar / cfg.max_size
-                                else:
-                                    w = scale * ar / conv_w
-                                    h = scale / ar / conv_h
-
-                                # This is for backward compatability with a bug where I made everything square by accident
-                                if cfg.backbone.use_square_anchors:
-                                    h = w
-
-                                prior_data += [x, y, w, h]
-
-                self.priors = (
-                    torch.Tensor(prior_data, device=device).view(-1, 4).detach()
-                )
-                self.priors.requires_grad = False
-                self.last_img_size = (cfg._tmp_img_w, cfg._tmp_img_h)
-                self.last_conv_size = (conv_w, conv_h)
-                prior_cache[size] = None
-            elif self.priors.device != device:
-                # This whole weird situation is so that DataParalell doesn't copy the priors each iteration
-                if prior_cache[size] is None:
-                    prior_cache[size] = {}
-
-                if device not in prior_cache[size]:
-                    prior_cache[size][device] = self.priors.to(device)
-
-                self.priors = prior_cache[size][device]
+            priors = make_prior_data(
+                conv_h,
+                conv_w,
+                tuple(tuple(ars) for ars in self.aspect_ratios),
+                tuple(self.scales),
+                cfg.max_size,
+                cfg.backbone.preapply_sqrt,
+                cfg.backbone.use_pixel_scales,
+                cfg.backbone.use_square_anchors,
+                device,
+            )
 
-        return self.priors
+        return priors
 
 
 class FPN(ScriptModuleWrapper):
@@ -483,6 +504,76 @@ class FPN(ScriptModuleWrapper):
         return out
 
 
+class TraceableFPN(nn.Module):
+    """
+    A plain (i.e., not TorchScript) copy of an FPN, for tracing it with FX (for quantization) or the ONNX
+    exporter, neither of which can go through a ScriptModule. The forward pass does the same thing as FPN's
+    without the TorchScript workarounds, so keep the two in sync.
+    """
+
+    def __init__(self, fpn):
+        super().__init__()
+
+        self.lat_layers = nn.ModuleList([copy.deepcopy(x) for x in fpn.lat_layers])
+        self.pred_layers = nn.ModuleList([copy.deepcopy(x) for x in fpn.pred_layers])
+
+        if fpn.use_conv_downsample:
+            self.downsample_layers = nn.ModuleList(
+                [copy.deepcopy(x) for x in fpn.downsample_layers]
+            )
+
+        self.interpolation_mode = fpn.interpolation_mode
+        self.num_downsample = fpn.num_downsample
+        self.use_conv_downsample = fpn.use_conv_downsample
+        self.relu_downsample_layers = fpn.relu_downsample_layers
+        self.relu_pred_layers = fpn.relu_pred_layers
+
+    def forward(self, convouts):
+        num_layers = len(self.lat_layers)
+        out = [None] * num_layers
+
+        # The conv layers are stored in reverse, so use j=-i-1 for the input and output like FPN does
+        x = None
+        for i, lat_layer in enumerate(self.lat_layers):
+            j = num_layers - i - 1
+
+            if x is None:
+                x = lat_layer(convouts[j])
+            else:
+                x = F.interpolate(
+                    x,
+                    size=convouts[j].shape[-2:],
+                    mode=self.interpolation_mode,
+                    align_corners=False,
+                )
+                x = x + lat_layer(convouts[j])
+
+            out[j] = x
+
+        for i, pred_layer in enumerate(self.pred_layers):
+            j = num_layers - i - 1
+            out[j] = pred_layer(out[j])
+
+            if self.relu_pred_layers:
+                out[j] = F.relu(out[j])
+
+        cur_idx = len(out)
+
+        if self.use_conv_downsample:
+            for downsample_layer in self.downsample_layers:
+                out.append(downsample_layer(out[-1]))
+        else:
+            for idx in range(self.num_downsample):
+                out.append(F.max_pool2d(out[-1], 1, stride=2))
+
+        if self.relu_downsample_layers:
+            # Note: this overwrites the first outputs, but it's what FPN does
+            for idx in range(len(out) - cur_idx):
+                out[idx] = F.relu(out[idx + cur_idx])
+
+        return out
+
+
 class FastMaskIoUNet(ScriptModuleWrapper):
     def __init__(self):
         super().__init__()
@@ -524,6 +615,15 @@ class Yolact(nn.Module):
 
         self.backbone = construct_backbone(cfg.backbone)
 
+        if len(cfg.checkpoint_backbone_layers) > 0:
+            if not isinstance(self.backbone, ResNetBackbone):
+                print(
+                    "Error: Activation checkpointing the backbone is only supported for ResNet backbones."
+                )
+                exit()
+
+            self.backbone.checkpoint_layers = cfg.checkpoint_backbone_layers
+
         if cfg.freeze_bn:
             self.freeze_bn()
 
@@ -613,8 +713,20 @@ class Yolact(nn.Module):
         torch.save(self.state_dict(), path)
 
     def load_weights(self, path):
-        """ Loads weights from a compressed save file. """
-        state_dict = torch.load(path)
+        """
+        Loads weights from a compressed save file, or from a memory-mapped one made by
+        scripts/convert_to_mmap.py. In the latter case, the network's tensors are views into the
+        (copy-on-write) mapping on the CPU, so move the network to the GPU afterwards if needed.
+        """
+        use_mmap = is_mmap_weights(path)
+
+        if use_mmap:
+            state_dict = load_mmap_state_dict(path)
+        else:
+            # Weights saved from the GPU have to be mapped to the CPU on machines without one
+            state_dict = torch.load(
+                path, map_location=None if torch.cuda.is_available() else "cpu"
+            )
 
         # For backward compatability, remove these (the new variable is called layers)
         for key in list(state_dict.keys()):
@@ -630,7 +742,12 @@ class Yolact(nn.Module):
                     and int(key.split(".")[2]) >= cfg.fpn.num_downsample
                 ):
                     del state_dict[key]
-        self.load_state_dict(state_dict)
+
+        if use_mmap:
+            # Assigning the mapped tensors instead of copying them is what lets processes share them
+            self.load_state_dict(state_dict, assign=True)
+        else:
+            self.load_state_dict(state_dict)
 
     def init_weights(self, backbone_path):
         """ Initialize weights for training. """
@@ -710,12 +827,44 @@ class Yolact(nn.Module):
                 module.weight.requires_grad = enable
                 module.bias.requires_grad = enable
 
+    def fuse_for_inference(self):
+        """
+        Folds every BatchNorm2d that directly follows a conv into that conv and replaces it with an
+        identity, which saves a pass over each of those activation maps. Call this after load_weights.
+
+        This puts the network in eval mode, and the BN layers are gone afterward, so don't train or
+        save weights from a fused network. The pairs folded are bnX after convX in the same module
+        (the ResNet bottlenecks and stem, and the prediction module) and conv -> bn in Sequentials.
+        """
+        self.eval()
+
+        for module in list(self.modules()):
+            children = dict(module.named_children())
+
+            if isinstance(module, nn.Sequential):
+                names = list(children.keys())
+                pairs = list(zip(names[:-1], names[1:]))
+            else:
+                pairs = [
+                    ("conv" + name[2:], name)
+                    for name in children
+                    if name.startswith("bn") and "conv" + name[2:] in children
+                ]
+
+            for conv_name, bn_name in pairs:
+                conv = children[conv_name]
+                bn = children[bn_name]
+
+                if isinstance(bn, nn.BatchNorm2d) and hasattr(conv, "weight"):
+                    if (
+                        conv.weight.dim() == 4
+                        and conv.weight.size(0) == bn.num_features
+                    ):
+                        fuse_conv_bn(conv, bn)
+                        setattr(module, bn_name, nn.Identity())
+
     def forward(self, x):
         """ The input should be of size [batch_size, 3, img_h, img_w] """
-        _, _, img_h, img_w = x.size()
-        cfg._tmp_img_h = img_h
-        cfg._tmp_img_w = img_w
-
         with timer.env("backbone"):
             outs = self.backbone(x)
 
@@ -723,7 +872,11 @@ class Yolact(nn.Module):
             with timer.env("fpn"):
                 # Use backbone.selected_layers because we overwrote self.selected_layers
                 outs = [outs[i] for i in cfg.backbone.selected_layers]
-                outs = self.fpn(outs)
+
+                if cfg.checkpoint_fpn and self.training:
+                    outs = checkpoint_module(self.fpn, outs)
+                else:
+                    outs = self.fpn(outs)
 
         proto_out = None
         if cfg.mask_type == mask_type.lincomb and cfg.eval_mask_branch:
@@ -734,7 +887,10 @@ class Yolact(nn.Module):
                     grids = self.grid.repeat(proto_x.size(0), 1, 1, 1)
                     proto_x = torch.cat([proto_x, grids], dim=1)
 
-                proto_out = self.proto_net(proto_x)
+                if cfg.checkpoint_proto_net and self.training:
+                    proto_out = checkpoint_module(self.proto_net, proto_x)
+                else:
+                    proto_out = self.proto_net(proto_x)
                 proto_out = cfg.mask_proto_prototype_activation(proto_out)
 
                 if cfg.mask_proto_prototypes_as_features:
@@ -750,7 +906,10 @@ class Yolact(nn.Module):
                 if cfg.mask_proto_bias:
                     bias_shape = [x for x in proto_out.size()]
                     bias_shape[-1] = 1
-                    proto_out = torch.cat([proto_out, torch.ones(*bias_shape)], -1)
+                    proto_out = torch.cat(
+                        [proto_out, torch.ones(*bias_shape, device=proto_out.device)],
+                        -1,
+                    )
 
         with timer.env("pred_heads"):
             pred_outs = {"loc": [], "conf": [], "mask": [], "priors": []}
@@ -865,10 +1024,6 @@ if __name__ == "__main__":
     x = torch.zeros((1, 3, cfg.max_size, cfg.max_size))
     y = net(x)
 
-    for p in net.prediction_layers:
-        print(p.last_conv_size)
-
-    print()
     for k, a in y.items():
         print(k + ": ", a.size(), torch.sum(a))
     exit()